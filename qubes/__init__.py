@@ -134,6 +134,12 @@ class Label(object):
             self.icon_dispvm) + ".png"
 
 
+#: incremented whenever :py:class:`property` objects are added to or removed
+#: from an existing class, to invalidate the cache of
+#: :py:meth:`PropertyHolder.property_list`
+_properties_generation = 0
+
+
 class property(object):  # pylint: disable=redefined-builtin,invalid-name
     '''Qubes property.
 
@@ -239,6 +245,18 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
             self.__delete__(instance)
             return
 
+        if not (instance.has_handlers('property-pre-set:' + self.__name__)
+                or instance.has_handlers('property-set:' + self.__name__)):
+            # nobody listens (in particular, when loading from XML), don't
+            # bother with old value, which may be an expensive default
+            if self._setter is not None:
+                value = self._setter(instance, self, value)
+            if self.type not in (None, type(value)):
+                value = self.type(value)
+            # pylint: disable=protected-access
+            instance._property_init(self, value)
+            return
+
         try:
             oldvalue = getattr(instance, self.__name__)
             has_oldvalue = True
@@ -282,10 +300,7 @@ class property(object):  # pylint: disable=redefined-builtin,invalid-name
             instance.fire_event('property-pre-del:' + self.__name__,
                 pre_event=True,
                 name=self.__name__, oldvalue=oldvalue)
-            try:
-                delattr(instance, self._attr_name)
-            except AttributeError:
-                pass
+            instance._property_del(self)  # pylint: disable=protected-access
             instance.fire_event('property-del:' + self.__name__,
                 name=self.__name__, oldvalue=oldvalue)
 
@@ -431,7 +446,28 @@ def stateless_property(func):
         doc=func.__doc__)
 
 
-class PropertyHolder(qubes.events.Emitter):
+class PropertyHolderMeta(qubes.events.EmitterMeta):
+    '''Metaclass for :py:class:`PropertyHolder`
+
+    Keeps cached :py:meth:`PropertyHolder.property_list` valid when
+    properties are added to (or removed from) a class after it was created.
+    '''
+
+    def __setattr__(cls, name, value):
+        if isinstance(value, property) \
+                or isinstance(cls.__dict__.get(name), property):
+            global _properties_generation  # pylint: disable=global-statement
+            _properties_generation += 1
+        super().__setattr__(name, value)
+
+    def __delattr__(cls, name):
+        if isinstance(cls.__dict__.get(name), property):
+            global _properties_generation  # pylint: disable=global-statement
+            _properties_generation += 1
+        super().__delattr__(name)
+
+
+class PropertyHolder(qubes.events.Emitter, metaclass=PropertyHolderMeta):
     '''Abstract class for holding :py:class:`qubes.property`
 
     Events fired by instances of this class:
@@ -503,33 +539,57 @@ class PropertyHolder(qubes.events.Emitter):
         for key, value in propvalues.items():
             setattr(self, key, value)
 
+        # (xml node, [(name, value), ...]) for load_properties()
+        self._xml_property_values = None
+
         if self.xml is not None:
             # check if properties are appropriate
-            all_names = set(prop.__name__ for prop in self.property_list())
+            all_names = self._property_cache()[2]
 
-            for node in self.xml.xpath('./properties/property'):
-                name = node.get('name')
+            for name, _ in self._get_xml_property_values():
                 if name not in all_names:
                     raise TypeError(
                         'property {!r} not applicable to {!r}'.format(
                             name, self.__class__.__name__))
 
     @classmethod
-    def property_list(cls, load_stage=None):
-        '''List all properties attached to this VM's class
+    def _property_cache(cls):
+        '''Properties of this class, computed once per class.
 
-        :param load_stage: Filter by load stage
-        :type load_stage: :py:func:`int` or :py:obj:`None`
+        :returns: tuple (generation, {load_stage: properties}, \
+            {name: property})
         '''
 
+        cache = cls.__dict__.get('__property_cache__')
+        if cache is not None and cache[0] == _properties_generation:
+            return cache
+
         props = set()
         for class_ in cls.__mro__:
             props.update(prop for prop in class_.__dict__.values()
                 if isinstance(prop, property))
-        if load_stage is not None:
-            props = set(prop for prop in props
-                if prop.load_stage == load_stage)
-        return sorted(props)
+        props = tuple(sorted(props))
+
+        cache = (_properties_generation, {None: props},
+            {prop.__name__: prop for prop in props})
+        cls.__property_cache__ = cache
+        return cache
+
+    @classmethod
+    def property_list(cls, load_stage=None):
+        '''List all properties attached to this VM's class
+
+        :param load_stage: Filter by load stage
+        :type load_stage: :py:func:`int` or :py:obj:`None`
+        '''
+
+        by_stage = cls._property_cache()[1]
+        try:
+            props = by_stage[load_stage]
+        except KeyError:
+            props = by_stage[load_stage] = tuple(prop
+                for prop in by_stage[None] if prop.load_stage == load_stage)
+        return list(props)
 
     def _property_init(self, prop, value):
         '''Initialise property to a given value, without side effects.
@@ -541,6 +601,17 @@ class PropertyHolder(qubes.events.Emitter):
         # pylint: disable=protected-access
         setattr(self, self.property_get_def(prop)._attr_name, value)
 
+    def _property_del(self, prop):
+        '''Reset property to its default value, without side effects.
+
+        :param qubes.property prop: property object of particular interest
+        '''
+
+        # pylint: disable=protected-access
+        try:
+            delattr(self, self.property_get_def(prop)._attr_name)
+        except AttributeError:
+            pass
 
     def property_is_default(self, prop):
         '''Check whether property is in it's default value.
@@ -584,12 +655,11 @@ class PropertyHolder(qubes.events.Emitter):
         if isinstance(prop, qubes.property):
             return prop
 
-        for p in cls.property_list():
-            if p.__name__ == prop:
-                return p
-
-        raise AttributeError('No property {!r} found in {!r}'.format(
-            prop, cls))
+        try:
+            return cls._property_cache()[2][prop]
+        except KeyError:
+            raise AttributeError('No property {!r} found in {!r}'.format(
+                prop, cls))
 
 
     def load_properties(self, load_stage=None):
@@ -604,15 +674,27 @@ class PropertyHolder(qubes.events.Emitter):
             return
         all_names = set(
             prop.__name__ for prop in self.property_list(load_stage))
-        for node in self.xml.xpath('./properties/property'):
-            name = node.get('name')
-            value = node.get('ref') or node.text
-
+        for name, value in self._get_xml_property_values():
             if not name in all_names:
                 continue
 
             setattr(self, name, value)
 
+    def _get_xml_property_values(self):
+        '''Names and values of properties stored in :py:attr:`xml`.
+
+        The XML is parsed once, not on every load stage.
+
+        :rtype: list of (str, str) tuples
+        '''
+
+        if self._xml_property_values is None \
+                or self._xml_property_values[0] is not self.xml:
+            self._xml_property_values = (self.xml, [
+                (node.get('name'), node.get('ref') or node.text)
+                for node in self.xml.xpath('./properties/property')])
+        return self._xml_property_values[1]
+
 
     def xml_properties(self, with_defaults=False):
         '''Iterator that yields XML nodes representing set properties.
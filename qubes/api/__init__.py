@@ -20,6 +20,7 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
 import errno
 import functools
 import io
@@ -29,6 +30,7 @@ import socket
 import struct
 import traceback
 
+import qubes.config
 import qubes.exc
 
 class ProtocolError(AssertionError):
@@ -152,6 +154,39 @@ class AbstractQubesAPI(object):
 
     @classmethod
     def list_methods(cls, select_method=None):
+        '''List API methods implemented by this class
+
+        :param str select_method: if given, list only methods serving this \
+            call
+        :return: iterator of ``(func, rpcname, endpoint)`` tuples
+        '''
+        index = cls._method_index()
+        if select_method is None:
+            for candidates in index.values():
+                yield from candidates
+        else:
+            yield from index.get(select_method, ())
+
+    @classmethod
+    def list_method_names(cls):
+        '''Names of all calls available in this API, sorted'''
+        return sorted(cls._method_index())
+
+    @classmethod
+    def _method_index(cls):
+        '''Dictionary of rpcname → list of ``(func, rpcname, endpoint)``
+
+        Names (including endpoints from entry points) are fixed when methods
+        are decorated, so this is computed once per class, instead of
+        scanning the class for each request.
+        '''
+        # look in __dict__, to not get index of the parent class
+        try:
+            return cls.__dict__['_method_index_cache']
+        except KeyError:
+            pass
+
+        index = collections.OrderedDict()
         for attr in dir(cls):
             func = getattr(cls, attr)
             if not callable(func):
@@ -164,8 +199,10 @@ class AbstractQubesAPI(object):
                 continue
 
             for mname, endpoint in rpcnames:
-                if select_method is None or mname == select_method:
-                    yield (func, mname, endpoint)
+                index.setdefault(mname, []).append((func, mname, endpoint))
+
+        cls._method_index_cache = index
+        return index
 
     def execute(self, *, untrusted_payload):
         '''Execute management operation.
@@ -176,10 +213,28 @@ class AbstractQubesAPI(object):
         kwargs = {}
         if endpoint is not None:
             kwargs['endpoint'] = endpoint
-        self._running_handler = asyncio.ensure_future(handler(self,
-            untrusted_payload=untrusted_payload, **kwargs))
+        coro = handler(self, untrusted_payload=untrusted_payload, **kwargs)
+        classifiers = getattr(handler, 'classifiers', {})
+        if classifiers.get('write') or classifiers.get('execute'):
+            coro = self._execute_and_save(coro)
+        self._running_handler = asyncio.ensure_future(coro)
         return self._running_handler
 
+    @asyncio.coroutine
+    def _execute_and_save(self, coro):
+        '''Run the handler, then wait until changes are written to
+        :file:`qubes.xml`
+
+        With delayed saving (see :py:meth:`qubes.Qubes.enable_delayed_save`)
+        this ensures that success is not reported before the change is
+        durable. Calls finishing at the same time share one write.
+        '''
+        result = yield from coro
+        delayed_save = getattr(self.app, 'delayed_save', None)
+        if delayed_save is not None:
+            yield from delayed_save.sync()
+        return result
+
     def cancel(self):
         '''If operation is cancellable, interrupt it'''
         if self.cancellable and self._running_handler is not None:
@@ -197,9 +252,123 @@ class AbstractQubesAPI(object):
             self.fire_event_for_permission(**kwargs))
 
 
+class FlowControl(object):
+    '''Flow control state of a :py:class:`QubesDaemonProtocol` connection
+
+    Data which can't be written right away (because the client does not read
+    as fast as events come), waits in :py:attr:`queue`, up to :py:attr:`limit`
+    bytes; see :py:data:`qubes.config.events_overflow_policy` for what
+    happens then.
+    '''
+
+    def __init__(self):
+        #: data waiting for the client to read previous data, as
+        #: ``key: (data, droppable)``; *key* identifies events to coalesce
+        self.queue = collections.OrderedDict()
+        #: total length of data in :py:attr:`queue`
+        self.size = 0
+        self.limit = qubes.config.events_queue_limit
+        self.overflow_policy = qubes.config.events_overflow_policy
+        #: the transport buffer is full
+        self.writing_paused = False
+        #: reading is paused, as the client sent too many requests
+        self.reading_paused = False
+        #: the queue overflowed and the connection is being given up
+        self.overflowed = False
+        #: close the connection, once the queue is written
+        self.close_pending = False
+        #: number of events dropped
+        self.dropped = 0
+        #: number of events replaced by newer ones
+        self.coalesced = 0
+
+    def put(self, key, data, droppable=True):
+        '''Queue data and apply overflow policy if the queue is too long
+
+        :param key: queued events with equal keys may be coalesced
+        :param bytes data: data to queue
+        :param bool droppable: may be dropped (or coalesced) on overflow
+        :returns: :py:obj:`False` if the connection should be given up
+        '''
+        if key in self.queue:
+            if droppable and self.overflow_policy == 'coalesce':
+                self.size -= len(self.queue[key][0])
+                self.coalesced += 1
+                # the newest value goes after everything queued before it
+                self.queue.move_to_end(key)
+            else:
+                key = object()
+        self.queue[key] = (data, droppable)
+        self.size += len(data)
+
+        if self.size <= self.limit:
+            return True
+
+        if self.overflow_policy == 'disconnect':
+            return False
+
+        for old_key, (old_data, old_droppable) in list(self.queue.items()):
+            if self.size <= self.limit:
+                break
+            if not old_droppable:
+                continue
+            del self.queue[old_key]
+            self.size -= len(old_data)
+            self.dropped += 1
+        return True
+
+    def pop(self):
+        '''Take the oldest data from the queue'''
+        _, (data, _) = self.queue.popitem(last=False)
+        self.size -= len(data)
+        return data
+
+    def clear(self):
+        '''Drop all queued data'''
+        self.dropped += sum(1
+            for _, droppable in self.queue.values() if droppable)
+        self.queue.clear()
+        self.size = 0
+
+
 class QubesDaemonProtocol(asyncio.Protocol):
+    '''Protocol spoken on qubesd sockets
+
+    By default a connection carries exactly one request: source qube, method,
+    destination qube, argument and payload, separated by NUL bytes and
+    terminated by EOF. The response is written back and the connection is
+    closed.
+
+    Clients issuing many calls may instead start the connection with
+    :py:attr:`framed_preamble` and then send any number of requests, each in
+    a frame: :py:attr:`frame_header` (request id and length of the rest),
+    followed by the request encoded as above, but without EOF. Requests are
+    executed concurrently and responses are sent as soon as they are ready,
+    in frames carrying the id of the request and exactly what would be
+    written to the connection in the plain protocol. Each request ends with
+    either a response (``0x30``) or exception (``0x32``) frame, or with an
+    empty frame, which stands for closing the connection (after a stream of
+    events, or when the request was refused). An empty request frame cancels
+    the request with the same id, like closing the connection would.
+
+    When a client does not read events as fast as they come, they are queued,
+    up to :py:data:`qubes.config.events_queue_limit` bytes; see
+    :py:data:`qubes.config.events_overflow_policy` for what happens then.
+    The connection is closed only after all the queued data is written.
+    '''
+
     buffer_size = 65536
     header = struct.Struct('Bx')
+    #: first bytes of a connection in framed protocol; this is not a valid
+    #: qube name, so it can't be the start of a plain request
+    framed_preamble = b'QUBESD/2\n'
+    #: header of a frame: request id and length of the frame body
+    frame_header = struct.Struct('!II')
+    #: requests executed at once on one framed connection; more requests
+    #: wait in a queue, and reading from the connection is paused while the
+    #: queue is that long too (so a client must not have twice as many
+    #: never-ending requests, like ``admin.Events``, pending at once)
+    max_framed_requests = 64
     # keep track of connections, to gracefully close them at server exit
     # (including cleanup of integration test)
     connections = set()
@@ -215,8 +384,25 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.event_sent = False
         self.mgmt = None
 
+        #: does the client use framed protocol? (:py:obj:`None` if not known
+        #: yet)
+        self.framed = None
+        self.untrusted_frames = bytearray()
+        #: requests in progress on framed connection, by request id
+        self.framed_requests = {}
+        #: requests received on framed connection, not yet started
+        self.framed_queue = collections.OrderedDict()
+        self.framed_events_sent = set()
+        self.framed_eof = False
+
+        #: :py:class:`FlowControl` state of the connection
+        self.flow = FlowControl()
+
     def connection_made(self, transport):
         self.transport = transport
+        self.transport.set_write_buffer_limits(
+            high=qubes.config.events_write_high,
+            low=qubes.config.events_write_low)
         self.connections.add(self)
 
     def connection_lost(self, exc):
@@ -224,10 +410,19 @@ class QubesDaemonProtocol(asyncio.Protocol):
         # for cancellable operation, interrupt it, otherwise it will do nothing
         if self.mgmt is not None:
             self.mgmt.cancel()
+        for mgmt in list(self.framed_requests.values()):
+            if mgmt is not None:
+                mgmt.cancel()
+        self.flow.clear()
         self.transport = None
         self.connections.remove(self)
 
     def data_received(self, untrusted_data):  # pylint: disable=arguments-differ
+        if self.framed:
+            self.untrusted_frames += untrusted_data
+            self.framed_process()
+            return
+
         if self.len_untrusted_buffer + len(untrusted_data) > self.buffer_size:
             self.app.log.warning('request too long')
             self.transport.abort()
@@ -237,7 +432,25 @@ class QubesDaemonProtocol(asyncio.Protocol):
         self.len_untrusted_buffer += \
             self.untrusted_buffer.write(untrusted_data)
 
+        if self.framed is None:
+            untrusted_head = self.untrusted_buffer.getvalue()[
+                :len(self.framed_preamble)]
+            if untrusted_head == self.framed_preamble:
+                self.framed = True
+                self.untrusted_frames += self.untrusted_buffer.getvalue()[
+                    len(self.framed_preamble):]
+                self.untrusted_buffer.close()
+                self.framed_process()
+            elif not self.framed_preamble.startswith(untrusted_head):
+                self.framed = False
+
     def eof_received(self):
+        if self.framed:
+            # requests in progress are allowed to finish
+            self.framed_eof = True
+            self.framed_close_if_idle()
+            return True
+
         try:
             src, meth, dest, arg, untrusted_payload = \
                 self.untrusted_buffer.getvalue().split(b'\0', 4)
@@ -253,6 +466,81 @@ class QubesDaemonProtocol(asyncio.Protocol):
 
         return True
 
+    def framed_process(self):
+        '''Handle complete frames received so far'''
+        offset = 0
+        while len(self.untrusted_frames) - offset >= self.frame_header.size:
+            request_id, untrusted_length = self.frame_header.unpack_from(
+                self.untrusted_frames, offset)
+            if untrusted_length > self.buffer_size:
+                self.app.log.warning('request too long')
+                self.transport.abort()
+                return
+            end = offset + self.frame_header.size + untrusted_length
+            if len(self.untrusted_frames) < end:
+                break
+            untrusted_request = bytes(self.untrusted_frames[
+                offset + self.frame_header.size:end])
+            offset = end
+            if not self.framed_dispatch(request_id, untrusted_request):
+                return
+        del self.untrusted_frames[:offset]
+
+        self.framed_start_queued()
+
+    def framed_dispatch(self, request_id, untrusted_request):
+        '''Queue (or cancel) a request received in a frame
+
+        :returns: :py:obj:`False` if the connection was aborted
+        '''
+        if not untrusted_request:
+            if request_id in self.framed_queue:
+                del self.framed_queue[request_id]
+                self.send_frame(request_id, b'')
+            elif self.framed_requests.get(request_id) is not None:
+                self.framed_requests[request_id].cancel()
+            return True
+
+        if request_id in self.framed_requests \
+                or request_id in self.framed_queue:
+            self.app.log.warning('duplicate request id')
+            self.transport.abort()
+            return False
+
+        untrusted_fields = untrusted_request.split(b'\0', 4)
+        if len(untrusted_fields) != 5:
+            self.app.log.warning('framing error')
+            self.transport.abort()
+            return False
+
+        self.framed_queue[request_id] = untrusted_fields
+        return True
+
+    def framed_start_queued(self):
+        '''Start queued requests, as many as :py:attr:`max_framed_requests`
+        allows'''
+        while self.framed_queue \
+                and len(self.framed_requests) < self.max_framed_requests:
+            request_id, (src, meth, dest, arg, untrusted_payload) = \
+                self.framed_queue.popitem(last=False)
+            self.framed_requests[request_id] = None
+            asyncio.ensure_future(self.respond_framed(request_id,
+                src, meth, dest, arg, untrusted_payload=untrusted_payload))
+
+        paused = len(self.framed_queue) >= self.max_framed_requests
+        if paused != self.flow.reading_paused:
+            self.flow.reading_paused = paused
+            if paused:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
+    def framed_close_if_idle(self):
+        '''Close framed connection after EOF, once all requests are done'''
+        if self.transport is not None and self.framed_eof \
+                and not self.framed_requests and not self.framed_queue:
+            self.close_when_flushed()
+
     @asyncio.coroutine
     def respond(self, src, meth, dest, arg, *, untrusted_payload):
         try:
@@ -287,8 +575,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
                     err, src, meth, dest, arg, len(untrusted_payload))
             if self.transport is not None:
                 self.send_exception(err)
-                self.transport.write_eof()
-                self.transport.close()
+                self.close_when_flushed()
             return
 
         except Exception:  # pylint: disable=broad-except
@@ -300,11 +587,7 @@ class QubesDaemonProtocol(asyncio.Protocol):
         else:
             if not self.event_sent:
                 self.send_response(response)
-            try:
-                self.transport.write_eof()
-            except NotImplementedError:
-                pass
-            self.transport.close()
+            self.close_when_flushed()
             return
 
         # this is reached if from except: blocks; do not put it in finally:,
@@ -312,42 +595,225 @@ class QubesDaemonProtocol(asyncio.Protocol):
         if self.transport:
             self.transport.abort()
 
+    @asyncio.coroutine
+    def respond_framed(self, request_id, src, meth, dest, arg, *,
+            untrusted_payload):
+        '''Execute request received on framed connection
+
+        Like :py:meth:`respond`, but a failed request ends only with an empty
+        frame, the connection is kept for other requests.
+        '''
+        data = b''
+        try:
+            mgmt = self.handler(self.app, src, meth, dest, arg,
+                functools.partial(self.send_framed_event, request_id))
+            self.framed_requests[request_id] = mgmt
+            response = yield from mgmt.execute(
+                untrusted_payload=untrusted_payload)
+            if request_id in self.framed_events_sent:
+                assert not response
+            else:
+                data = self.format_response(response)
+
+        except PermissionDenied:
+            self.app.log.warning(
+                'permission denied for call %s+%s (%s → %s) '
+                'with payload of %d bytes',
+                    meth, arg, src, dest, len(untrusted_payload))
+
+        except ProtocolError:
+            self.app.log.warning(
+                'protocol error for call %s+%s (%s → %s) '
+                'with payload of %d bytes',
+                    meth, arg, src, dest, len(untrusted_payload))
+
+        except qubes.exc.QubesException as err:
+            if self.debug:
+                self.app.log.exception('%r while calling '
+                    'src=%r meth=%r dest=%r arg=%r len(untrusted_payload)=%d',
+                    err, src, meth, dest, arg, len(untrusted_payload))
+            data = self.format_exception(err)
+
+        except Exception:  # pylint: disable=broad-except
+            self.app.log.exception(
+                'unhandled exception while calling '
+                'src=%r meth=%r dest=%r arg=%r len(untrusted_payload)=%d',
+                    src, meth, dest, arg, len(untrusted_payload))
+
+        finally:
+            del self.framed_requests[request_id]
+            self.framed_events_sent.discard(request_id)
+
+        if self.transport is None:
+            return
+        self.send_frame(request_id, data)
+        self.framed_start_queued()
+        self.framed_close_if_idle()
+
+    def pause_writing(self):
+        self.flow.writing_paused = True
+
+    def resume_writing(self):
+        self.flow.writing_paused = False
+        self.flush_event_queue()
+
+    def close_when_flushed(self):
+        '''Send EOF and close the connection, once all queued data is written
+
+        Closing the transport right away would lose the data still queued for
+        a slow client: events, and the response or final frame written after
+        them.
+        '''
+        if self.flow.queue:
+            self.flow.close_pending = True
+            return
+        try:
+            self.transport.write_eof()
+        except NotImplementedError:
+            pass
+        self.transport.close()
+
+    def write(self, data):
+        '''Write data other than events, keeping order with queued events'''
+        if self.flow.overflowed:
+            return
+        if self.flow.queue:
+            self.queue_event(object(), data, droppable=False)
+        else:
+            self.transport.write(data)
+
+    def write_event(self, key, data):
+        '''Write an event, or queue it if the client does not keep up
+
+        :param key: queued events with equal keys may be coalesced
+        :param bytes data: the event, as sent over the connection
+        '''
+        if self.flow.overflowed:
+            return
+        if self.flow.writing_paused or self.flow.queue:
+            self.queue_event(key, data)
+        else:
+            self.transport.write(data)
+
+    def queue_event(self, key, data, droppable=True):
+        '''Queue data to be written when the client reads what was sent
+        already, and apply overflow policy if the queue is too long'''
+        if not self.flow.put(key, data, droppable):
+            self.disconnect_overflowed()
+
+    def flush_event_queue(self):
+        '''Write queued events, until the transport buffer fills again; close
+        the connection if that was requested and everything got written'''
+        while self.flow.queue and not self.flow.writing_paused \
+                and self.transport is not None:
+            self.transport.write(self.flow.pop())
+        if self.flow.close_pending and not self.flow.queue \
+                and self.transport is not None:
+            self.flow.close_pending = False
+            self.close_when_flushed()
+
+    def disconnect_overflowed(self):
+        '''Give up on a client which does not read events'''
+        self.app.log.warning('event queue overflow, closing connection')
+        self.flow.overflowed = True
+        self.flow.clear()
+
+        terminal_event = self.format_event(self.app, 'connection-overflow')
+        if self.framed:
+            for request_id in sorted(self.framed_events_sent):
+                self.send_frame(request_id, terminal_event)
+        else:
+            self.transport.write(terminal_event)
+
+        if self.mgmt is not None:
+            self.mgmt.cancel()
+        for mgmt in list(self.framed_requests.values()):
+            if mgmt is not None:
+                mgmt.cancel()
+        # what was already written is still sent, if the client ever reads it
+        self.transport.close()
+
+    def get_stats(self):
+        '''Statistics of this connection, for monitoring'''
+        if self.framed:
+            methods = sorted(mgmt.method
+                for mgmt in self.framed_requests.values() if mgmt is not None)
+        else:
+            methods = [self.mgmt.method] if self.mgmt is not None else []
+        return {
+            'methods': methods,
+            'framed': bool(self.framed),
+            'buffered': (self.transport.get_write_buffer_size()
+                if self.transport is not None else 0),
+            'queued': self.flow.size,
+            'queued_events': len(self.flow.queue),
+            'paused': self.flow.writing_paused,
+            'dropped': self.flow.dropped,
+            'coalesced': self.flow.coalesced,
+        }
+
     def send_header(self, *args):
-        self.transport.write(self.header.pack(*args))
+        self.write(self.header.pack(*args))
+
+    def send_frame(self, request_id, data):
+        self.write(self.frame_header.pack(request_id, len(data)) + data)
+
+    def format_response(self, content):
+        data = self.header.pack(0x30)
+        if content is not None:
+            data += content.encode('utf-8')
+        return data
 
     def send_response(self, content):
         assert not self.event_sent
-        self.send_header(0x30)
-        if content is not None:
-            self.transport.write(content.encode('utf-8'))
+        self.write(self.format_response(content))
 
-    def send_event(self, subject, event, **kwargs):
-        if self.transport is None:
-            return
-        self.event_sent = True
-        self.send_header(0x31)
+    def format_event(self, subject, event, **kwargs):
+        data = [self.header.pack(0x31)]
 
         if subject is not self.app:
-            self.transport.write(str(subject).encode('ascii'))
-        self.transport.write(b'\0')
+            data.append(str(subject).encode('ascii'))
+        data.append(b'\0')
 
-        self.transport.write(event.encode('ascii') + b'\0')
+        data.append(event.encode('ascii') + b'\0')
 
         for k, v in kwargs.items():
-            self.transport.write('{}\0{}\0'.format(k, str(v)).encode('ascii'))
-        self.transport.write(b'\0')
+            data.append('{}\0{}\0'.format(k, str(v)).encode('ascii'))
+        data.append(b'\0')
 
-    def send_exception(self, exc):
-        self.send_header(0x32)
+        return b''.join(data)
 
-        self.transport.write(type(exc).__name__.encode() + b'\0')
+    def send_event(self, subject, event, **kwargs):
+        if self.transport is None:
+            return
+        self.event_sent = True
+        self.write_event((None, str(subject), event),
+            self.format_event(subject, event, **kwargs))
+
+    def send_framed_event(self, request_id, subject, event, **kwargs):
+        if self.transport is None or request_id not in self.framed_requests:
+            return
+        self.framed_events_sent.add(request_id)
+        data = self.format_event(subject, event, **kwargs)
+        self.write_event((request_id, str(subject), event),
+            self.frame_header.pack(request_id, len(data)) + data)
+
+    def format_exception(self, exc):
+        data = [self.header.pack(0x32)]
+
+        data.append(type(exc).__name__.encode() + b'\0')
 
         if self.debug:
-            self.transport.write(''.join(traceback.format_exception(
+            data.append(''.join(traceback.format_exception(
                 type(exc), exc, exc.__traceback__)).encode('utf-8'))
-        self.transport.write(b'\0')
+        data.append(b'\0')
 
-        self.transport.write(str(exc).encode('utf-8') + b'\0')
+        data.append(str(exc).encode('utf-8') + b'\0')
+
+        return b''.join(data)
+
+    def send_exception(self, exc):
+        self.write(self.format_exception(exc))
 
 
 def cleanup_socket(sockpath, force):
@@ -22,9 +22,12 @@ Qubes OS Management API
 '''
 
 import asyncio
+import collections
+import fnmatch
 import functools
 import itertools
 import os
+import re
 import string
 import subprocess
 
@@ -33,46 +36,135 @@ import pkg_resources
 import yaml
 
 import qubes.api
+import qubes.api.internal
 import qubes.backup
+import qubes.bulk
 import qubes.config
 import qubes.devices
 import qubes.firewall
+import qubes.stats
 import qubes.storage
 import qubes.utils
 import qubes.vm
 import qubes.vm.adminvm
 import qubes.vm.qubesvm
+import qubespolicy
 
 
 class QubesMgmtEventsDispatcher(object):
-    def __init__(self, filters, send_event):
+    '''Forward events to an ``admin.Events`` client
+
+    :param list filters: filters returned by ``admin-permission:`` event
+    :param send_event: callback sending event to the client
+    :param list event_patterns: if given, send only events with names \
+        matching any of those :py:mod:`fnmatch` patterns
+    :param set vm_names: if given, send only events of those domains (and \
+        global ones)
+    :param float coalesce_delay: if given, delay ``property-set:*`` events \
+        by that many seconds, and send only one per domain and property in \
+        that time
+    '''
+    #: events which are never sent to the client
+    internal_event_prefixes = (
+        'admin-permission:',
+        'device-get:',
+        'device-list:',
+        'device-list-attached:',
+    )
+
+    def __init__(self, filters, send_event, event_patterns=None,
+            vm_names=None, coalesce_delay=None):
         self.filters = filters
         self.send_event = send_event
 
+        #: regular expression matching selected event names
+        self.event_re = re.compile('|'.join(
+                fnmatch.translate(pattern) for pattern in event_patterns)) \
+            if event_patterns else None
+        self.vm_names = vm_names
+
+        self.coalesce_delay = coalesce_delay
+        #: ``property-set:`` events waiting to be sent, by (subject, event)
+        self.pending = collections.OrderedDict()
+        self.pending_handle = None
+
     def vm_handler(self, subject, event, **kwargs):
         # do not send internal events
-        if event.startswith('admin-permission:'):
-            return
-        if event.startswith('device-get:'):
-            return
-        if event.startswith('device-list:'):
-            return
-        if event.startswith('device-list-attached:'):
+        if event.startswith(self.internal_event_prefixes):
             return
         if event in ('domain-is-fully-usable',):
             return
 
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
+        if self.vm_names is not None and subject.name not in self.vm_names:
             return
-        self.send_event(subject, event, **kwargs)
+
+        self.dispatch(subject, event, kwargs)
 
     def app_handler(self, subject, event, **kwargs):
-        if not list(qubes.api.apply_filters([(subject, event, kwargs)],
-                self.filters)):
+        self.dispatch(subject, event, kwargs)
+
+    def dispatch(self, subject, event, kwargs):
+        '''Send the event, if selected and allowed'''
+        if self.event_re is not None and not self.event_re.match(event):
+            return
+
+        if self.filters and not list(qubes.api.apply_filters(
+                [(subject, event, kwargs)], self.filters)):
             return
+
+        if self.coalesce_delay is not None:
+            if event.startswith('property-set:'):
+                self.coalesce(subject, event, kwargs)
+                return
+            if event.startswith('property-del:'):
+                # keep the order of changes of the same property
+                self.flush((subject, 'property-set:' + event[13:]))
+
         self.send_event(subject, event, **kwargs)
 
+    def coalesce(self, subject, event, kwargs):
+        '''Queue ``property-set:`` event, merging it with a queued one'''
+        key = (subject, event)
+        try:
+            pending = self.pending[key]
+        except KeyError:
+            self.pending[key] = kwargs
+        else:
+            # report change from the first old value to the last new value
+            kwargs = kwargs.copy()
+            kwargs.pop('oldvalue', None)
+            if 'oldvalue' in pending:
+                kwargs['oldvalue'] = pending['oldvalue']
+            self.pending[key] = kwargs
+
+        if self.pending_handle is None:
+            self.pending_handle = asyncio.get_event_loop().call_later(
+                self.coalesce_delay, self.flush)
+
+    def flush(self, key=None):
+        '''Send queued ``property-set:`` events
+
+        :param tuple key: if given, send only event of this \
+            (subject, event) pair
+        '''
+        if key is not None:
+            kwargs = self.pending.pop(key, None)
+            if kwargs is not None:
+                self.send_event(*key, **kwargs)
+            return
+
+        self.pending_handle = None
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for (subject, event), kwargs in pending.items():
+            self.send_event(subject, event, **kwargs)
+
+    def close(self):
+        '''Drop queued events'''
+        if self.pending_handle is not None:
+            self.pending_handle.cancel()
+            self.pending_handle = None
+        self.pending.clear()
+
     def on_domain_add(self, subject, event, vm):
         # pylint: disable=unused-argument
         vm.add_handler('*', self.vm_handler)
@@ -82,6 +174,163 @@ class QubesMgmtEventsDispatcher(object):
         vm.remove_handler('*', self.vm_handler)
 
 
+class VMStatsSampler(object):
+    '''Sample VM statistics once for all ``admin.vm.Stats`` clients
+
+    Statistics of all domains are retrieved once every
+    :py:attr:`qubes.Qubes.stats_interval` seconds and passed to each
+    subscriber. Domain IDs are mapped to names using ``domain-spawn`` and
+    ``domain-shutdown`` events instead of asking libvirt; unknown IDs (like
+    stubdomains) are skipped.
+
+    The sampler runs only while it has subscribers, or all the time when
+    history is enabled (see :py:meth:`enable_history`).
+
+    If getting the statistics fails, the error is passed to current
+    subscribers (which then give up, like when not sharing the sampler).
+    With history enabled, the sample is skipped and sampling is retried, with
+    delay growing up to :py:attr:`max_retry_delay`.
+
+    :param qubes.Qubes app: the application object
+    '''
+
+    #: maximum delay (in seconds) between attempts to get statistics, while
+    #: they keep failing
+    max_retry_delay = 60
+
+    def __init__(self, app):
+        self.app = app
+        #: queues of subscribers, see :py:meth:`subscribe`
+        self.subscribers = set()
+        #: domain ID -> domain name
+        self.id_to_name_map = {}
+        self.info_time = None
+        self.info = None
+        self.task = None
+        #: :py:class:`qubes.stats.StatsHistory`, if enabled
+        self.history = None
+
+    def enable_history(self, tiers=None):
+        '''Keep sampling without subscribers and record history of samples
+
+        :param tiers: see :py:class:`qubes.stats.StatsHistory`
+        '''
+        self.history = qubes.stats.StatsHistory(tiers)
+        if self.task is None:
+            self.start()
+
+    def subscribe(self):
+        '''Register a new subscriber, starting the sampler if needed
+
+        :return: :py:class:`asyncio.Queue` receiving tuples \
+            ``(stats, exception)``, where *stats* maps domain name to \
+            its statistics. Only the newest sample is kept in the queue.
+        '''
+        queue = asyncio.Queue(maxsize=1)
+        self.subscribers.add(queue)
+        if self.task is None:
+            self.start()
+        elif self.info is not None:
+            queue.put_nowait((self.named_info(), None))
+        return queue
+
+    def unsubscribe(self, queue):
+        '''Remove a subscriber, stopping the sampler if it was the last one'''
+        self.subscribers.discard(queue)
+        if not self.subscribers and self.history is None:
+            self.stop()
+
+    def start(self):
+        self.id_to_name_map.clear()
+        for vm in self.app.domains:
+            self._add_vm_handlers(vm)
+            if vm.is_running():
+                self.id_to_name_map[vm.xid] = vm.name
+        self.app.add_handler('domain-add', self.on_domain_add)
+        self.app.add_handler('domain-delete', self.on_domain_delete)
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        self.task = None
+        self.app.remove_handler('domain-add', self.on_domain_add)
+        self.app.remove_handler('domain-delete', self.on_domain_delete)
+        for vm in self.app.domains:
+            self._remove_vm_handlers(vm)
+        self.info_time = None
+        self.info = None
+
+    @asyncio.coroutine
+    def run(self):
+        failures = 0
+        while self.subscribers or self.history is not None:
+            try:
+                self.info_time, self.info = self.app.host.get_vm_stats(
+                    self.info_time, self.info)
+            except Exception as exc:  # pylint: disable=broad-except
+                self.publish(None, exc)
+                self.subscribers.clear()
+                if self.history is None:
+                    self.stop()
+                    return
+                failures += 1
+                delay = min(self.app.stats_interval * 2 ** failures,
+                    self.max_retry_delay)
+                self.app.log.warning(
+                    'Failed to get VM stats (%d time(s) in a row), '
+                    'retrying in %s s: %s', failures, delay, exc)
+                yield from asyncio.sleep(delay)
+                continue
+            failures = 0
+            named_info = self.named_info()
+            if self.history is not None:
+                self.history.add(self.info_time, named_info)
+            self.publish(named_info, None)
+            yield from asyncio.sleep(self.app.stats_interval)
+
+    def named_info(self):
+        '''Last sample, with domain IDs replaced by names'''
+        return {self.id_to_name_map[vm_id]: vm_info
+            for vm_id, vm_info in self.info.items()
+            if vm_id in self.id_to_name_map}
+
+    def publish(self, stats, exc):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((stats, exc))
+
+    def _add_vm_handlers(self, vm):
+        vm.add_handler('domain-spawn', self.on_domain_spawn)
+        vm.add_handler('domain-shutdown', self.on_domain_shutdown)
+
+    def _remove_vm_handlers(self, vm):
+        vm.remove_handler('domain-spawn', self.on_domain_spawn)
+        vm.remove_handler('domain-shutdown', self.on_domain_shutdown)
+
+    def on_domain_add(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self._add_vm_handlers(vm)
+
+    def on_domain_delete(self, subject, event, vm):
+        # pylint: disable=unused-argument
+        self._remove_vm_handlers(vm)
+        if self.history is not None:
+            self.history.remove(vm.name)
+
+    def on_domain_spawn(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        self.id_to_name_map[vm.xid] = vm.name
+
+    def on_domain_shutdown(self, vm, event, **kwargs):
+        # pylint: disable=unused-argument
+        for vm_id, name in list(self.id_to_name_map.items()):
+            if name == vm.name:
+                del self.id_to_name_map[vm_id]
+
+
 class QubesAdminAPI(qubes.api.AbstractQubesAPI):
     '''Implementation of Qubes Management API calls
 
@@ -93,6 +342,9 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
     SOCKNAME = '/var/run/qubesd.sock'
 
+    #: maximum delay of coalesced events in ``admin.EventsFiltered``
+    max_events_coalesce_delay = 10
+
     @qubes.api.method('admin.vmclass.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -107,6 +359,18 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         return ''.join('{}\n'.format(ep.name)
             for ep in entrypoints)
 
+    @qubes.api.method('admin.method.List', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def method_list(self):
+        '''List calls available in this API'''
+        assert not self.arg
+        assert self.dest.name == 'dom0'
+
+        names = self.fire_event_for_filter(self.list_method_names())
+
+        return ''.join('{}\n'.format(name) for name in names)
+
     @qubes.api.method('admin.vm.List', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
@@ -125,6 +389,35 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
                 vm.get_power_state())
             for vm in sorted(domains))
 
+    @qubes.api.method('admin.vm.ListWithProperties', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def vm_list_with_properties(self):
+        '''List all the domains, with values of all their properties
+
+        Each domain line (as in ``admin.vm.List``) is followed by lines with
+        its properties (as in ``admin.vm.property.GetAll``), each starting
+        with a tab. The ``admin-permission:`` event is fired once to filter
+        domains, and then once per domain (with *vm* argument) to filter its
+        properties.
+        '''
+        assert not self.arg
+
+        if self.dest.name == 'dom0':
+            domains = self.fire_event_for_filter(self.app.domains)
+        else:
+            domains = self.fire_event_for_filter([self.dest])
+
+        lines = []
+        for vm in sorted(domains):
+            lines.append('{} class={} state={}\n'.format(
+                vm.name,
+                vm.__class__.__name__,
+                vm.get_power_state()))
+            lines.extend('\t' + line
+                for line in self._property_get_all_lines(vm, vm=vm))
+        return ''.join(lines)
+
     @qubes.api.method('admin.vm.property.List', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -168,7 +461,12 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.fire_event_for_permission()
 
-        property_def = dest.property_get_def(self.arg)
+        return self._serialize_property(dest, self.arg)
+
+    @staticmethod
+    def _serialize_property(dest, prop_name):
+        '''Format value of a property as returned by ``admin.property.Get``'''
+        property_def = dest.property_get_def(prop_name)
         # explicit list to be sure that it matches protocol spec
         if isinstance(property_def, qubes.vm.VMProperty):
             property_type = 'vm'
@@ -176,21 +474,52 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             property_type = 'int'
         elif property_def.type is bool:
             property_type = 'bool'
-        elif self.arg == 'label':
+        elif prop_name == 'label':
             property_type = 'label'
         else:
             property_type = 'str'
 
         try:
-            value = getattr(dest, self.arg)
+            value = getattr(dest, prop_name)
         except AttributeError:
             return 'default=True type={} '.format(property_type)
         else:
             return 'default={} type={} {}'.format(
-                str(dest.property_is_default(self.arg)),
+                str(dest.property_is_default(prop_name)),
                 property_type,
                 str(value) if value is not None else '')
 
+    @qubes.api.method('admin.vm.property.GetAll', no_payload=True,
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_property_get_all(self):
+        '''Get values of all properties of a qube'''
+        return ''.join(self._property_get_all_lines(self.dest))
+
+    @qubes.api.method('admin.property.GetAll', no_payload=True,
+        scope='global', read=True)
+    @asyncio.coroutine
+    def property_get_all(self):
+        '''Get values of all global properties'''
+        assert self.dest.name == 'dom0'
+        return ''.join(self._property_get_all_lines(self.app))
+
+    def _property_get_all_lines(self, dest, **kwargs):
+        '''Lines with name and value (as in ``admin.property.Get``) of each
+        property of *dest*, with backslashes and newlines in values escaped.
+
+        *kwargs* are passed to the ``admin-permission:`` event.
+        '''
+        assert not self.arg
+
+        properties = self.fire_event_for_filter(dest.property_list(),
+            **kwargs)
+
+        return ['{} {}\n'.format(prop.__name__,
+                self._serialize_property(dest, prop.__name__)
+                    .replace('\\', '\\\\').replace('\n', '\\n'))
+            for prop in properties]
+
     @qubes.api.method('admin.vm.property.GetDefault', no_payload=True,
         scope='local', read=True)
     @asyncio.coroutine
@@ -807,20 +1136,217 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
         self.fire_event_for_permission()
         yield from self.dest.kill()
 
+    @qubes.api.method('admin.vm.StartMany',
+        scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_start_many(self, untrusted_payload):
+        '''Start many domains, in parallel where possible
+
+        Payload consists of names of domains to start, one per line. Network
+        VMs are started before their clients, domains not depending on each
+        other are started concurrently (see
+        :py:class:`qubes.bulk.StartScheduler`). Progress of each domain is
+        reported with ``start-many-*`` events, the call ends with
+        ``start-many-finished`` event.
+
+        Starting each of the domains (including network VMs not listed) has
+        to be allowed like for ``admin.vm.Start``, otherwise nothing is
+        started.
+        '''
+        assert self.dest.name == 'dom0'
+        assert not self.arg
+
+        vms = self._parse_vm_list(untrusted_payload)
+        del untrusted_payload
+
+        self.fire_event_for_permission(vms=vms)
+
+        scheduler = qubes.bulk.StartScheduler(self.app, vms,
+            notify=self.send_event)
+        # including network VMs not listed in the payload
+        self._check_permission_for_each(scheduler.order, 'admin.vm.Start')
+
+        results = yield from scheduler.run()
+        failed = sum(1 for exc in results.values() if exc is not None)
+        self.send_event(self.app, 'start-many-finished',
+            started=len(results) - failed, failed=failed)
+
+    @qubes.api.method('admin.vm.ShutdownMany',
+        scope='global', execute=True)
+    @asyncio.coroutine
+    def vm_shutdown_many(self, untrusted_payload):
+        '''Shut down many domains, in parallel where possible
+
+        Payload consists of names of domains to shut down, one per line.
+        Domains connected to listed network VMs are shut down too, before
+        them; domains not depending on each other are shut down
+        concurrently, domains not halted in time are killed (see
+        :py:class:`qubes.bulk.ShutdownScheduler`). Progress of each domain is
+        reported with ``shutdown-many-*`` events, the call ends with
+        ``shutdown-many-finished`` event.
+
+        Shutting down and killing each of the domains (including connected
+        ones not listed) has to be allowed like for ``admin.vm.Shutdown`` and
+        ``admin.vm.Kill``, otherwise nothing is shut down.
+        '''
+        assert self.dest.name == 'dom0'
+        assert not self.arg
+
+        vms = self._parse_vm_list(untrusted_payload)
+        del untrusted_payload
+
+        self.fire_event_for_permission(vms=vms)
+
+        scheduler = qubes.bulk.ShutdownScheduler(self.app, vms,
+            notify=self.send_event)
+        # including domains connected to network VMs from the payload,
+        # which may need to be killed
+        self._check_permission_for_each(scheduler.order,
+            'admin.vm.Shutdown', 'admin.vm.Kill')
+
+        results = yield from scheduler.run()
+        failed = sum(1 for exc in results.values() if exc is not None)
+        self.send_event(self.app, 'shutdown-many-finished',
+            halted=len(results) - failed, failed=failed)
+
+    def _check_permission_for_each(self, vms, *methods):
+        '''Check permission to call each of *methods* on each of *vms*
+
+        The checks are the same as for a call of *methods* with the domain as
+        destination: qrexec policy of the method has to allow it (for calls
+        from other domains than dom0, policy asking the user is not enough)
+        and then ``admin-permission:`` event of the method is fired with the
+        domain as *dest*. Any failed check denies the whole call, before
+        anything is done.
+
+        :param vms: domains to check
+        :param str methods: names of methods for a single domain
+        :raises qubes.api.PermissionDenied: when any check fails
+        '''
+        if self.src.qid != 0:
+            system_info = qubes.api.internal.get_system_info(self.app)
+            for method in methods:
+                try:
+                    policy = qubespolicy.Policy(method)
+                    for vm in vms:
+                        action = policy.evaluate(system_info, self.src.name,
+                            vm.name)
+                        if action.action != qubespolicy.Action.allow:
+                            raise qubespolicy.AccessDenied(
+                                '{} for {} requires confirmation'.format(
+                                    method, vm.name))
+                except qubespolicy.AccessDenied as e:
+                    raise qubes.api.PermissionDenied(str(e))
+
+        for method in methods:
+            for vm in vms:
+                self.src.fire_event('admin-permission:' + method,
+                    pre_event=True, dest=vm, arg='')
+
+    def _parse_vm_list(self, untrusted_payload):
+        '''Get domains named in payload, one per line'''
+        vms = []
+        for untrusted_vm_name in untrusted_payload.decode('ascii',
+                errors='strict').splitlines():
+            allowed_chars = string.ascii_letters + string.digits + '-_.'
+            if not untrusted_vm_name or any(
+                    c not in allowed_chars for c in untrusted_vm_name):
+                raise qubes.api.ProtocolError('Invalid chars in VM name')
+            try:
+                vm = self.app.domains[untrusted_vm_name]
+            except KeyError:
+                raise qubes.exc.QubesVMNotFoundError(untrusted_vm_name)
+            if vm not in vms:
+                vms.append(vm)
+        return vms
+
     @qubes.api.method('admin.Events', no_payload=True,
         scope='global', read=True)
     @asyncio.coroutine
     def events(self):
         assert not self.arg
 
-        # run until client connection is terminated
-        self.cancellable = True
-        wait_for_cancel = asyncio.get_event_loop().create_future()
-
         # cache event filters, to not call an event each time an event arrives
         event_filters = self.fire_event_for_permission()
 
         dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event)
+        yield from self._send_events(dispatcher)
+
+    @qubes.api.method('admin.EventsFiltered',
+        scope='global', read=True)
+    @asyncio.coroutine
+    def events_filtered(self, untrusted_payload):
+        '''Like ``admin.Events``, but send only selected events
+
+        Payload consists of lines, each of them optional and (except
+        ``coalesce``) possibly repeated:
+
+        - ``event=PATTERN`` - send only events matching any of given
+          (:py:mod:`fnmatch`-style) patterns
+        - ``vm=NAME`` - send only events of any of given domains (and
+          global ones)
+        - ``coalesce=SECONDS`` - delay ``property-set:*`` events and send
+          only one per domain and property in that time
+        '''
+        assert not self.arg
+
+        event_patterns = []
+        vm_names = set()
+        coalesce_delay = None
+        for untrusted_line in untrusted_payload.decode('ascii',
+                errors='strict').splitlines():
+            try:
+                untrusted_key, untrusted_value = untrusted_line.split('=', 1)
+            except ValueError:
+                raise qubes.api.ProtocolError('Invalid subscription format')
+
+            if untrusted_key == 'event':
+                allowed_chars = string.ascii_letters + string.digits + \
+                    '-_.:*?'
+                if not untrusted_value or any(
+                        c not in allowed_chars for c in untrusted_value):
+                    raise qubes.api.ProtocolError(
+                        'Invalid chars in event pattern')
+                event_patterns.append(untrusted_value)
+
+            elif untrusted_key == 'vm':
+                allowed_chars = string.ascii_letters + string.digits + '-_.'
+                if not untrusted_value or any(
+                        c not in allowed_chars for c in untrusted_value):
+                    raise qubes.api.ProtocolError('Invalid chars in VM name')
+                vm_names.add(untrusted_value)
+
+            elif untrusted_key == 'coalesce' and coalesce_delay is None:
+                allowed_chars = string.digits + '.'
+                if not 0 < len(untrusted_value) <= 8 or any(
+                        c not in allowed_chars for c in untrusted_value) \
+                        or untrusted_value.count('.') > 1:
+                    raise qubes.api.ProtocolError('Invalid coalesce delay')
+                coalesce_delay = float(untrusted_value)
+                if not 0 < coalesce_delay <= self.max_events_coalesce_delay:
+                    raise qubes.api.ProtocolError('Invalid coalesce delay')
+
+            else:
+                raise qubes.api.ProtocolError('Invalid subscription option')
+        del untrusted_payload
+
+        # cache event filters, to not call an event each time an event arrives
+        event_filters = self.fire_event_for_permission(
+            event_patterns=tuple(event_patterns),
+            vm_names=tuple(sorted(vm_names)))
+
+        dispatcher = QubesMgmtEventsDispatcher(event_filters, self.send_event,
+            event_patterns=event_patterns, vm_names=vm_names or None,
+            coalesce_delay=coalesce_delay)
+        yield from self._send_events(dispatcher)
+
+    @asyncio.coroutine
+    def _send_events(self, dispatcher):
+        '''Pass events to the dispatcher, until the call is cancelled'''
+        # run until client connection is terminated
+        self.cancellable = True
+        wait_for_cancel = asyncio.get_event_loop().create_future()
+
         if self.dest.name == 'dom0':
             self.app.add_handler('*', dispatcher.app_handler)
             self.app.add_handler('domain-add', dispatcher.on_domain_add)
@@ -848,6 +1374,7 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
                 vm.remove_handler('*', dispatcher.vm_handler)
         else:
             self.dest.remove_handler('*', dispatcher.vm_handler)
+        dispatcher.close()
 
     @qubes.api.method('admin.vm.feature.List', no_payload=True,
         scope='local', read=True)
@@ -1413,49 +1940,44 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
             skip_passphrase=True)
         return backup.get_backup_summary()
 
-    def _send_stats_single(self, info_time, info, only_vm, filters,
-            id_to_name_map):
-        '''A single iteration of sending VM stats
-
-        :param info_time: time of previous iteration
-        :param info: information retrieved in previous iteration
-        :param only_vm: send information only about this VM
-        :param filters: filters to apply on stats before sending
-        :param id_to_name_map: ID->VM name map, may be modified
-        :return: tuple(info_time, info) - new information (to be passed to
-        the next iteration)
-        '''
-
-        (info_time, info) = self.app.host.get_vm_stats(info_time, info,
-            only_vm=only_vm)
-        for vm_id, vm_info in info.items():
-            if vm_id not in id_to_name_map:
-                try:
-                    name = \
-                        self.app.vmm.libvirt_conn.lookupByID(vm_id).name()
-                except libvirt.libvirtError as err:
-                    if err.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
-                        # stubdomain or so
-                        name = None
-                    else:
-                        raise
-                id_to_name_map[vm_id] = name
-            else:
-                name = id_to_name_map[vm_id]
+    @qubes.api.method('admin.vm.StatsHistory',
+        scope='local', read=True)
+    @asyncio.coroutine
+    def vm_stats_history(self, untrusted_payload):
+        '''Get history of VM stats, as CSV with time, average CPU usage and
+        memory
 
-            # skip VMs with unknown name
-            if name is None:
-                continue
+        Argument is the resolution of history in seconds, see
+        :py:data:`qubes.config.stats_history_tiers`. Payload optionally
+        limits time range: ``start end`` as unix timestamps.
+        '''
+        sampler = getattr(self.app, 'vm_stats_sampler', None)
+        if sampler is None or sampler.history is None:
+            raise qubes.exc.QubesException('VM stats history not enabled')
 
-            if not list(qubes.api.apply_filters([name], filters)):
-                continue
+        try:
+            resolution = int(self.arg)
+        except ValueError:
+            raise qubes.api.ProtocolError('Invalid resolution')
+        if resolution not in sampler.history.resolutions:
+            raise qubes.exc.QubesValueError('Unsupported resolution')
+
+        start = end = None
+        if untrusted_payload:
+            try:
+                untrusted_start, untrusted_end = map(int,
+                    untrusted_payload.decode('ascii').split())
+            except (UnicodeDecodeError, ValueError):
+                raise qubes.api.ProtocolError('Invalid time range')
+            start, end = untrusted_start, untrusted_end
+            del untrusted_start, untrusted_end
+        del untrusted_payload
 
-            self.send_event(name, 'vm-stats',
-                memory_kb=int(vm_info['memory_kb']),
-                cpu_time=int(vm_info['cpu_time'] / 1000000),
-                cpu_usage=int(vm_info['cpu_usage']))
+        self.fire_event_for_permission(resolution=resolution,
+            start=start, end=end)
 
-        return info_time, info
+        return sampler.history.format_csv(self.dest.name, resolution,
+            start, end)
 
     @qubes.api.method('admin.vm.Stats', no_payload=True,
         scope='global', read=True)
@@ -1475,14 +1997,29 @@ class QubesAdminAPI(qubes.api.AbstractQubesAPI):
 
         self.send_event(self.app, 'connection-established')
 
-        info_time = None
-        info = None
-        id_to_name_map = {0: 'dom0'}
+        if not hasattr(self.app, 'vm_stats_sampler'):
+            self.app.vm_stats_sampler = VMStatsSampler(self.app)
+        sampler = self.app.vm_stats_sampler
+        queue = sampler.subscribe()
         try:
             while True:
-                info_time, info = self._send_stats_single(info_time, info,
-                    only_vm, stats_filters, id_to_name_map)
-                yield from asyncio.sleep(self.app.stats_interval)
+                stats, exc = yield from queue.get()
+                if exc is not None:
+                    raise exc
+                if only_vm is not None and only_vm.name not in stats:
+                    raise qubes.exc.QubesVMNotRunningError(only_vm)
+                for name, vm_info in stats.items():
+                    if only_vm is not None and name != only_vm.name:
+                        continue
+                    if not list(qubes.api.apply_filters([name],
+                            stats_filters)):
+                        continue
+                    self.send_event(name, 'vm-stats',
+                        memory_kb=int(vm_info['memory_kb']),
+                        cpu_time=int(vm_info['cpu_time'] / 1000000),
+                        cpu_usage=int(vm_info['cpu_usage']))
         except asyncio.CancelledError:
             # valid method to terminate this loop
             pass
+        finally:
+            sampler.unsubscribe(queue)
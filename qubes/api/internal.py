@@ -30,6 +30,26 @@ import qubes.vm.adminvm
 import qubes.vm.dispvm
 
 
+def get_system_info(app):
+    '''Information about domains needed to evaluate qrexec policy, as
+    expected by :py:meth:`qubespolicy.Policy.evaluate`
+
+    :param qubes.Qubes app: Qubes application object
+    :rtype: dict
+    '''
+    return {'domains': {
+        domain.name: {
+            'tags': list(domain.tags),
+            'type': domain.__class__.__name__,
+            'template_for_dispvms':
+                getattr(domain, 'template_for_dispvms', False),
+            'default_dispvm': (str(domain.default_dispvm) if
+                getattr(domain, 'default_dispvm', None) else None),
+            'icon': str(domain.label.icon),
+        } for domain in app.domains
+    }}
+
+
 class QubesInternalAPI(qubes.api.AbstractQubesAPI):
     ''' Communication interface for dom0 components,
     by design the input here is trusted.'''
@@ -42,19 +62,41 @@ class QubesInternalAPI(qubes.api.AbstractQubesAPI):
         assert self.dest.name == 'dom0'
         assert not self.arg
 
-        system_info = {'domains': {
-            domain.name: {
-                'tags': list(domain.tags),
-                'type': domain.__class__.__name__,
-                'template_for_dispvms':
-                    getattr(domain, 'template_for_dispvms', False),
-                'default_dispvm': (str(domain.default_dispvm) if
-                    getattr(domain, 'default_dispvm', None) else None),
-                'icon': str(domain.label.icon),
-            } for domain in self.app.domains
-        }}
-
-        return json.dumps(system_info)
+        return json.dumps(get_system_info(self.app))
+
+    @qubes.api.method('internal.GetSaveStats', no_payload=True)
+    @asyncio.coroutine
+    def get_save_stats(self):
+        '''Report counters of background qubes.xml saving
+
+        Returns JSON with number of save requests, actual writes, requests
+        coalesced into a write triggered by another one, failed writes and
+        whether there are unsaved changes. Empty object if qubes.xml is saved
+        synchronously.
+        '''
+        assert self.dest.name == 'dom0'
+        assert not self.arg
+
+        if self.app.delayed_save is None:
+            return json.dumps({})
+        return json.dumps(self.app.delayed_save.get_stats(), sort_keys=True)
+
+    @qubes.api.method('internal.GetConnectionStats', no_payload=True)
+    @asyncio.coroutine
+    def get_connection_stats(self):
+        '''Report state of qubesd client connections
+
+        Returns JSON list with, for each connection, the methods being
+        served, bytes buffered in the transport and queued for writing,
+        whether writing is paused, and counters of events dropped or
+        coalesced because the client did not read them in time.
+        '''
+        assert self.dest.name == 'dom0'
+        assert not self.arg
+
+        return json.dumps([conn.get_stats()
+            for conn in qubes.api.QubesDaemonProtocol.connections],
+            sort_keys=True)
 
     @qubes.api.method('internal.vm.volume.ImportEnd')
     @asyncio.coroutine
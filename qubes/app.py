@@ -20,16 +20,21 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import collections
+import concurrent.futures
 import errno
 import functools
 import grp
+import hashlib
+import json
 import logging
 import os
 import random
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import uuid
@@ -59,6 +64,7 @@ else:
 
 # pylint: disable=wrong-import-position
 import qubes
+import qubes.devices
 import qubes.ext
 import qubes.utils
 import qubes.storage
@@ -98,19 +104,114 @@ class VirDomainWrapper(object):
                 raise
         return wrapper
 
+    def undefine(self, *args):
+        '''Undefine the domain, like :py:meth:`libvirt.virDomain.undefine`,
+        and drop its lock used by :py:meth:`call_async`'''
+        ret = self.__getattr__('undefine')(*args)
+        self._connection.forget_domain_lock(self._vm.UUID())
+        return ret
+
+    @asyncio.coroutine
+    def call_async(self, attrname, *args, **kwargs):
+        '''Call method of the domain in a thread, without blocking the
+        event loop.
+
+        Calls made this way for the same domain are executed one at a time,
+        in order.
+
+        :param str attrname: name of :py:class:`libvirt.virDomain` method
+        '''
+        # pylint: disable=protected-access
+        with (yield from self._connection._domain_lock(self._vm.UUID())):
+            return (yield from self._connection.run_in_executor(
+                getattr(self, attrname), *args, **kwargs))
+
 
 class VirConnectWrapper(object):
     # pylint: disable=too-few-public-methods
 
-    def __init__(self, uri):
+    def __init__(self, uri, executor=None):
         self._conn = libvirt.open(uri)
+        #: thread pool for :py:meth:`call_async`
+        self._executor = executor
+        self._reconnect_lock = threading.Lock()
+        self._domain_locks = collections.defaultdict(asyncio.Lock)
+        #: callbacks registered with :py:meth:`domainEventRegisterAny`, as
+        #: ``callback_id: [libvirt_callback_id, registration_args]``
+        self._event_callbacks = {}
+        self._event_callback_ids = itertools.count()
+        #: functions called (without arguments) after reconnecting to
+        #: libvirt; events may have been missed while the connection was dead
+        self.reconnect_callbacks = []
 
     def _reconnect_if_dead(self):
-        is_dead = not self._conn.isAlive()
-        if is_dead:
-            self._conn = libvirt.open(self._conn.getURI())
-            # TODO: re-register event handlers
-        return is_dead
+        # may be called from several threads of the executor at once
+        with self._reconnect_lock:
+            is_dead = not self._conn.isAlive()
+            if is_dead:
+                self._conn = libvirt.open(self._conn.getURI())
+                for callback in self._event_callbacks.values():
+                    callback[0] = self._conn.domainEventRegisterAny(
+                        *callback[1])
+                for func in self.reconnect_callbacks:
+                    func()
+            return is_dead
+
+    def domainEventRegisterAny(self, *args):
+        '''Register domain event callback, like
+        :py:meth:`libvirt.virConnect.domainEventRegisterAny`
+
+        The callback is registered again after reconnecting to libvirt.
+
+        :returns: callback ID for :py:meth:`domainEventDeregisterAny`
+        '''
+        # pylint: disable=invalid-name
+        libvirt_callback_id = self.__getattr__('domainEventRegisterAny')(*args)
+        callback_id = next(self._event_callback_ids)
+        self._event_callbacks[callback_id] = [libvirt_callback_id, args]
+        return callback_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        '''Deregister callback registered with
+        :py:meth:`domainEventRegisterAny`'''
+        # pylint: disable=invalid-name
+        libvirt_callback_id, _ = self._event_callbacks.pop(callback_id)
+        try:
+            self._conn.domainEventDeregisterAny(libvirt_callback_id)
+        except libvirt.libvirtError:
+            # registered on a dead connection only, nothing to deregister
+            if not self._reconnect_if_dead():
+                raise
+
+    def _domain_lock(self, domain_uuid):
+        return self._domain_locks[domain_uuid]
+
+    def forget_domain_lock(self, domain_uuid):
+        '''Drop the lock of an undefined domain, unless it is still in use
+
+        :param bytes domain_uuid: UUID of the domain, as returned by \
+            :py:meth:`libvirt.virDomain.UUID`
+        '''
+        lock = self._domain_locks.get(domain_uuid)
+        # pylint: disable=protected-access
+        if lock is not None and not lock.locked() and not lock._waiters:
+            del self._domain_locks[domain_uuid]
+
+    @asyncio.coroutine
+    def run_in_executor(self, func, *args, **kwargs):
+        '''Run *func* in the libvirt thread pool'''
+        return (yield from asyncio.get_event_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)))
+
+    @asyncio.coroutine
+    def call_async(self, attrname, *args, **kwargs):
+        '''Call method of the connection in a thread, without blocking the
+        event loop. Returned domains are wrapped like for synchronous calls.
+
+        :param str attrname: name of :py:class:`libvirt.virConnect` method
+        '''
+        return (yield from self.run_in_executor(
+            getattr(self, attrname), *args, **kwargs))
 
     def _wrap_domain(self, ret):
         if isinstance(ret, libvirt.virDomain):
@@ -151,6 +252,7 @@ class VMMConnection(object):
         self._offline_mode = offline_mode
 
         self._libvirt_conn = None
+        self._libvirt_executor = None
         self._xs = None
         self._xc = None
 
@@ -178,8 +280,11 @@ class VMMConnection(object):
             self._xs = xen.lowlevel.xs.xs()
         if 'xen.lowlevel.xc' in sys.modules:
             self._xc = xen.lowlevel.xc.xc()
+        self._libvirt_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=qubes.config.libvirt_threads)
         self._libvirt_conn = VirConnectWrapper(
-            qubes.config.defaults['libvirt_uri'])
+            qubes.config.defaults['libvirt_uri'],
+            executor=self._libvirt_executor)
         libvirt.registerErrorHandler(self._libvirt_error_handler, None)
 
     @property
@@ -228,6 +333,9 @@ class VMMConnection(object):
         if self._libvirt_conn:
             self._libvirt_conn.close()
             self._libvirt_conn = None
+        if self._libvirt_executor is not None:
+            self._libvirt_executor.shutdown(wait=False)
+            self._libvirt_executor = None
         self._xc = None  # and pray it will get garbage-collected
 
 
@@ -372,17 +480,44 @@ class VMCollection(object):
     and whole VM object's presence.
 
     Iterating over VMCollection will yield machine objects.
+
+    Lookups by ``name`` and ``uuid`` are served from indexes, which are
+    maintained on :py:meth:`add`, on deletion and when ``name`` or ``uuid``
+    property of a member changes. The sorted view used for iteration is
+    cached and rebuilt only when the membership (or ordering) changes.
+
+    When :py:class:`Qubes` is loaded with ``lazy=True``, domains are
+    registered with :py:meth:`add_lazy` and their objects are constructed
+    from XML only on first access. Checking for presence, counting and
+    listing names or qids does not construct anything.
     '''
 
     def __init__(self, app):
         self.app = app
         self._dict = dict()
+        #: name -> qid
+        self._name_index = dict()
+        #: uuid -> qid
+        self._uuid_index = dict()
+        #: cached result of sorting VMs, :py:obj:`None` when invalid
+        self._sorted = None
+        #: qid -> XML node of domains not constructed yet
+        self._pending = dict()
+        #: while loading, VMs constructed from :py:attr:`_pending` are not
+        #: finished right away, but collected here
+        self._unfinished = None
 
 
     def close(self):
+        for vm in self._dict.values():
+            self._unwatch(vm)
         del self.app
         self._dict.clear()
         del self._dict
+        self._name_index.clear()
+        self._uuid_index.clear()
+        self._pending.clear()
+        self._sorted = None
 
 
     def __repr__(self):
@@ -402,6 +537,8 @@ class VMCollection(object):
         qids are sorted by numerical order.
         '''
 
+        if self._pending:
+            return iter(sorted(itertools.chain(self._dict, self._pending)))
         return iter(sorted(self._dict.keys()))
 
     keys = qids
@@ -413,7 +550,7 @@ class VMCollection(object):
         names are sorted by lexical order.
         '''
 
-        return iter(sorted(vm.name for vm in self._dict.values()))
+        return iter(sorted(self._name_index.keys()))
 
 
     def vms(self):
@@ -422,11 +559,87 @@ class VMCollection(object):
         vms are sorted by qid.
         '''
 
-        return iter(sorted(self._dict.values()))
+        for qid in list(self._pending):
+            self._get(qid)
+        return self.loaded_vms()
 
     __iter__ = vms
     values = vms
 
+    def loaded_vms(self):
+        '''Iterate over machines already constructed, without loading any
+        other (see :py:meth:`add_lazy`)'''
+
+        if self._sorted is None:
+            self._sorted = tuple(sorted(self._dict.values()))
+        return iter(self._sorted)
+
+    def pending_items(self):
+        '''``(qid, node)`` pairs of domains not constructed yet, sorted by qid
+
+        :rtype: list of tuples (:py:class:`int`, \
+            :py:class:`lxml.etree._Element`)
+        '''
+        return sorted(self._pending.items())
+
+    def add_lazy(self, node):
+        '''Register domain to be constructed from *node* on first access
+
+        Only domains with ``qid`` and ``name`` properties set explicitly can
+        be registered this way.
+
+        :param lxml.etree._Element node: ``<domain>`` element
+        :return: :py:obj:`True` if registered, :py:obj:`False` when the \
+            domain needs to be constructed right away
+        :raises ValueError: on conflicting ``qid`` or ``name``
+        '''
+
+        properties = {}
+        for prop in node.xpath('./properties/property'):
+            name = prop.get('name')
+            if name in ('qid', 'name', 'uuid'):
+                properties[name] = prop.text
+        if 'qid' not in properties or 'name' not in properties:
+            return False
+
+        qid = int(properties['qid'])
+        name = properties['name']
+        if qid in self:
+            raise ValueError('This collection already holds VM that has '
+                'qid={!r}'.format(qid))
+        if name in self:
+            raise ValueError('A VM named {!s} already exists'.format(name))
+
+        self._pending[qid] = node
+        self._name_index[name] = qid
+        if 'uuid' in properties:
+            self._uuid_index[uuid.UUID(properties['uuid'])] = qid
+        return True
+
+    def _get(self, qid):
+        try:
+            return self._dict[qid]
+        except KeyError:
+            if qid not in self._pending:
+                raise
+
+        # pylint: disable=protected-access
+        node = self._pending.pop(qid)
+        vm = self.app._load_domain(node)
+        self._dict[qid] = vm
+        self._index_uuid(vm)
+        self._sorted = None
+        self._watch(vm)
+
+        if self._unfinished is not None:
+            # Qubes.load() in progress, it will finish this one
+            self._unfinished.append(vm)
+        else:
+            self.app._load_domain_finish(vm)
+            vm.events_enabled = True
+            vm.fire_event('domain-load')
+        return vm
+
     def add(self, value, _enable_events=True):
         '''Add VM to collection
 
@@ -450,6 +663,10 @@ class VMCollection(object):
                 .format(value.name))
 
         self._dict[value.qid] = value
+        self._name_index[value.name] = value.qid
+        self._index_uuid(value)
+        self._sorted = None
+        self._watch(value)
         if _enable_events:
             value.events_enabled = True
             self.app.fire_event('domain-add', vm=value)
@@ -458,22 +675,22 @@ class VMCollection(object):
 
     def __getitem__(self, key):
         if isinstance(key, int):
-            return self._dict[key]
+            return self._get(key)
 
         if isinstance(key, str):
-            for vm in self:
-                if vm.name == key:
-                    return vm
-            raise KeyError(key)
+            try:
+                return self._get(self._name_index[key])
+            except KeyError:
+                raise KeyError(key)
 
         if isinstance(key, qubes.vm.BaseVM):
             key = key.uuid
 
         if isinstance(key, uuid.UUID):
-            for vm in self:
-                if vm.uuid == key:
-                    return vm
-            raise KeyError(key)
+            try:
+                return self._get(self._uuid_index[key])
+            except KeyError:
+                raise KeyError(key)
 
         raise KeyError(key)
 
@@ -486,20 +703,85 @@ class VMCollection(object):
             vm.libvirt_domain.undefine()
             # pylint: disable=protected-access
             vm._libvirt_domain = None
+            vm.invalidate_libvirt_cache()
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                 # already undefined
                 pass
         del self._dict[vm.qid]
+        self._unindex(vm)
+        self._unwatch(vm)
         self.app.fire_event('domain-delete', vm=vm)
 
     def __contains__(self, key):
-        return any((key == vm or key == vm.qid or key == vm.name)
-                   for vm in self)
+        if isinstance(key, int):
+            return key in self._dict or key in self._pending
+        if isinstance(key, str):
+            return key in self._name_index
+        if isinstance(key, qubes.vm.BaseVM):
+            try:
+                qid = key.qid
+            except AttributeError:
+                return False
+            return qid in self and key == self._get(qid)
+        return False
 
 
     def __len__(self):
-        return len(self._dict)
+        return len(self._dict) + len(self._pending)
+
+
+    def _index_uuid(self, vm):
+        try:
+            self._uuid_index[vm.uuid] = vm.qid
+        except AttributeError:
+            # not yet assigned, see on_vm_property_set_uuid
+            pass
+
+    def _unindex(self, vm):
+        if self._name_index.get(vm.name) == vm.qid:
+            del self._name_index[vm.name]
+        try:
+            if self._uuid_index.get(vm.uuid) == vm.qid:
+                del self._uuid_index[vm.uuid]
+        except AttributeError:
+            pass
+        self._sorted = None
+
+    def _watch(self, vm):
+        vm.add_handler('property-pre-set:name',
+            self.on_vm_property_pre_set_name)
+        vm.add_handler('property-set:name', self.on_vm_property_set_name)
+        vm.add_handler('property-set:uuid', self.on_vm_property_set_uuid)
+
+    def _unwatch(self, vm):
+        vm.remove_handler('property-pre-set:name',
+            self.on_vm_property_pre_set_name)
+        vm.remove_handler('property-set:name', self.on_vm_property_set_name)
+        vm.remove_handler('property-set:uuid', self.on_vm_property_set_uuid)
+
+    def on_vm_property_pre_set_name(self, vm, event, name, newvalue,
+            oldvalue=None):
+        # pylint: disable=unused-argument
+        if newvalue != oldvalue and newvalue in self._name_index:
+            raise ValueError('A VM named {!s} already exists'
+                .format(newvalue))
+
+    def on_vm_property_set_name(self, vm, event, name, newvalue,
+            oldvalue=None):
+        # pylint: disable=unused-argument
+        if self._name_index.get(oldvalue) == vm.qid:
+            del self._name_index[oldvalue]
+        self._name_index[newvalue] = vm.qid
+        # default ordering of VMs is by name
+        self._sorted = None
+
+    def on_vm_property_set_uuid(self, vm, event, name, newvalue,
+            oldvalue=None):
+        # pylint: disable=unused-argument
+        if self._uuid_index.get(oldvalue) == vm.qid:
+            del self._uuid_index[oldvalue]
+        self._uuid_index[newvalue] = vm.qid
 
 
     def get_vms_based_on(self, template):
@@ -555,6 +837,502 @@ class VMCollection(object):
             'https://xkcd.com/221/',
             'http://dilbert.com/strip/2001-10-25')[random.randint(0, 1)])
 
+class DelayedSave(object):
+    '''Coalescing, debounced writer of :file:`qubes.xml`
+
+    Every :py:meth:`schedule` call marks the data as dirty and (re)arms a
+    timer. The file is written once no new request arrived for
+    *quiet_period* seconds, but no later than *max_delay* seconds after the
+    first not yet saved request. All requests covered by one write share
+    its outcome. :py:meth:`sync` skips the wait, for callers which need the
+    changes on disk before going on.
+
+    The data is serialized in the event loop, but written to disk (with
+    locking of :file:`qubes.xml`) by another thread. Changes made while
+    a write is in progress are written after it.
+
+    :param qubes.Qubes app: application object to save
+    :param float quiet_period: seconds without changes before saving
+    :param float max_delay: upper bound of postponing a save, in seconds
+    :param loop: event loop to use (default: current one)
+    '''
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, app, quiet_period=None, max_delay=None, loop=None):
+        self.app = app
+        self.quiet_period = (qubes.config.save_quiet_period
+            if quiet_period is None else quiet_period)
+        self.max_delay = (qubes.config.save_max_delay
+            if max_delay is None else max_delay)
+        self.loop = loop or asyncio.get_event_loop()
+
+        #: there are changes not written to disk yet
+        self.dirty = False
+        self._lock = False
+        self._deadline = None
+        self._handle = None
+        self._waiters = []
+        #: write in progress, as ``(concurrent future, waiters, lock)``
+        self._writing = None
+        #: flush was requested while a write was in progress
+        self._flush_pending = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        #: number of :py:meth:`schedule` calls
+        self.requested = 0
+        #: number of actual writes of :file:`qubes.xml`
+        self.saved = 0
+        #: number of requests served by a write triggered by another request
+        self.coalesced = 0
+        #: number of failed writes
+        self.failed = 0
+
+    def schedule(self, lock=True):
+        '''Request saving of :file:`qubes.xml`
+
+        :param bool lock: keep file locked after saving
+        :returns: future resolved when a write covering this request is done
+        :rtype: asyncio.Future
+        '''
+        self.requested += 1
+        self.dirty = True
+        self._lock = self._lock or lock
+
+        future = self.loop.create_future()
+        self._waiters.append(future)
+
+        now = self.loop.time()
+        if self._deadline is None:
+            self._deadline = now + self.max_delay
+        self._arm(max(0, min(self.quiet_period, self._deadline - now)))
+
+        return future
+
+    @asyncio.coroutine
+    def sync(self):
+        '''Wait until all changes requested so far are on disk, writing
+        them right away
+
+        Callers waiting at the same time share one write.
+
+        :raises EnvironmentError: failure on saving
+        '''
+        if self.dirty:
+            future = self.loop.create_future()
+            self._waiters.append(future)
+            self._arm(0)
+            yield from future
+        elif self._writing is not None:
+            # all the changes are in the write in progress
+            yield from asyncio.shield(
+                asyncio.wrap_future(self._writing[0], loop=self.loop))
+
+    def _arm(self, delay):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self.loop.call_later(delay, self.flush)
+
+    def _cancel_timer(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._deadline = None
+
+    def flush(self):
+        '''Start writing pending changes, if there are any'''
+        self._cancel_timer()
+        if self._writing is not None:
+            self._flush_pending = True
+            return
+        waiters, self._waiters = self._waiters, []
+        if not self.dirty:
+            self._save_done(waiters, count=False)
+            return
+
+        # pylint: disable=protected-access
+        lock, self._lock = self._lock, False
+        self.dirty = False
+        try:
+            data = self.app._serialize_store()
+        except Exception as e:  # pylint: disable=broad-except
+            self._save_failed(waiters, lock, e)
+            return
+        future = self._executor.submit(self.app._write_store, data,
+            lock=lock)
+        self._writing = (future, waiters, lock)
+        future.add_done_callback(lambda future:
+            self.loop.call_soon_threadsafe(self._write_done, future))
+
+    def _write_done(self, future):
+        if self._writing is None or self._writing[0] is not future:
+            # already handled by flush_sync()
+            return
+        _, waiters, lock = self._writing
+        self._writing = None
+        exc = future.exception()
+        if exc is not None:
+            self._save_failed(waiters, lock, exc)
+        else:
+            self._save_done(waiters)
+        if self._flush_pending:
+            self._flush_pending = False
+            self._arm(0)
+
+    def flush_sync(self):
+        '''Write pending changes now, in this thread, and return when they
+        are on disk (or failed to get there)
+
+        Meant for places which can't wait asynchronously, like exiting.
+
+        :raises EnvironmentError: failure on saving
+        '''
+        if self._writing is not None:
+            future = self._writing[0]
+            concurrent.futures.wait([future])
+            self._write_done(future)
+        self._cancel_timer()
+        self._flush_pending = False
+
+        waiters, self._waiters = self._waiters, []
+        if not self.dirty:
+            self._save_done(waiters, count=False)
+            return
+        lock, self._lock = self._lock, False
+        self.dirty = False
+        try:
+            # pylint: disable=protected-access
+            self.app._save(lock=lock)
+        except Exception as e:  # pylint: disable=broad-except
+            self._save_failed(waiters, lock, e)
+            raise
+        self._save_done(waiters)
+
+    def _save_done(self, waiters, count=True):
+        if count:
+            self.saved += 1
+            self.coalesced += max(0, len(waiters) - 1)
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    def _save_failed(self, waiters, lock, exc):
+        self.failed += 1
+        # retry on the next flush
+        self.dirty = True
+        self._lock = self._lock or lock
+        self.app.log.error('failed to save %s', self.app.store,
+            exc_info=(type(exc), exc, exc.__traceback__))
+        for future in waiters:
+            if not future.done():
+                future.set_exception(exc)
+                # already logged above, don't complain again about
+                # futures nobody waits for
+                future.exception()
+
+    def cancel(self):
+        '''Stop the timer without saving anything'''
+        self._cancel_timer()
+
+    def close(self):
+        '''Write pending changes and stop the writer thread
+
+        Failures are only logged.
+        '''
+        try:
+            self.flush_sync()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        finally:
+            self._executor.shutdown()
+
+    def get_stats(self):
+        '''Counters of this object, as :py:class:`dict`'''
+        return {
+            'requested': self.requested,
+            'saved': self.saved,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'pending': self.dirty,
+        }
+
+
+class StoreSnapshot(object):
+    '''Compact copy of the state saved in :file:`qubes.xml`, for faster
+    start of :program:`qubesd`
+
+    The snapshot holds values of properties as they are after their setters
+    ran, so loading it skips both parsing XML and validating values. It is
+    used only when it matches the current :file:`qubes.xml` (SHA-256 of its
+    content), the snapshot format and the code that wrote it (modification
+    time of :py:mod:`qubes` and of the extensions, which is changed by every
+    update of those packages). Otherwise (or if anything goes wrong)
+    :file:`qubes.xml` is loaded as usual.
+
+    The file is written along with :file:`qubes.xml` by :py:meth:`Qubes.save`
+    (so not after loading :file:`qubes.xml`, which would slow down the cold
+    start), but only when the content of :file:`qubes.xml` changed since
+    the snapshot was last written or read. It consists of lines of JSON:
+    a header with the above key (so a stale snapshot is rejected without
+    decoding the rest), global data (labels, pools and properties) and then
+    one line for each domain. Lines of domains are reused until the domain
+    changes, just like in :py:meth:`Qubes.xml_serialize`.
+
+    :param str path: path of the snapshot file
+    '''
+
+    #: version of the format, change it on every incompatible change
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        #: qid -> (:py:attr:`qubes.vm.BaseVM.xml_cache`, encoded domain)
+        self._domain_cache = {}
+        #: digest of :file:`qubes.xml` matching the snapshot on disk
+        self._digest = None
+
+    @staticmethod
+    def get_digest(xml):
+        '''Digest of content of :file:`qubes.xml`
+
+        :param bytes xml: content of :file:`qubes.xml`
+        :rtype: str
+        '''
+        return hashlib.sha256(xml).hexdigest()
+
+    @staticmethod
+    def get_key(app, digest):
+        '''Key identifying content of :file:`qubes.xml`, and the code
+        interpreting it
+
+        :param qubes.Qubes app: application object
+        :param str digest: result of :py:meth:`get_digest`
+        :rtype: list
+        '''
+        # pylint: disable=protected-access
+        modules = {qubes.__name__}
+        modules.update(type(ext).__module__ for ext in app._extensions)
+        return [StoreSnapshot.VERSION, digest,
+            sorted([name, os.stat(sys.modules[name].__file__).st_mtime_ns]
+                for name in modules)]
+
+    def read(self, app, digest):
+        '''Read the snapshot, if it matches :file:`qubes.xml`
+
+        :param qubes.Qubes app: application object
+        :param str digest: :py:meth:`get_digest` of :file:`qubes.xml`
+        :returns: data like from :py:meth:`dump`, or :py:obj:`None`
+        '''
+        try:
+            with open(self.path, 'rb') as fh:
+                header = json.loads(fh.readline().decode())
+                if header != self.get_key(app, digest):
+                    app.log.debug('snapshot %s is stale', self.path)
+                    return None
+                data = json.loads(fh.readline().decode())
+                data['domains'] = [json.loads(line.decode()) for line in fh]
+                self._digest = digest
+                return data
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            app.log.warning('failed to read snapshot %s: %s', self.path, e)
+            return None
+
+    def encode(self, app, xml):
+        '''Encode a snapshot of *app*, which is about to be saved to
+        :file:`qubes.xml`, for :py:meth:`write`
+
+        Failures are only logged, as the snapshot is not needed.
+
+        :param qubes.Qubes app: application object
+        :param bytes xml: content of :file:`qubes.xml` to be saved
+        :returns: digest of *xml* and list of encoded lines, or \
+            :py:obj:`None` if the snapshot on disk is up to date already
+        '''
+        digest = self.get_digest(xml)
+        if digest == self._digest:
+            return None
+        try:
+            lines = [self._encode(self.get_key(app, digest)),
+                self._encode(self.dump(app, with_domains=False))]
+            domain_cache = {}
+            for vm in app.domains:
+                cached = self._domain_cache.get(vm.qid)
+                if cached is not None and vm.xml_cache is not None \
+                        and cached[0] is vm.xml_cache:
+                    encoded = cached[1]
+                else:
+                    encoded = self._encode(self.dump_domain(vm))
+                if vm.xml_cache is not None:
+                    domain_cache[vm.qid] = (vm.xml_cache, encoded)
+                lines.append(encoded)
+            self._domain_cache = domain_cache
+            return digest, lines
+        except Exception:  # pylint: disable=broad-except
+            app.log.exception('failed to encode snapshot %s', self.path)
+            return None
+
+    def write(self, app, data):
+        '''Write a snapshot encoded by :py:meth:`encode`, after
+        :file:`qubes.xml` was saved
+
+        Failures are only logged, as the snapshot is not needed.
+
+        :param qubes.Qubes app: application object
+        :param tuple data: result of :py:meth:`encode`
+        '''
+        digest, lines = data
+        try:
+            fh_new = tempfile.NamedTemporaryFile(prefix=self.path,
+                delete=False)
+            try:
+                with fh_new:
+                    fh_new.writelines(lines)
+                os.rename(fh_new.name, self.path)
+            except:
+                os.unlink(fh_new.name)
+                raise
+            self._digest = digest
+        except Exception:  # pylint: disable=broad-except
+            app.log.exception('failed to write snapshot %s', self.path)
+
+    @staticmethod
+    def _encode(data):
+        return json.dumps(data, separators=(',', ':')).encode() + b'\n'
+
+    @classmethod
+    def dump(cls, app, with_domains=True):
+        '''Data of the snapshot of *app*, as stored in :file:`qubes.xml`
+
+        :param bool with_domains: include ``'domains'`` key, with a list of \
+            results of :py:meth:`dump_domain`
+        :rtype: dict
+        '''
+        pools = []
+        for pool in app.pools.values():
+            xml = pool.__xml__()
+            if xml is not None:
+                pools.append(dict(xml.items()))
+
+        data = {
+            'labels': [[label.index, label.color, label.name]
+                for label in app.labels.values()],
+            'pools': pools,
+            'properties': cls.dump_properties(app),
+        }
+        if with_domains:
+            data['domains'] = [cls.dump_domain(vm) for vm in app.domains]
+        return data
+
+    @classmethod
+    def dump_domain(cls, vm):
+        '''Snapshot of a domain, as in its ``<domain>`` element
+
+        :rtype: dict
+        '''
+        volume_config = {}
+        for name, volume in vm.volumes.items():
+            # pylint: disable=protected-access
+            volume_config[name] = {key: (True if value == 'True' else value)
+                for key, value in qubes.storage._sanitize_config(
+                    volume.config).items()}
+
+        devices = []
+        for devclass in vm.devices:
+            for device in vm.devices[devclass].assignments(persistent=True):
+                devices.append([devclass, device.backend_domain.name,
+                    device.ident, device.options])
+
+        return {
+            'class': vm.__class__.__name__,
+            'properties': cls.dump_properties(vm),
+            'volume_config': volume_config,
+            'features': dict(vm.features),
+            'devices': devices,
+            'tags': sorted(vm.tags),
+        }
+
+    @staticmethod
+    def dump_properties(holder):
+        '''Values of properties of *holder*, which are saved to
+        :file:`qubes.xml`
+
+        References to domains, labels and pools are stored by name (or
+        index). Values which have no JSON counterpart are stored as in
+        :file:`qubes.xml`, and go through the setter when loaded.
+
+        :param qubes.PropertyHolder holder: object with properties
+        :rtype: dict
+        '''
+        # pylint: disable=protected-access
+        result = {}
+        for prop in holder.property_list():
+            try:
+                value = getattr(holder, prop._attr_name)
+            except AttributeError:
+                continue
+            try:
+                saved = prop._saver(holder, prop, value)
+            except qubes.property.DontSave:
+                continue
+
+            if value is None or type(value) in (bool, int, float, str):
+                result[prop.__name__] = value
+            elif isinstance(value, qubes.vm.BaseVM):
+                result[prop.__name__] = ['vm', value.name]
+            elif isinstance(value, qubes.Label):
+                result[prop.__name__] = ['label', value.index]
+            elif isinstance(value, qubes.storage.Pool):
+                result[prop.__name__] = ['pool', value.name]
+            elif isinstance(value, uuid.UUID):
+                result[prop.__name__] = ['uuid', str(value)]
+            else:
+                result[prop.__name__] = ['str', saved]
+        return result
+
+    @staticmethod
+    def restore_properties(holder, app, values, load_stage):
+        '''Set properties of *holder* of given *load_stage* to *values*
+        stored by :py:meth:`dump_properties`, without calling setters (except
+        for values stored as strings)
+
+        :param qubes.PropertyHolder holder: object with properties
+        :param qubes.Qubes app: application object
+        :param dict values: property values
+        :param int load_stage: stage of loading, like in \
+            :py:meth:`qubes.PropertyHolder.load_properties`
+        '''
+        # pylint: disable=protected-access
+        for name, value in values.items():
+            prop = holder.property_get_def(name)
+            if prop.load_stage != load_stage:
+                continue
+            if not isinstance(value, list):
+                holder._property_init(prop, value)
+                continue
+            kind, value = value
+            if kind == 'str':
+                setattr(holder, name, value)
+                continue
+            if kind == 'vm':
+                value = app.domains[value]
+            elif kind == 'label':
+                value = app.labels[value]
+            elif kind == 'pool':
+                value = app.pools[value]
+            elif kind == 'uuid':
+                value = uuid.UUID(value)
+            else:
+                raise ValueError(
+                    'unknown kind of property value: {!r}'.format(kind))
+            holder._property_init(prop, value)
+
+
+# used by Qubes.xml_serialize() to glue pretty-printed document together
+_XML_FRAGMENT_PREFIX = b'<qubes>\n  <domains>\n'
+_XML_FRAGMENT_SUFFIX = b'  </domains>\n</qubes>\n'
+_XML_DOCUMENT_SUFFIX = b'</qubes>\n'
+
 def _default_pool(app):
     ''' Default storage pool.
 
@@ -601,6 +1379,9 @@ class Qubes(qubes.PropertyHolder):
     '''Main Qubes application
 
     :param str store: path to ``qubes.xml``
+    :param bool snapshot: keep a :py:class:`StoreSnapshot` next to the \
+        store (in :file:`qubes.xml.snapshot`) and load from it when possible; \
+        ignored with *lazy*
 
     The store is loaded in stages:
 
@@ -652,6 +1433,10 @@ class Qubes(qubes.PropertyHolder):
 
     Methods and attributes:
     '''
+    # the application object holds independent pieces of daemon state
+    # (like the delayed save writer), which are used directly by domains
+    # and extensions
+    # pylint: disable=too-many-instance-attributes
 
     default_netvm = qubes.VMProperty('default_netvm', load_stage=3,
         default=None, allow_none=True,
@@ -715,7 +1500,7 @@ class Qubes(qubes.PropertyHolder):
         doc='check for updates inside qubes')
 
     def __init__(self, store=None, load=True, offline_mode=None, lock=False,
-            **kwargs):
+            stopwatch=None, lazy=False, snapshot=False, **kwargs):
         #: logger instance for logging global messages
         self.log = logging.getLogger('app')
         self.log.debug('init() -> %#x', id(self))
@@ -753,6 +1538,27 @@ class Qubes(qubes.PropertyHolder):
         self.__load_timestamp = None
         self.__locked_fh = None
         self._domain_event_callback_id = None
+        self._device_event_callback_ids = []
+
+        #: cache results of read-only libvirt calls for each domain (see
+        #: :py:meth:`qubes.vm.BaseVM.libvirt_cached`); enabled by
+        #: :py:meth:`register_event_handlers`, as the cache relies on libvirt
+        #: events for invalidation
+        self.libvirt_cache_enabled = False
+        #: verify each value taken from the libvirt cache against libvirt
+        #: (for tests)
+        self.libvirt_cache_check = False
+
+        #: domain classes already looked up by :py:meth:`_load_domain`;
+        #: entry point lookup is expensive enough to show on large stores
+        self._vm_classes = {}
+
+        #: :py:class:`DelayedSave` instance when saving in background
+        self.delayed_save = None
+
+        #: :py:class:`StoreSnapshot` instance, if enabled
+        self.snapshot = StoreSnapshot(self._store + '.snapshot') \
+            if snapshot and not lazy else None
 
         #: jinja2 environment for libvirt XML templates
         self.env = jinja2.Environment(
@@ -763,7 +1569,7 @@ class Qubes(qubes.PropertyHolder):
             undefined=jinja2.StrictUndefined)
 
         if load:
-            self.load(lock=lock)
+            self.load(lock=lock, stopwatch=stopwatch, lazy=lazy)
 
         self.events_enabled = True
 
@@ -771,73 +1577,226 @@ class Qubes(qubes.PropertyHolder):
     def store(self):
         return self._store
 
-    def load(self, lock=False):
+    def load(self, lock=False, stopwatch=None, lazy=False):
         '''Open qubes.xml
 
+        :param qubes.utils.Stopwatch stopwatch: if given, record there time \
+            spent in each loading stage and in each event handler called \
+            meanwhile
+        :param bool lazy: construct domain objects only when they are first \
+            accessed (see :py:meth:`VMCollection.add_lazy`); meant for tools \
+            which touch only a few of them
         :throws EnvironmentError: failure on parsing store
         :throws xml.parsers.expat.ExpatError: failure on parsing store
         :raises lxml.etree.XMLSyntaxError: on syntax error in qubes.xml
         '''
 
+        with qubes.events.profile_handlers(
+                stopwatch.handler_called if stopwatch is not None else None):
+            self._load(stopwatch or qubes.utils.Stopwatch(), lazy)
+
+        if not lock:
+            self._release_lock()
+
+    def _load(self, stopwatch, lazy):
         fh = self._acquire_lock()
-        self.xml = lxml.etree.parse(fh)
+        data = loaded = None
+        if self.snapshot is not None:
+            with stopwatch.measure('read snapshot'):
+                data = self.snapshot.read(self,
+                    StoreSnapshot.get_digest(fh.read()))
+                fh.seek(0)
+        if data is not None:
+            try:
+                loaded = self._load_snapshot(stopwatch, data)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception('failed to load snapshot %s, loading %s',
+                    self.snapshot.path, self._store)
+                self._unload()
+        if loaded is None:
+            with stopwatch.measure('parse qubes.xml'):
+                self.xml = lxml.etree.parse(fh)
+            loaded = self._load_xml(stopwatch, lazy)
+
+        # stage 5: misc fixups
+        with stopwatch.measure('stage 5: fixups'):
+            self.property_require('default_fw_netvm', allow_none=True)
+            self.property_require('default_netvm', allow_none=True)
+            self.property_require('default_template')
+            self.property_require('clockvm', allow_none=True)
+            self.property_require('updatevm', allow_none=True)
+
+        with stopwatch.measure('stage 5: domain-load events'):
+            for vm in sorted(loaded):
+                vm.events_enabled = True
+                vm.fire_event('domain-load')
 
+        # get a file timestamp (before closing it - still holding the lock!),
+        #  to detect whether anyone else have modified it in the meantime
+        self.__load_timestamp = os.path.getmtime(self._store)
+
+    def _load_xml(self, stopwatch, lazy):
+        '''Load stages 1 to 4 from parsed :file:`qubes.xml`
+
+        :returns: list of loaded domains
+        '''
         # stage 1: load labels and pools
-        for node in self.xml.xpath('./labels/label'):
-            label = qubes.Label.fromxml(node)
-            self.labels[label.index] = label
+        with stopwatch.measure('stage 1: labels'):
+            for node in self.xml.xpath('./labels/label'):
+                label = qubes.Label.fromxml(node)
+                self.labels[label.index] = label
 
         for node in self.xml.xpath('./pools/pool'):
             name = node.get('name')
             assert name, "Pool name '%s' is invalid " % name
-            try:
-                self.pools[name] = self._get_pool(**node.attrib)
-            except qubes.exc.QubesException as e:
-                self.log.error(str(e))
+            with stopwatch.measure(
+                    'stage 1: pool driver {}'.format(node.get('driver'))):
+                try:
+                    self.pools[name] = self._get_pool(**node.attrib)
+                except qubes.exc.QubesException as e:
+                    self.log.error(str(e))
 
         # stage 2: load VMs
-        for node in self.xml.xpath('./domains/domain'):
-            # pylint: disable=no-member
-            cls = self.get_vm_class(node.get('class'))
-            vm = cls(self, node)
-            vm.load_properties(load_stage=2)
-            vm.init_log()
-            self.domains.add(vm, _enable_events=False)
-
-        if 0 not in self.domains:
-            self.domains.add(
-                qubes.vm.adminvm.AdminVM(self, None, qid=0, name='dom0'),
-                _enable_events=False)
+        # pylint: disable=protected-access
+        unfinished = self.domains._unfinished = []
+        with stopwatch.measure('stage 2: domains'):
+            for node in self.xml.xpath('./domains/domain'):
+                if lazy and self.domains.add_lazy(node):
+                    continue
+                vm = self._load_domain(node)
+                self.domains.add(vm, _enable_events=False)
+                unfinished.append(vm)
+
+            if 0 not in self.domains:
+                vm = qubes.vm.adminvm.AdminVM(self, None, qid=0, name='dom0')
+                self.domains.add(vm, _enable_events=False)
+                unfinished.append(vm)
 
         # stage 3: load global properties
-        self.load_properties(load_stage=3)
+        with stopwatch.measure('stage 3: global properties'):
+            self.load_properties(load_stage=3)
+
+        # stage 4: fill all remaining VM properties; in lazy mode, this may
+        # construct more VMs, referenced by those already loaded
+        with stopwatch.measure('stage 4: domain properties and extras'):
+            unfinished.sort()
+            i = 0
+            while i < len(unfinished):
+                self._load_domain_finish(unfinished[i])
+                i += 1
+            self.domains._unfinished = None
+        return unfinished
+
+    def _load_snapshot(self, stopwatch, data):
+        '''Load stages 1 to 4 from :py:class:`StoreSnapshot` data
+
+        :returns: list of loaded domains
+        '''
+        with stopwatch.measure('stage 1: labels'):
+            for index, color, name in data['labels']:
+                self.labels[index] = qubes.Label(index, color, name)
 
-        # stage 4: fill all remaining VM properties
-        for vm in self.domains:
-            vm.load_properties(load_stage=4)
-            vm.load_extras()
+        for config in data['pools']:
+            with stopwatch.measure(
+                    'stage 1: pool driver {}'.format(config.get('driver'))):
+                try:
+                    self.pools[config['name']] = self._get_pool(**config)
+                except qubes.exc.QubesException as e:
+                    self.log.error(str(e))
+
+        loaded = []
+        with stopwatch.measure('stage 2: domains'):
+            for record in data['domains']:
+                clsname = record['class']
+                kwargs = {}
+                if record['volume_config']:
+                    kwargs['volume_config'] = record['volume_config']
+                # everything but the class comes from the snapshot
+                vm = self._get_vm_class_cached(clsname)(self,
+                    lxml.etree.Element('domain', {'class': clsname}), **kwargs)
+                StoreSnapshot.restore_properties(vm, self,
+                    record['properties'], 2)
+                vm.init_log()
+                self.domains.add(vm, _enable_events=False)
+                loaded.append((vm, record))
+
+            if 0 not in self.domains:
+                vm = qubes.vm.adminvm.AdminVM(self, None, qid=0, name='dom0')
+                self.domains.add(vm, _enable_events=False)
+                loaded.append((vm, None))
+
+        with stopwatch.measure('stage 3: global properties'):
+            StoreSnapshot.restore_properties(self, self, data['properties'], 3)
+
+        with stopwatch.measure('stage 4: domain properties and extras'):
+            loaded.sort(key=lambda item: item[0])
+            for vm, record in loaded:
+                if record is None:
+                    continue
+                StoreSnapshot.restore_properties(vm, self,
+                    record['properties'], 4)
+                vm.features.update(record['features'])
+                for devclass, backend, ident, options in record['devices']:
+                    vm.devices[devclass].load_persistent(
+                        qubes.devices.DeviceAssignment(
+                            self.domains[backend], ident, options,
+                            persistent=True))
+                vm.tags.update(record['tags'])
+        return [vm for vm, _ in loaded]
+
+    def _unload(self):
+        '''Drop everything loaded by a failed :py:meth:`_load_snapshot`'''
+        # pylint: disable=protected-access
+        for vm in self.domains.loaded_vms():
+            vm.close()
+        self.domains.close()
+        self.domains = VMCollection(self)
+        self.labels.clear()
+        self.pools.clear()
+        for prop in self.property_list():
+            try:
+                delattr(self, prop._attr_name)
+            except AttributeError:
+                pass
 
-        # stage 5: misc fixups
+    def _load_domain(self, node):
+        '''Construct domain object from its XML, with stage 2 properties
 
-        self.property_require('default_fw_netvm', allow_none=True)
-        self.property_require('default_netvm', allow_none=True)
-        self.property_require('default_template')
-        self.property_require('clockvm', allow_none=True)
-        self.property_require('updatevm', allow_none=True)
+        :param lxml.etree._Element node: ``<domain>`` element
+        :rtype: qubes.vm.BaseVM
+        '''
+        # pylint: disable=no-member
+        vm = self._get_vm_class_cached(node.get('class'))(self, node)
+        vm.load_properties(load_stage=2)
+        vm.init_log()
+        return vm
+
+    def _get_vm_class_cached(self, clsname):
+        ''':py:meth:`get_vm_class`, remembering classes already looked up'''
+        try:
+            return self._vm_classes[clsname]
+        except KeyError:
+            cls = self._vm_classes[clsname] = self.get_vm_class(clsname)
+            return cls
 
-        for vm in self.domains:
-            vm.events_enabled = True
-            vm.fire_event('domain-load')
+    @staticmethod
+    def _load_domain_finish(vm):
+        '''Load stage 4 properties and extras of a domain'''
+        vm.load_properties(load_stage=4)
+        vm.load_extras()
 
-        # get a file timestamp (before closing it - still holding the lock!),
-        #  to detect whether anyone else have modified it in the meantime
-        self.__load_timestamp = os.path.getmtime(self._store)
+    def __xml__(self):
+        element = self._xml_head()
 
-        if not lock:
-            self._release_lock()
+        domains = lxml.etree.Element('domains')
+        for vm in self.domains:
+            domains.append(vm.__xml__())
+        element.append(domains)
 
+        return element
 
-    def __xml__(self):
+    def _xml_head(self):
+        '''Serialise everything except domains'''
         element = lxml.etree.Element('qubes')
 
         element.append(self.xml_labels())
@@ -852,13 +1811,67 @@ class Qubes(qubes.PropertyHolder):
 
         element.append(self.xml_properties())
 
-        domains = lxml.etree.Element('domains')
-        for vm in self.domains:
-            domains.append(vm.__xml__())
-        element.append(domains)
-
         return element
 
+    @staticmethod
+    def _xml_domain_fragment(vm):
+        '''Serialised ``<domain>`` element, exactly as it appears in
+        :file:`qubes.xml`.
+
+        The result is cached in :py:attr:`qubes.vm.BaseVM.xml_cache` and
+        reused until the domain is changed. Cache is not used for domains with
+        events disabled, because then we would not know about changes.
+        '''
+        key = vm.xml_cache_key()
+        if vm.events_enabled and vm.xml_cache is not None \
+                and vm.xml_cache[0] == key:
+            return vm.xml_cache[1]
+
+        # serialise in the same context as in the whole document, so
+        # pretty-printing indents the fragment properly
+        wrapper = lxml.etree.Element('qubes')
+        lxml.etree.SubElement(wrapper, 'domains').append(vm.__xml__())
+        data = lxml.etree.tostring(wrapper, encoding='utf-8',
+            pretty_print=True)
+        assert data.startswith(_XML_FRAGMENT_PREFIX)
+        assert data.endswith(_XML_FRAGMENT_SUFFIX)
+        fragment = data[len(_XML_FRAGMENT_PREFIX):-len(_XML_FRAGMENT_SUFFIX)]
+
+        vm.xml_cache = (key, fragment) if vm.events_enabled else None
+        return fragment
+
+    def xml_serialize(self):
+        '''Serialise the whole store to bytes, as written to
+        :file:`qubes.xml`.
+
+        This gives the same result as serialising :py:meth:`__xml__`, but
+        reuses ``<domain>`` elements of domains, that did not change since the
+        last call.
+
+        :rtype: bytes
+        '''
+
+        head = lxml.etree.tostring(self._xml_head(),
+            encoding='utf-8', pretty_print=True)
+        assert head.endswith(_XML_DOCUMENT_SUFFIX)
+
+        fragments = [self._xml_domain_fragment(vm)
+            for vm in self.domains.loaded_vms()]
+        # domains not loaded (see VMCollection.add_lazy) can't have changed,
+        # no need to construct them just to save
+        fragments.extend(b''.join((b'    ',
+                lxml.etree.tostring(node, encoding='utf-8', with_tail=False),
+                b'\n'))
+            for _, node in self.domains.pending_items())
+        if fragments:
+            domains = b''.join(itertools.chain(
+                (b'  <domains>\n',), fragments, (b'  </domains>\n',)))
+        else:
+            domains = b'  <domains/>\n'
+
+        return b''.join((head[:-len(_XML_DOCUMENT_SUFFIX)], domains,
+            _XML_DOCUMENT_SUFFIX))
+
     def __str__(self):
         return type(self).__name__
 
@@ -873,17 +1886,67 @@ class Qubes(qubes.PropertyHolder):
         - Attempts to write two or more files concurrently. This is done by
           sophisticated locking.
 
+        If background saving was enabled with
+        :py:meth:`enable_delayed_save`, the file is not written immediately.
+        Instead, the returned future is resolved once the change is on disk
+        (or has failed to get there). Callers which don't need to wait for
+        that may ignore the return value.
+
+        Admin API calls which change anything wait for the write (see
+        :py:meth:`DelayedSave.sync`) before reporting success. Other changes
+        get written at most :py:data:`qubes.config.save_max_delay` seconds
+        later (or when :program:`qubesd` exits). Until then,
+        :file:`qubes.xml` does not reflect them and anything reading it
+        directly (like backup) must call :py:meth:`flush_save` first.
+
         :param bool lock: keep file locked after saving
+        :throws EnvironmentError: failure on saving
+        :rtype: asyncio.Future or None
+        '''
+
+        if self.delayed_save is not None:
+            return self.delayed_save.schedule(lock=lock)
+        self._save(lock=lock)
+        return None
+
+    def flush_save(self):
+        '''Write changes postponed by delayed saving (see
+        :py:meth:`enable_delayed_save`) now
+
+        Does nothing if there are none, or delayed saving is not enabled.
+
         :throws EnvironmentError: failure on saving
         '''
+        if self.delayed_save is None:
+            return
+        self.delayed_save.flush_sync()
+
+    def _save(self, lock=True):
+        self._write_store(self._serialize_store(), lock=lock)
+
+    def _serialize_store(self):
+        '''Collect data for :py:meth:`_write_store` from domains and other
+        objects, so it needs to run in the event loop thread
+        '''
+        xml = self.xml_serialize()
+        snapshot_data = None
+        if self.snapshot is not None:
+            snapshot_data = self.snapshot.encode(self, xml)
+        return xml, snapshot_data
+
+    def _write_store(self, data, lock=True):
+        '''Write data from :py:meth:`_serialize_store` to :file:`qubes.xml`
 
+        This touches only the files (and locks them), so it may run in
+        another thread.
+        '''
+        xml, snapshot_data = data
         if not self.__locked_fh:
             self._acquire_lock(for_save=True)
 
         fh_new = tempfile.NamedTemporaryFile(
             prefix=self._store, delete=False)
-        lxml.etree.ElementTree(self.__xml__()).write(
-            fh_new, encoding='utf-8', pretty_print=True)
+        fh_new.write(xml)
         fh_new.flush()
         try:
             os.chown(fh_new.name, -1, grp.getgrnam('qubes').gr_gid)
@@ -897,6 +1960,9 @@ class Qubes(qubes.PropertyHolder):
         # loading qubes.xml again
         self.__load_timestamp = os.path.getmtime(self._store)
 
+        if snapshot_data is not None:
+            self.snapshot.write(self, snapshot_data)
+
         # this releases lock for all other processes,
         # but they should instantly block on the new descriptor
         self.__locked_fh.close()
@@ -906,11 +1972,34 @@ class Qubes(qubes.PropertyHolder):
             self._release_lock()
 
 
+    def enable_delayed_save(self, quiet_period=None, max_delay=None,
+            loop=None):
+        '''Coalesce :py:meth:`save` calls and write the file in background
+
+        Meant for long running processes (:program:`qubesd`), where many
+        changes may come in a burst. Parameters are passed to
+        :py:class:`DelayedSave`. Call :py:meth:`disable_delayed_save` before
+        exiting to write pending changes.
+        '''
+        if self.delayed_save is None:
+            self.delayed_save = DelayedSave(self, quiet_period=quiet_period,
+                max_delay=max_delay, loop=loop)
+        return self.delayed_save
+
+    def disable_delayed_save(self):
+        '''Write pending changes (if any) and go back to saving synchronously
+        '''
+        delayed_save, self.delayed_save = self.delayed_save, None
+        if delayed_save is not None:
+            delayed_save.close()
+
     def close(self):
         '''Deconstruct the object and break circular references
 
         After calling this the object is unusable, not even for saving.'''
 
+        self.disable_delayed_save()
+
         self.log.debug('close() <- %#x', id(self))
         for frame in traceback.extract_stack():
             self.log.debug('%s', frame)
@@ -921,12 +2010,18 @@ class Qubes(qubes.PropertyHolder):
             self.vmm.libvirt_conn.domainEventDeregisterAny(
                 self._domain_event_callback_id)
             self._domain_event_callback_id = None
+        for callback_id in self._device_event_callback_ids:
+            self.vmm.libvirt_conn.domainEventDeregisterAny(callback_id)
+        self._device_event_callback_ids = []
+        self.libvirt_cache_enabled = False
 
         # Only our Lord, The God Almighty, knows what references
         # are kept in extensions.
         del self._extensions
 
-        for vm in self.domains:
+        # VMs still pending in a lazily loaded collection were never
+        # constructed, so there is nothing to close for them
+        for vm in self.domains.loaded_vms():
             vm.close()
         self.domains.close()
         del self.domains
@@ -1159,6 +2254,12 @@ class Qubes(qubes.PropertyHolder):
             raise qubes.exc.QubesException('No driver %s for pool %s' %
                                            (driver, name))
 
+    @property
+    def libvirt_events_available(self):
+        '''Whether libvirt events are translated into qubes events (see
+        :py:meth:`register_event_handlers`)'''
+        return self._domain_event_callback_id is not None
+
     def register_event_handlers(self):
         '''Register libvirt event handlers, which will translate libvirt
         events into qubes.events. This function should be called only in
@@ -1170,13 +2271,49 @@ class Qubes(qubes.PropertyHolder):
                 libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
                 self._domain_event_callback,
                 None))
+        self._device_event_callback_ids = [
+            self.vmm.libvirt_conn.domainEventRegisterAny(
+                None,  # any domain
+                event_id,
+                self._device_event_callback,
+                None)
+            for event_id in (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED)]
+        loop = asyncio.get_event_loop()
+
+        def reconnected():
+            # this may be called from any thread; don't use cached values
+            # until they are dropped in the main one
+            self.libvirt_cache_enabled = False
+            loop.call_soon_threadsafe(self._libvirt_reconnected)
+        self.vmm.libvirt_conn.reconnect_callbacks.append(reconnected)
+        self.libvirt_cache_enabled = True
+
+    def _libvirt_reconnected(self):
+        '''Drop libvirt state cached by all domains after reconnecting to
+        libvirt, as events may have been missed meanwhile'''
+        for vm in self.domains.loaded_vms():
+            vm.invalidate_libvirt_cache()
+        self.libvirt_cache_enabled = self.libvirt_events_available
+
+    def _device_event_callback(self, _conn, domain, _device, _opaque):
+        '''Handler of device addition and removal
+        (virConnectDomainEventDeviceAddedCallback,
+        virConnectDomainEventDeviceRemovedCallback)
+        '''
+        try:
+            vm = self.domains[domain.name()]
+        except KeyError:
+            return
+        vm.invalidate_libvirt_cache()
 
     def _domain_event_callback(self, _conn, domain, event, _detail, _opaque):
         '''Generic libvirt event handler (virConnectDomainEventCallback),
         translate libvirt event into qubes.events.
         '''
-        if not self.events_enabled:
-            return
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            # also when undefined by someone else
+            self.vmm.libvirt_conn.forget_domain_lock(domain.UUID())
 
         try:
             vm = self.domains[domain.name()]
@@ -1184,6 +2321,12 @@ class Qubes(qubes.PropertyHolder):
             # ignore events for unknown domains
             return
 
+        # any lifecycle change may change both state and domain XML
+        vm.invalidate_libvirt_cache()
+
+        if not self.events_enabled:
+            return
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED:
             vm.on_libvirt_domain_stopped()
 
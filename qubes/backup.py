@@ -698,6 +698,9 @@ class Backup(object):
             raise qubes.exc.QubesException("No passphrase set")
         if not isinstance(self.passphrase, bytes):
             self.passphrase = self.passphrase.encode('utf-8')
+        # with delayed saving in qubesd, recent changes may not be in the
+        # file yet
+        self.app.flush_save()
         qubes_xml = self.app.store
         self.tmpdir = tempfile.mkdtemp()
         shutil.copy(qubes_xml, os.path.join(self.tmpdir, 'qubes.xml'))
@@ -0,0 +1,341 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Operations on many domains at once
+
+Domains are ordered by their network dependencies (a domain needs its
+``netvm`` running), domains not depending on each other are handled
+concurrently.
+'''
+
+import asyncio
+
+import qubes.config
+import qubes.exc
+
+
+class BulkOperation(object):
+    '''Base class for operations on many domains
+
+    Subclasses fill :py:attr:`order` and implement :py:meth:`run_vm`, which
+    is run concurrently for all the domains and can wait for other domains
+    using :py:meth:`wait_for`.
+
+    :param qubes.Qubes app: Qubes application object
+    :param collections.Callable notify: progress callback, called as \
+        ``notify(vm, event, **kwargs)``
+    '''
+
+    def __init__(self, app, notify=None):
+        self.app = app
+        self.notify = notify
+        #: domains to handle, in order of creating tasks
+        self.order = []
+        #: domain -> :py:class:`asyncio.Task` handling it
+        self.tasks = {}
+
+    def _notify(self, vm, event, **kwargs):
+        if self.notify is not None:
+            self.notify(vm, event, **kwargs)
+
+    @asyncio.coroutine
+    def run(self):
+        '''Handle all the domains
+
+        :return: dict of domain -> exception which prevented handling it, \
+            or :py:obj:`None` on success
+        '''
+        for vm in self.order:
+            self.tasks[vm] = asyncio.ensure_future(self.run_vm(vm))
+
+        if self.tasks:
+            try:
+                yield from asyncio.wait(list(self.tasks.values()))
+            except asyncio.CancelledError:
+                for task in self.tasks.values():
+                    task.cancel()
+                raise
+
+        return {vm: task.exception() for vm, task in self.tasks.items()}
+
+    @asyncio.coroutine
+    def wait_for(self, vms):
+        '''Wait until other domains are handled
+
+        :return: list of those domains, which failed
+        '''
+        tasks = [self.tasks[vm] for vm in vms]
+        if tasks:
+            yield from asyncio.wait(tasks)
+        return [vm for vm, task in zip(vms, tasks)
+            if task.cancelled() or task.exception()]
+
+    @asyncio.coroutine
+    def run_vm(self, vm):
+        '''Handle a single domain'''
+        raise NotImplementedError
+
+
+class StartScheduler(BulkOperation):
+    '''Start many domains, each after its network VM
+
+    Network VMs (also indirect ones) which are not running are started too,
+    even if not listed in *vms*. At most *max_concurrency* domains are
+    started at the same time.
+
+    A start which fails because qmemman cannot provide enough memory is
+    retried after another start in progress finishes; it fails only when no
+    other start was in progress meanwhile.
+
+    *notify* is called as ``notify(vm, event, **kwargs)`` on progress of each
+    domain, with *event* being one of:
+
+    - ``start-many-queued`` - the domain will be started
+    - ``start-many-starting`` - start of the domain begins
+    - ``start-many-deferred`` - not enough memory, will retry
+    - ``start-many-started`` - the domain is running
+    - ``start-many-failed`` - failed to start the domain, with ``reason``
+
+    :param qubes.Qubes app: Qubes application object
+    :param vms: domains to start
+    :param int max_concurrency: maximum number of domains started at the \
+        same time, defaults to :py:data:`qubes.config.start_many_concurrency`
+    :param collections.Callable notify: progress callback
+    '''
+
+    def __init__(self, app, vms, max_concurrency=None, notify=None):
+        super(StartScheduler, self).__init__(app, notify=notify)
+        if max_concurrency is None:
+            max_concurrency = qubes.config.start_many_concurrency
+        self.max_concurrency = max_concurrency
+
+        #: domain -> network VM which needs to be started first
+        self.dependencies = {}
+        self.order = self.resolve_dependencies(vms)
+
+        #: number of domains being started right now
+        self.starting = 0
+        self._semaphore = None
+        self._start_finished = None
+
+    def resolve_dependencies(self, vms):
+        '''Collect domains to start, with their not running network VMs
+
+        :return: list of domains, network VMs before their clients
+        '''
+        depth = {}
+        for vm in vms:
+            while vm not in depth and vm.qid != 0:
+                netvm = getattr(vm, 'netvm', None)
+                if netvm is not None and netvm.qid != 0 \
+                        and not netvm.is_running():
+                    self.dependencies[vm] = netvm
+                depth[vm] = None
+                vm = self.dependencies.get(vm, vm)
+
+        def get_depth(vm):
+            if depth[vm] is None:
+                netvm = self.dependencies.get(vm)
+                depth[vm] = 0 if netvm is None else get_depth(netvm) + 1
+            return depth[vm]
+
+        return sorted(depth, key=lambda vm: (get_depth(vm), vm.name))
+
+    @asyncio.coroutine
+    def run(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._start_finished = asyncio.Event()
+        for vm in self.order:
+            self._notify(vm, 'start-many-queued')
+        return (yield from super(StartScheduler, self).run())
+
+    @asyncio.coroutine
+    def run_vm(self, vm):
+        try:
+            netvm = self.dependencies.get(vm)
+            if netvm is not None:
+                if (yield from self.wait_for([netvm])):
+                    raise qubes.exc.QubesVMError(vm,
+                        'Network VM {} of {} failed to start'.format(
+                            netvm.name, vm.name))
+
+            while not (yield from self._try_start(vm)):
+                pass
+        except Exception as exc:
+            self._notify(vm, 'start-many-failed', reason=str(exc))
+            raise
+        self._notify(vm, 'start-many-started')
+
+    @asyncio.coroutine
+    def _try_start(self, vm):
+        '''Start the domain, if memory allows
+
+        :return: :py:obj:`False` if the start needs to be retried
+        '''
+        with (yield from self._semaphore):
+            self._notify(vm, 'start-many-starting')
+            self.starting += 1
+            start_finished = self._start_finished
+            try:
+                yield from vm.start()
+            except qubes.exc.QubesMemoryError:
+                if self.starting == 1 and not start_finished.is_set():
+                    # nothing else started or finished in the meantime
+                    self._finish_start()
+                    raise
+                # wait for some other start to finish, not this one
+                self.starting -= 1
+            except:  # pylint: disable=bare-except
+                self._finish_start()
+                raise
+            else:
+                self._finish_start()
+                return True
+
+        self._notify(vm, 'start-many-deferred')
+        yield from start_finished.wait()
+        return False
+
+    def _finish_start(self):
+        self.starting -= 1
+        self._start_finished.set()
+        self._start_finished = asyncio.Event()
+
+
+class ShutdownScheduler(BulkOperation):
+    '''Shut down many domains, each after domains connected to it
+
+    Running domains connected (also indirectly) to network VMs listed in
+    *vms* are shut down too. Domains not depending on each other are shut
+    down concurrently. A domain which does not shut down within *timeout*
+    seconds is killed.
+
+    *notify* is called as ``notify(vm, event, **kwargs)`` on progress of each
+    domain, with *event* being one of:
+
+    - ``shutdown-many-queued`` - the domain will be shut down
+    - ``shutdown-many-stopping`` - shutdown of the domain begins
+    - ``shutdown-many-killing`` - the domain did not shut down in time, it
+      will be killed
+    - ``shutdown-many-halted`` - the domain is halted
+    - ``shutdown-many-failed`` - failed to shut down the domain, with
+      ``reason``
+
+    :param qubes.Qubes app: Qubes application object
+    :param vms: domains to shut down
+    :param int timeout: time (in seconds) to wait for each domain to shut \
+        down, defaults to :py:data:`qubes.config.shutdown_many_timeout`
+    :param collections.Callable notify: progress callback
+    '''
+
+    def __init__(self, app, vms, timeout=None, notify=None):
+        super(ShutdownScheduler, self).__init__(app, notify=notify)
+        if timeout is None:
+            timeout = qubes.config.shutdown_many_timeout
+        self.timeout = timeout
+
+        #: domain -> domains connected to it, which need to be shut down
+        #: first
+        self.dependencies = {}
+        self.order = self.resolve_dependencies(vms)
+
+    def resolve_dependencies(self, vms):
+        '''Collect domains to shut down, with running domains connected to
+        them
+
+        :return: list of domains, clients before their network VMs
+        '''
+        selected = set()
+        for vm in vms:
+            if vm.qid == 0:
+                continue
+            selected.add(vm)
+            if getattr(vm, 'provides_network', False):
+                selected.update(self.app.domains.get_vms_connected_to(vm))
+        selected = set(vm for vm in selected if not vm.is_halted())
+
+        for vm in selected:
+            netvm = getattr(vm, 'netvm', None)
+            if netvm in selected:
+                self.dependencies.setdefault(netvm, set()).add(vm)
+
+        height = {}
+
+        def get_height(vm):
+            if vm not in height:
+                height[vm] = max((get_height(client) + 1
+                    for client in self.dependencies.get(vm, ())), default=0)
+            return height[vm]
+
+        return sorted(selected, key=lambda vm: (get_height(vm), vm.name))
+
+    @asyncio.coroutine
+    def run(self):
+        for vm in self.order:
+            self._notify(vm, 'shutdown-many-queued')
+        return (yield from super(ShutdownScheduler, self).run())
+
+    @asyncio.coroutine
+    def run_vm(self, vm):
+        try:
+            clients = sorted(self.dependencies.get(vm, ()),
+                key=lambda client: client.name)
+            failed = yield from self.wait_for(clients)
+            if failed:
+                raise qubes.exc.QubesVMError(vm,
+                    'Domains connected to {} failed to shut down: {}'.format(
+                        vm.name, ', '.join(client.name for client in failed)))
+
+            yield from self._shutdown(vm)
+        except Exception as exc:
+            self._notify(vm, 'shutdown-many-failed', reason=str(exc))
+            raise
+        self._notify(vm, 'shutdown-many-halted')
+
+    @asyncio.coroutine
+    def _shutdown(self, vm):
+        '''Shut down the domain and wait for it, kill it on timeout'''
+        if vm.is_halted():
+            # domain-shutdown handlers may still be running
+            try:
+                yield from vm.wait_halted(timeout=self.timeout)
+            except asyncio.TimeoutError:
+                raise qubes.exc.QubesVMError(vm,
+                    'Domain {} did not finish shutting down'.format(vm.name))
+            return
+        self._notify(vm, 'shutdown-many-stopping')
+        try:
+            yield from vm.shutdown()
+        except qubes.exc.QubesVMNotStartedError:
+            pass
+        try:
+            yield from vm.wait_halted(timeout=self.timeout)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        self._notify(vm, 'shutdown-many-killing')
+        try:
+            yield from vm.kill()
+        except qubes.exc.QubesVMNotStartedError:
+            pass
+        try:
+            yield from vm.wait_halted(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise qubes.exc.QubesVMError(vm,
+                'Domain {} did not stop after being killed'.format(vm.name))
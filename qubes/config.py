@@ -108,3 +108,50 @@ max_default_label = 8
 
 #: profiles for admin.backup.* calls
 backup_profile_dir = '/etc/qubes/backup'
+
+#: when qubesd saves :file:`qubes.xml` in background, wait for this many
+#: seconds without further changes before writing the file
+save_quiet_period = 0.2
+#: ... but never postpone writing a change for longer than this many seconds
+save_max_delay = 2.0
+
+#: qubesd stops writing events (like from ``admin.Events``) to a connection
+#: when this many bytes wait for the client to read them, and queues events
+#: instead ...
+events_write_high = 256 * 1024
+#: ... until the client reads all but this many bytes
+events_write_low = 64 * 1024
+#: maximum size (in bytes) of events queued for one connection
+events_queue_limit = 1024 * 1024
+#: what to do when the queue of events is full:
+#: ``'drop-oldest'`` - drop the oldest events;
+#: ``'coalesce'`` - keep only the newest of queued events of the same name and
+#: subject (and drop the oldest events, if that's not enough);
+#: ``'disconnect'`` - send ``connection-overflow`` event and close the
+#: connection
+events_overflow_policy = 'drop-oldest'
+
+#: resolution (in seconds) and number of slots of rings keeping VM stats
+#: history, see :py:mod:`qubes.stats`; each slot takes 18 bytes, so the
+#: default (10 minutes in 1s slots, a day in 1 minute slots and 30 days in
+#: 1 hour slots) takes about 48 KiB per VM
+stats_history_tiers = ((1, 600), (60, 1440), (3600, 720))
+
+#: number of threads making libvirt calls on behalf of qubesd coroutines (see
+#: :py:meth:`qubes.app.VirConnectWrapper.call_async`); more concurrent calls
+#: wait for a free thread
+libvirt_threads = 4
+
+#: maximum number of domains started at the same time by
+#: :py:class:`qubes.bulk.StartScheduler` (``admin.vm.StartMany``)
+start_many_concurrency = 4
+
+#: time (in seconds) :py:class:`qubes.bulk.ShutdownScheduler`
+#: (``admin.vm.ShutdownMany``) waits for each domain to shut down, before
+#: killing it
+shutdown_many_timeout = 60
+
+#: minimum time (in seconds) between full rescans of all LVM volumes (see
+#: :py:class:`qubes.storage.lvm.VolumeCache`); operations made by qubesd
+#: itself list only the volumes they changed
+lvm_cache_rescan_interval = 10
@@ -255,6 +255,7 @@ class DeviceCollection(object):
             device=device, options=device_assignment.options)
         if device_assignment.persistent:
             self._set.add(device_assignment)
+            self._vm.invalidate_xml_cache()
         yield from self._vm.fire_event_async('device-attach:' + self._bus,
             device=device, options=device_assignment.options)
 
@@ -289,6 +290,7 @@ class DeviceCollection(object):
             self._set.add(assignment)
         elif not persistent and device in self._set:
             self._set.discard(assignment)
+        self._vm.invalidate_xml_cache()
 
     @asyncio.coroutine
     def detach(self, device_assignment: DeviceAssignment):
@@ -317,6 +319,7 @@ class DeviceCollection(object):
         if device in self._set:
             device_assignment.persistent = True
             self._set.discard(device_assignment)
+            self._vm.invalidate_xml_cache()
 
         yield from self._vm.fire_event_async('device-detach:' + self._bus,
             device=device)
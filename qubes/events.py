@@ -25,6 +25,8 @@ etc.
 '''
 import asyncio
 import collections
+import contextlib
+import time
 
 import itertools
 
@@ -55,6 +57,58 @@ def handler(*events):
     return decorator
 
 
+#: incremented whenever class handlers change, to invalidate dispatch tables
+#: cached by :py:meth:`Emitter._get_class_handlers`
+_handlers_generation = 0
+
+
+#: if not :py:obj:`None`, called as ``(func, event, seconds)`` after each
+#: handler, see :py:func:`profile_handlers`
+_handler_profiler = None
+
+
+@contextlib.contextmanager
+def profile_handlers(callback):
+    '''Measure time spent in each event handler.
+
+    While the context is active, *callback* is called after each handler
+    returns, with the handler, event name and time (in seconds) as
+    arguments. For coroutine handlers only creating the coroutine is
+    measured.
+
+    :param collections.Callable callback: function to call, or \
+        :py:obj:`None` to disable profiling
+    '''
+    global _handler_profiler  # pylint: disable=global-statement
+    previous, _handler_profiler = _handler_profiler, callback
+    try:
+        yield
+    finally:
+        _handler_profiler = previous
+
+
+def invalidate_dispatch_cache():
+    '''Drop cached dispatch tables of all :py:class:`Emitter` classes.
+
+    Must be called after modifying ``__handlers__`` of a class directly (like
+    :py:class:`qubes.ext.Extension` does), otherwise the change may be missed
+    when firing events.
+    '''
+    global _handlers_generation  # pylint: disable=global-statement
+    _handlers_generation += 1
+
+
+def _sorted_handlers(handlers_dict, event):
+    '''Handlers for *event* (including catch-all ones) from one dict,
+    bound handlers first.'''
+    handlers = handlers_dict.get(event, set())
+    if '*' in handlers_dict:
+        handlers = handlers_dict['*'] | handlers
+    return tuple(sorted(handlers,
+        key=(lambda handler: hasattr(handler, 'ha_bound')),
+        reverse=True))
+
+
 def ishandler(obj):
     '''Test if a method is hooked to an event.
 
@@ -72,6 +126,8 @@ class EmitterMeta(type):
     def __init__(cls, name, bases, dict_):
         super(EmitterMeta, cls).__init__(name, bases, dict_)
         cls.__handlers__ = collections.defaultdict(set)
+        #: event -> (generation, pre-event handlers, post-event handlers)
+        cls.__dispatch__ = {}
 
         try:
             propnames = set(prop.__name__ for prop in cls.property_list())
@@ -119,6 +175,10 @@ class Emitter(object, metaclass=EmitterMeta):
 
         # pylint: disable=no-member
         self.__handlers__[event].add(func)
+        if isinstance(self, type):
+            # handlers of instances are not part of cached dispatch tables,
+            # no need to rebuild them every time some object gets one
+            invalidate_dispatch_cache()
 
     def remove_handler(self, event, func):
         '''Remove event handler from subject's class.
@@ -133,7 +193,65 @@ class Emitter(object, metaclass=EmitterMeta):
         '''
 
         # pylint: disable=no-member
-        self.__handlers__[event].remove(func)
+        handlers = self.__handlers__[event]
+        handlers.remove(func)
+        if not handlers:
+            del self.__handlers__[event]
+        if isinstance(self, type):
+            invalidate_dispatch_cache()
+
+    @classmethod
+    def _get_class_handlers(cls, event):
+        '''Handlers of *event* from the class and all its parents.
+
+        The result is cached until any handler set changes (see
+        :py:func:`invalidate_dispatch_cache`).
+
+        :returns: pair of tuples: handlers in pre-event order and handlers \
+            in normal order
+        '''
+
+        try:
+            generation, pre_handlers, handlers = cls.__dispatch__[event]
+            if generation == _handlers_generation:
+                return pre_handlers, handlers
+        except KeyError:
+            pass
+
+        per_class = []
+        for i in cls.__mro__:
+            try:
+                handlers_dict = i.__handlers__
+            except AttributeError:
+                continue
+            per_class.append(_sorted_handlers(handlers_dict, event))
+
+        pre_handlers = tuple(itertools.chain.from_iterable(per_class))
+        handlers = tuple(itertools.chain.from_iterable(reversed(per_class)))
+        cls.__dispatch__[event] = \
+            (_handlers_generation, pre_handlers, handlers)
+        return pre_handlers, handlers
+
+    def has_handlers(self, event):
+        '''Check if firing *event* would call anything.
+
+        This allows skipping costly preparation of event arguments when
+        nobody listens. Subclasses overriding :py:meth:`fire_event` are
+        assumed to always listen.
+
+        :param str event: event identifier
+        :rtype: bool
+        '''
+
+        if type(self).fire_event is not Emitter.fire_event:
+            return True
+        if not self.events_enabled:
+            return False
+        if self._get_class_handlers(event)[1]:
+            return True
+        own_handlers = self.__dict__.get('__handlers__')
+        return bool(own_handlers) and bool(
+            own_handlers.get(event) or own_handlers.get('*'))
 
     def _fire_event(self, event, kwargs, pre_event=False):
         '''Fire event for classes in given order.
@@ -144,28 +262,33 @@ class Emitter(object, metaclass=EmitterMeta):
         if not self.events_enabled:
             return [], []
 
-        order = itertools.chain((self,), self.__class__.__mro__)
-        if not pre_event:
-            order = reversed(list(order))
+        pre_handlers, handlers = self._get_class_handlers(event)
+        if pre_event:
+            handlers = pre_handlers
+
+        # instance handlers come first in the chain, before the class ones
+        own_handlers = self.__dict__.get('__handlers__')
+        if own_handlers and (event in own_handlers or '*' in own_handlers):
+            own_handlers = _sorted_handlers(own_handlers, event)
+            if pre_event:
+                handlers = own_handlers + handlers
+            else:
+                handlers = handlers + own_handlers
 
         effects = []
         async_effects = []
-        for i in order:
-            try:
-                handlers_dict = i.__handlers__
-            except AttributeError:
-                continue
-            handlers = handlers_dict.get(event, set())
-            if '*' in handlers_dict:
-                handlers = handlers_dict['*'] | handlers
-            for func in sorted(handlers,
-                    key=(lambda handler: hasattr(handler, 'ha_bound')),
-                    reverse=True):
+        profiler = _handler_profiler
+        for func in handlers:
+            if profiler is None:
                 effect = func(self, event, **kwargs)
-                if asyncio.iscoroutinefunction(func):
-                    async_effects.append(effect)
-                elif effect is not None:
-                    effects.extend(effect)
+            else:
+                start = time.perf_counter()
+                effect = func(self, event, **kwargs)
+                profiler(func, event, time.perf_counter() - start)
+            if asyncio.iscoroutinefunction(func):
+                async_effects.append(effect)
+            elif effect is not None:
+                effects.extend(effect)
         return effects, async_effects
 
     def fire_event(self, event, pre_event=False, **kwargs):
@@ -51,6 +51,8 @@ class Extension(object):
                         # pylint: disable=no-member
                         qubes.Qubes.__handlers__[event].add(attr)
 
+            qubes.events.invalidate_dispatch_cache()
+
         return cls._instance
 
 
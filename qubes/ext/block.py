@@ -21,7 +21,6 @@
 ''' Qubes block devices extensions '''
 import re
 import string
-import lxml.etree
 
 import qubes.devices
 import qubes.ext
@@ -172,7 +171,7 @@ class BlockDeviceExtension(qubes.ext.Extension):
         if not vm.is_running():
             return
 
-        xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
+        xml_desc = vm.libvirt_xml
 
         for disk in xml_desc.findall('devices/disk'):
             if disk.get('type') != 'block':
@@ -223,8 +222,7 @@ class BlockDeviceExtension(qubes.ext.Extension):
         parameter'''
         assert vm.is_running()
 
-        xml = vm.libvirt_domain.XMLDesc()
-        parsed_xml = lxml.etree.fromstring(xml)
+        parsed_xml = vm.libvirt_xml
         used = [target.get('dev', None) for target in
             parsed_xml.xpath("//domain/devices/disk/target")]
         for dev in AVAILABLE_FRONTENDS:
@@ -274,6 +272,7 @@ class BlockDeviceExtension(qubes.ext.Extension):
         vm.libvirt_domain.attachDevice(
             vm.app.env.get_template('libvirt/devices/block.xml').render(
                 device=device, vm=vm, options=options))
+        vm.invalidate_libvirt_cache()
 
     @qubes.ext.handler('device-pre-detach:block')
     def on_device_pre_detached_block(self, vm, event, device):
@@ -288,4 +287,5 @@ class BlockDeviceExtension(qubes.ext.Extension):
                 vm.libvirt_domain.detachDevice(
                     vm.app.env.get_template('libvirt/devices/block.xml').render(
                         device=device, vm=vm, options=options))
+                vm.invalidate_libvirt_cache()
                 break
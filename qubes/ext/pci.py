@@ -199,7 +199,7 @@ class PCIDeviceExtension(qubes.ext.Extension):
         # pylint: disable=unused-argument,no-self-use
         if not vm.is_running() or isinstance(vm, qubes.vm.adminvm.AdminVM):
             return
-        xml_desc = lxml.etree.fromstring(vm.libvirt_domain.XMLDesc())
+        xml_desc = vm.libvirt_xml
 
         for hostdev in xml_desc.findall('devices/hostdev'):
             if hostdev.get('type') != 'pci':
@@ -237,6 +237,7 @@ class PCIDeviceExtension(qubes.ext.Extension):
             vm.libvirt_domain.attachDevice(
                 vm.app.env.get_template('libvirt/devices/pci.xml').render(
                     device=device, vm=vm, options=options))
+            vm.invalidate_libvirt_cache()
         except subprocess.CalledProcessError as e:
             vm.log.exception('Failed to attach PCI device {!r} on the fly,'
                 ' changes will be seen after VM restart.'.format(
@@ -270,6 +271,7 @@ class PCIDeviceExtension(qubes.ext.Extension):
             vm.libvirt_domain.detachDevice(
                 vm.app.env.get_template('libvirt/devices/pci.xml').render(
                     device=device, vm=vm))
+            vm.invalidate_libvirt_cache()
         except (subprocess.CalledProcessError, libvirt.libvirtError) as e:
             vm.log.exception('Failed to detach PCI device {!r} on the fly,'
                 ' changes will be seen after VM restart.'.format(
@@ -0,0 +1,157 @@
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''History of VM statistics (CPU usage and memory)
+
+Samples are kept in fixed-size rings, one per resolution ("tier"), each
+slot holding average of samples taken in that time slot. Memory used by
+one VM is ``SLOT_SIZE`` bytes times the total number of slots in all tiers
+and does not grow over time.
+'''
+
+import array
+
+import qubes.config
+
+#: bytes used by a single slot of a ring
+SLOT_SIZE = sum(array.array(typecode).itemsize
+    for typecode in ('q', 'f', 'I', 'H'))
+
+
+class StatsRing(object):
+    '''Averaged samples of a single VM, in *length* slots of *resolution*
+    seconds each.
+
+    :param int resolution: length of a single slot, in seconds
+    :param int length: number of slots kept
+    '''
+
+    def __init__(self, resolution, length):
+        self.resolution = resolution
+        self.length = length
+        #: number of time slot (time divided by resolution) stored at each
+        #: index, -1 if empty
+        self.slots = array.array('q', [-1]) * length
+        self.cpu_usage = array.array('f', [0]) * length
+        self.memory_kb = array.array('I', [0]) * length
+        self.count = array.array('H', [0]) * length
+
+    def add(self, timestamp, cpu_usage, memory_kb):
+        '''Add a sample taken at *timestamp*'''
+        slot = int(timestamp // self.resolution)
+        i = slot % self.length
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.cpu_usage[i] = cpu_usage
+            self.memory_kb[i] = memory_kb
+            self.count[i] = 1
+            return
+        count = min(self.count[i] + 1, 0xffff)
+        self.cpu_usage[i] += (cpu_usage - self.cpu_usage[i]) / count
+        self.memory_kb[i] += int((memory_kb - self.memory_kb[i]) / count)
+        self.count[i] = count
+
+    def get(self, start=None, end=None):
+        '''Get averaged samples, ordered by time
+
+        :param int start: skip slots starting before this time
+        :param int end: skip slots starting after this time
+        :return: list of tuples ``(slot_start, cpu_usage, memory_kb)``
+        '''
+        result = []
+        for i, slot in enumerate(self.slots):
+            if slot < 0:
+                continue
+            timestamp = slot * self.resolution
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                continue
+            result.append((timestamp, self.cpu_usage[i], self.memory_kb[i]))
+        result.sort()
+        return result
+
+
+class StatsHistory(object):
+    '''History of statistics of all VMs
+
+    :param tiers: tuples ``(resolution, length)`` of rings kept for each \
+        VM, defaults to :py:data:`qubes.config.stats_history_tiers`
+    '''
+
+    def __init__(self, tiers=None):
+        if tiers is None:
+            tiers = qubes.config.stats_history_tiers
+        self.tiers = tuple(tiers)
+        #: VM name -> {resolution: :py:class:`StatsRing`}
+        self.vms = {}
+
+    @property
+    def resolutions(self):
+        return [resolution for resolution, _ in self.tiers]
+
+    def vm_memory_usage(self):
+        '''Bytes used for history of a single VM'''
+        return SLOT_SIZE * sum(length for _, length in self.tiers)
+
+    def add(self, timestamp, stats):
+        '''Record a sample
+
+        :param timestamp: time of the sample
+        :param dict stats: VM name -> dict with ``cpu_usage`` and \
+            ``memory_kb``, like :py:meth:`qubes.app.QubesHost.get_vm_stats`
+            returns for domain IDs
+        '''
+        for name, vm_info in stats.items():
+            try:
+                rings = self.vms[name]
+            except KeyError:
+                rings = self.vms[name] = {resolution:
+                    StatsRing(resolution, length)
+                    for resolution, length in self.tiers}
+            for ring in rings.values():
+                ring.add(timestamp, vm_info['cpu_usage'],
+                    vm_info['memory_kb'])
+
+    def remove(self, name):
+        '''Forget history of a VM'''
+        self.vms.pop(name, None)
+
+    def get(self, name, resolution, start=None, end=None):
+        '''Get history of a VM
+
+        :param str name: VM name
+        :param int resolution: resolution, one of :py:attr:`resolutions`
+        :param int start: start of time range
+        :param int end: end of time range
+        :return: list of tuples ``(time, cpu_usage, memory_kb)``
+        '''
+        if resolution not in self.resolutions:
+            raise KeyError(resolution)
+        if name not in self.vms:
+            return []
+        return self.vms[name][resolution].get(start, end)
+
+    def format_csv(self, name, resolution, start=None, end=None):
+        '''Get history of a VM (see :py:meth:`get`) as CSV'''
+        lines = ['time,cpu_usage,memory_kb\n']
+        for timestamp, cpu_usage, memory_kb in self.get(name, resolution,
+                start, end):
+            lines.append('{},{:.1f},{}\n'.format(
+                timestamp, cpu_usage, memory_kb))
+        return ''.join(lines)
@@ -429,6 +429,7 @@ class Storage(object):
 
         xml_string = lxml.etree.tostring(disk, encoding='utf-8')
         self.vm.libvirt_domain.attachDevice(xml_string)
+        self.vm.invalidate_libvirt_cache()
         # trigger watches to update device status
         # FIXME: this should be removed once libvirt will report such
         # events itself
@@ -437,7 +438,7 @@ class Storage(object):
 
     def _is_already_attached(self, volume):
         ''' Checks if the given volume is already attached '''
-        parsed_xml = lxml.etree.fromstring(self.vm.libvirt_domain.XMLDesc())
+        parsed_xml = self.vm.libvirt_xml
         disk_sources = parsed_xml.xpath("//domain/devices/disk/source")
         for source in disk_sources:
             if source.get('dev') == '/dev/%s' % volume.vid:
@@ -446,13 +447,14 @@ class Storage(object):
 
     def detach(self, volume):
         ''' Detach a volume from domain '''
-        parsed_xml = lxml.etree.fromstring(self.vm.libvirt_domain.XMLDesc())
+        parsed_xml = self.vm.libvirt_xml
         disks = parsed_xml.xpath("//domain/devices/disk")
         for disk in disks:
             source = disk.xpath('source')[0]
             if source.get('dev') == '/dev/%s' % volume.vid:
                 disk_xml = lxml.etree.tostring(disk, encoding='utf-8')
                 self.vm.libvirt_domain.detachDevice(disk_xml)
+                self.vm.invalidate_libvirt_cache()
                 return
         raise StoragePoolException('Volume {!r} is not attached'.format(volume))
 
@@ -499,17 +501,19 @@ class Storage(object):
         ''' Creates volumes on disk '''
         old_umask = os.umask(0o002)
 
-        coros = []
-        for volume in self.vm.volumes.values():
-            # launch the operation, if it's asynchronous, then append to wait
-            #  for them at the end
-            ret = volume.create()
-            if asyncio.iscoroutine(ret):
-                coros.append(ret)
-        if coros:
-            yield from asyncio.wait(coros)
-
-        os.umask(old_umask)
+        try:
+            coros = []
+            for volume in self.vm.volumes.values():
+                # launch the operation, if it's asynchronous, then append to
+                #  wait for them at the end
+                ret = volume.create()
+                if asyncio.iscoroutine(ret):
+                    coros.append(ret)
+            if coros:
+                done, _ = yield from asyncio.wait(coros)
+                _reraise_first(done)
+        finally:
+            os.umask(old_umask)
 
     @asyncio.coroutine
     def clone_volume(self, src_vm, name):
@@ -532,6 +536,8 @@ class Storage(object):
         # in the later case, we need to wait for them to finish
         if asyncio.iscoroutine(create_op_ret):
             yield from create_op_ret
+        # from now on, it needs to be removed if cloning fails
+        self.vm.volumes[name] = dst
 
         # Then import data from source volume
         clone_op_ret = dst.import_volume(src_volume)
@@ -540,17 +546,40 @@ class Storage(object):
         # in the later case, we need to wait for them to finish
         if asyncio.iscoroutine(clone_op_ret):
             yield from clone_op_ret
-        self.vm.volumes[name] = dst
         return self.vm.volumes[name]
 
     @asyncio.coroutine
     def clone(self, src_vm):
-        ''' Clone volumes from the specified vm '''
+        ''' Clone volumes from the specified vm
+
+        If cloning of any volume fails, volumes created so far are removed
+        and the exception is re-raised.
+        '''
 
         self.vm.volumes = {}
-        with VmCreationManager(self.vm):
-            yield from asyncio.wait([self.clone_volume(src_vm, vol_name)
-                for vol_name in self.vm.volume_config.keys()])
+        try:
+            done, _ = yield from asyncio.wait(
+                [self.clone_volume(src_vm, vol_name)
+                    for vol_name in self.vm.volume_config.keys()])
+            _reraise_first(done)
+        except:
+            yield from self._remove_cloned()
+            raise
+
+    @asyncio.coroutine
+    def _remove_cloned(self):
+        ''' Clean up after failed :py:meth:`clone`, errors are only logged '''
+        for volume in self.vm.volumes.values():
+            try:
+                ret = volume.remove()
+                if asyncio.iscoroutine(ret):
+                    yield from ret
+            except Exception:  # pylint: disable=broad-except
+                self.vm.log.exception('Failed to remove volume %s', volume)
+        try:
+            os.rmdir(self.vm.dir_path)
+        except OSError:
+            pass
 
     @property
     def outdated_volumes(self):
@@ -653,8 +682,7 @@ class Storage(object):
     @property
     def used_frontends(self):
         ''' Used device names '''
-        xml = self.vm.libvirt_domain.XMLDesc()
-        parsed_xml = lxml.etree.fromstring(xml)
+        parsed_xml = self.vm.libvirt_xml
         return set([target.get('dev', None)
                     for target in parsed_xml.xpath(
                         "//domain/devices/disk/target")])
@@ -861,25 +889,19 @@ def driver_parameters(name):
     return [p for p in params if p not in ignored_params]
 
 
-def isodate(seconds=time.time()):
-    ''' Helper method which returns an iso date '''
-    return datetime.utcfromtimestamp(seconds).isoformat("T")
+def _reraise_first(tasks):
+    ''' Re-raise exception of the first failed task of *tasks*
 
+    Exceptions of all the tasks are retrieved, so none of them is reported as
+    never retrieved.
+    '''
+    exceptions = [task.exception() for task in tasks]
+    for exc in exceptions:
+        if exc is not None:
+            raise exc
 
-class VmCreationManager(object):
-    ''' A `ContextManager` which cleans up if volume creation fails.
-    '''  # pylint: disable=too-few-public-methods
-    def __init__(self, vm):
-        self.vm = vm
 
-    def __enter__(self):
-        pass
+def isodate(seconds=time.time()):
+    ''' Helper method which returns an iso date '''
+    return datetime.utcfromtimestamp(seconds).isoformat("T")
 
-    def __exit__(self, type, value, tb):  # pylint: disable=redefined-builtin
-        if type is not None and value is not None and tb is not None:
-            for volume in self.vm.volumes.values():
-                try:
-                    volume.remove()
-                except Exception:  # pylint: disable=broad-except
-                    pass
-            os.rmdir(self.vm.dir_path)
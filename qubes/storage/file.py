@@ -228,17 +228,7 @@ class FileVolume(qubes.storage.Volume):
         with open(self.path, 'a+b') as fd:
             fd.truncate(size)
 
-        p = subprocess.Popen(['losetup', '--associated', self.path],
-                             stdout=subprocess.PIPE)
-        result = p.communicate()
-
-        m = re.match(r'^(/dev/loop\d+):\s', result[0].decode())
-        if m is not None:
-            loop_dev = m.group(1)
-
-            # resize loop device
-            subprocess.check_call(['losetup', '--set-capacity',
-                                   loop_dev])
+        resize_loop_device(self.path)
         self.size = size
 
     def commit(self):
@@ -458,6 +448,22 @@ def copy_file(source, destination):
                                                                 destination))
 
 
+def resize_loop_device(path):
+    ''' Update size of the loop device backed by *path*, if there is one,
+    after the file was resized '''
+    p = subprocess.Popen(['losetup', '--associated', path],
+                         stdout=subprocess.PIPE)
+    result = p.communicate()
+
+    m = re.match(r'^(/dev/loop\d+):\s', result[0].decode())
+    if m is not None:
+        loop_dev = m.group(1)
+
+        # resize loop device
+        subprocess.check_call(['losetup', '--set-capacity',
+                               loop_dev])
+
+
 def _remove_if_exists(path):
     ''' Removes a file if it exist, silently succeeds if file does not exist '''
     if os.path.exists(path):
@@ -19,9 +19,13 @@
 
 ''' Driver for storing vm images in a LVM thin pool '''
 
+import collections
+import collections.abc
+import functools
 import logging
 import operator
 import os
+import shlex
 import subprocess
 
 import time
@@ -29,6 +33,7 @@ import time
 import asyncio
 
 import qubes
+import qubes.config
 import qubes.storage
 import qubes.utils
 
@@ -61,6 +66,7 @@ class ThinPool(qubes.storage.Pool):
         self.log = logging.getLogger('qube.storage.lvm.%s' % self._pool_id)
 
         self._volume_objects_cache = {}
+        self._volume_locks = collections.defaultdict(asyncio.Lock)
 
     @property
     def config(self):
@@ -99,6 +105,25 @@ class ThinPool(qubes.storage.Pool):
     def setup(self):
         pass  # TODO Should we create a non existing pool?
 
+    def volume_lock(self, vid):
+        '''Lock serializing LVM operations on a volume (including its
+        snapshots and revisions)
+
+        :param str vid: volume ID
+        :rtype: asyncio.Lock
+        '''
+        return self._volume_locks[vid]
+
+    def forget_volume_lock(self, vid):
+        '''Drop the lock of a removed volume, unless it is still in use
+
+        :param str vid: volume ID
+        '''
+        lock = self._volume_locks.get(vid)
+        # pylint: disable=protected-access
+        if lock is not None and not lock.locked() and not lock._waiters:
+            del self._volume_locks[vid]
+
     def get_volume(self, vid):
         ''' Return a volume with given vid'''
         if vid in self._volume_objects_cache:
@@ -115,6 +140,8 @@ class ThinPool(qubes.storage.Pool):
 
     def list_volumes(self):
         ''' Return a list of volumes managed by this pool '''
+        # volumes may have been created or removed outside of qubesd
+        size_cache.invalidate()
         volumes = []
         for vid, vol_info in size_cache.items():
             if not vid.startswith(self.volume_group + '/'):
@@ -154,21 +181,55 @@ class ThinPool(qubes.storage.Pool):
             return 0
 
 
-def init_cache(log=logging.getLogger('qubes.storage.lvm')):
+def _get_lvs_cmdline(vids=()):
+    ''' Build command line for :program:`lvs` call listing given volumes, or
+    all of them '''
     cmd = ['lvs', '--noheadings', '-o',
            'vg_name,pool_lv,name,lv_size,data_percent,lv_attr,origin',
            '--units', 'b', '--separator', ';']
+    cmd.extend(vids)
     if os.getuid() != 0:
         cmd.insert(0, 'sudo')
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        close_fds=True)
+    return cmd
+
+
+def _loop_is_running():
+    ''' Whether called from a coroutine or callback of the event loop '''
+    try:
+        return asyncio.get_event_loop().is_running()
+    except RuntimeError:
+        # thread without an event loop
+        return False
+
+
+def init_cache(log=logging.getLogger('qubes.storage.lvm')):
+    p = subprocess.Popen(_get_lvs_cmdline(), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, close_fds=True)
     out, err = p.communicate()
-    return_code = p.returncode
+    return _parse_lvs_output(p.returncode, out, err, log)
+
+
+@asyncio.coroutine
+def init_cache_coro(log=logging.getLogger('qubes.storage.lvm')):
+    ''' Coroutine version of :py:func:`init_cache` '''
+    p = yield from asyncio.create_subprocess_exec(*_get_lvs_cmdline(),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    out, err = yield from p.communicate()
+    return _parse_lvs_output(p.returncode, out, err, log)
+
+
+def _parse_lvs_output(return_code, out, err, log):
+    ''' Parse output of :program:`lvs` into volume info dict '''
     if return_code == 0 and err:
         log.warning(err)
     elif return_code != 0:
         raise qubes.storage.StoragePoolException(err)
 
+    return _parse_lvs_lines(out)
+
+
+def _parse_lvs_lines(out):
+    ''' Parse lines printed by :program:`lvs`, ignoring its exit code '''
     result = {}
 
     for line in out.splitlines():
@@ -186,7 +247,263 @@ def init_cache(log=logging.getLogger('qubes.storage.lvm')):
     return result
 
 
-size_cache = init_cache()
+class VolumeCache(collections.abc.Mapping):
+    ''' Information about LVM volumes: volume ID -> dict with ``size``,
+    ``usage``, ``pool_lv``, ``attr`` and ``origin``
+
+    All the volumes are listed on first access (not at import time). LVM
+    operations made by qubesd itself update the affected entries in place,
+    and :py:meth:`update_coro` lists just those volumes again to get
+    accurate usage. A full rescan is made only after :py:meth:`invalidate`
+    (or when listing only some volumes failed), lazily on next access and at
+    most once per *rescan_interval* seconds - until then, the old data is
+    used. When accessed from a running event loop, the rescan is done in
+    the background (see :py:meth:`rescan_coro`) and the old data is
+    returned meanwhile, so the loop is not blocked on :program:`lvs`.
+
+    :param float rescan_interval: minimum time between full rescans, \
+        defaults to :py:data:`qubes.config.lvm_cache_rescan_interval`
+    '''
+
+    def __init__(self, rescan_interval=None):
+        if rescan_interval is None:
+            rescan_interval = qubes.config.lvm_cache_rescan_interval
+        self.rescan_interval = rescan_interval
+        #: volume ID -> info, :py:obj:`None` until listed for the first time
+        self._volumes = None
+        #: volume ID -> set of IDs of its revisions (like ``1500000000-back``)
+        self._revisions = collections.defaultdict(set)
+        self._last_rescan = None
+        self._invalidated = False
+        #: background rescan started by :py:meth:`_get_volumes`
+        self._rescan_future = None
+        #: volumes changed by qubesd, to be listed by :py:meth:`update_coro`
+        self._pending = set()
+        #: number of in-place updates so far, and volume ID -> number of its
+        #: last update; a listing started earlier must not overwrite those
+        self._generation = 0
+        self._updated_at = {}
+        #: value of :py:attr:`_generation` when the last full rescan started;
+        #: older listings are outdated as a whole
+        self._rescan_generation = 0
+
+    def __getitem__(self, vid):
+        return self._get_volumes()[vid]
+
+    def __iter__(self):
+        return iter(self._get_volumes())
+
+    def __len__(self):
+        return len(self._get_volumes())
+
+    def _get_volumes(self):
+        if self._volumes is None:
+            self.rescan()
+        elif self._invalidated and (self._last_rescan is None
+                or time.monotonic() - self._last_rescan
+                >= self.rescan_interval):
+            if _loop_is_running():
+                if self._rescan_future is None:
+                    self._rescan_future = asyncio.ensure_future(
+                        self.rescan_coro())
+                    self._rescan_future.add_done_callback(
+                        self._background_rescan_done)
+            else:
+                self.rescan()
+        return self._volumes
+
+    def _background_rescan_done(self, future):
+        self._rescan_future = None
+        if not future.cancelled() and future.exception() is not None:
+            # keep the old data, try again after rescan_interval
+            self._last_rescan = time.monotonic()
+            logging.getLogger('qubes.storage.lvm').warning(
+                'Listing volumes failed: %s', future.exception())
+
+    def invalidate(self):
+        ''' Make a full rescan on next access, if not done recently '''
+        self._invalidated = True
+
+    def rescan(self, log=logging.getLogger('qubes.storage.lvm')):
+        ''' List all the volumes now '''
+        self._set_volumes(self._generation, init_cache(log))
+
+    @asyncio.coroutine
+    def rescan_coro(self, log=logging.getLogger('qubes.storage.lvm')):
+        ''' Coroutine version of :py:meth:`rescan` '''
+        generation = self._generation
+        self._set_volumes(generation, (yield from init_cache_coro(log)))
+
+    def _set_volumes(self, generation, volumes):
+        if generation < self._rescan_generation:
+            # a newer full listing was already used
+            return
+        if self._volumes is not None:
+            # keep entries updated while the listing was in progress
+            for vid, updated_at in self._updated_at.items():
+                if updated_at <= generation:
+                    continue
+                if vid in self._volumes:
+                    volumes[vid] = self._volumes[vid]
+                else:
+                    volumes.pop(vid, None)
+        self._volumes = volumes
+        self._revisions.clear()
+        for vid in volumes:
+            self._index_revision(vid, True)
+        self._last_rescan = time.monotonic()
+        self._invalidated = False
+        # only updates made during this listing matter to later ones
+        self._rescan_generation = generation
+        self._updated_at = {vid: updated_at
+            for vid, updated_at in self._updated_at.items()
+            if updated_at > generation}
+
+    def _update(self, vid, info=None):
+        self._generation += 1
+        self._updated_at[vid] = self._generation
+        if info is None:
+            if self._volumes.pop(vid, None) is not None:
+                self._index_revision(vid, False)
+        else:
+            self._volumes[vid] = info
+            self._index_revision(vid, True)
+
+    def _index_revision(self, vid, exists):
+        ''' Add or remove *vid* in the index of revisions, if it is one '''
+        if not vid.endswith('-back'):
+            return
+        origin, _, seconds = vid[:-len('-back')].rpartition('-')
+        if not origin or not seconds.isdigit():
+            return
+        revision = seconds + '-back'
+        if exists:
+            self._revisions[origin].add(revision)
+        else:
+            revisions = self._revisions.get(origin)
+            if revisions is not None:
+                revisions.discard(revision)
+                if not revisions:
+                    del self._revisions[origin]
+
+    def get_revisions(self, vid):
+        ''' IDs of revisions of a volume (like ``1500000000-back``), without
+        going through all the volumes
+
+        :param str vid: volume ID
+        :rtype: frozenset
+        '''
+        self._get_volumes()
+        return frozenset(self._revisions.get(vid, ()))
+
+    def record_lvm_call(self, cmd, success):
+        ''' Update entries after an LVM operation (see :py:func:`qubes_lvm`)
+
+        Entries are updated with what is known without asking LVM, volumes
+        which need to be listed again are remembered for
+        :py:meth:`update_coro`.
+
+        :param list cmd: operation, as passed to :py:func:`qubes_lvm`
+        :param bool success: whether the operation succeeded
+        '''
+        if self._volumes is None:
+            # nothing listed yet, first access will list the current state
+            return
+        action = cmd[0]
+        if not success:
+            # a failed removal of a single volume did not remove anything,
+            # otherwise the volumes may differ from what qubesd knows
+            if action == 'remove' and len(cmd) == 2:
+                return
+            if action != 'remove':
+                self._pending.add(cmd[2] if action == 'clone' else cmd[1])
+            self.invalidate()
+            return
+
+        if action == 'remove':
+            for vid in cmd[1:]:
+                self._update(vid)
+                self._pending.discard(vid)
+        elif action == 'rename':
+            if cmd[1] in self._volumes:
+                self._update(cmd[2], self._volumes[cmd[1]])
+            self._update(cmd[1])
+            if cmd[1] in self._pending:
+                self._pending.discard(cmd[1])
+                self._pending.add(cmd[2])
+        elif action == 'clone':
+            # until listed again, the new volume looks like its origin
+            if cmd[1] in self._volumes:
+                self._update(cmd[2], dict(self._volumes[cmd[1]],
+                    origin=cmd[1].split('/', 1)[1], attr='Vwi-a-tz--'))
+            self._pending.add(cmd[2])
+        elif action == 'create':
+            vid = cmd[1].split('/', 1)[0] + '/' + cmd[2]
+            self._update(vid, {'size': int(cmd[3]), 'usage': 0,
+                'pool_lv': cmd[1].split('/', 1)[1], 'attr': 'Vwi-a-tz--',
+                'origin': ''})
+            self._pending.add(vid)
+        elif action == 'extend':
+            if cmd[1] in self._volumes:
+                self._update(cmd[1], dict(self._volumes[cmd[1]],
+                    size=int(cmd[2])))
+            self._pending.add(cmd[1])
+        else:
+            self._pending.add(cmd[1])
+
+    @asyncio.coroutine
+    def update_coro(self, vids=(), log=logging.getLogger('qubes.storage.lvm')):
+        ''' List volumes changed since the last call, and *vids*
+
+        Only those volumes are passed to :program:`lvs`. If that fails, a full
+        rescan is scheduled (see :py:meth:`invalidate`).
+        '''
+        vids = self._pending.union(vids)
+        self._pending.clear()
+        if self._volumes is None or not vids:
+            return
+        generation = self._generation
+        p = yield from asyncio.create_subprocess_exec(
+            *_get_lvs_cmdline(sorted(vids)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        out, err = yield from p.communicate()
+        if p.returncode != 0:
+            # some volume is gone without qubesd knowing, or lvs failed
+            log.warning('Listing volumes failed, will rescan all: %s', err)
+            self.invalidate()
+        elif err:
+            log.warning(err)
+
+        volumes = _parse_lvs_lines(out)
+        if self._volumes is None or generation < self._rescan_generation:
+            # a full rescan started later has newer data
+            return
+        for vid in vids:
+            if self._updated_at.get(vid, 0) > generation:
+                continue
+            if vid in volumes:
+                self._update(vid, volumes[vid])
+            elif p.returncode == 0:
+                self._update(vid)
+
+
+#: information about all LVM volumes, see :py:class:`VolumeCache`
+size_cache = VolumeCache()
+
+
+def locked(method):
+    '''Decorator running a coroutine method of :py:class:`ThinVolume` under
+    the volume lock (see :py:meth:`ThinPool.volume_lock`), so operations on
+    the same volume don't interleave, while other volumes are not blocked.
+    Needs to be applied after :py:func:`asyncio.coroutine`.
+    '''
+    @functools.wraps(method)
+    @asyncio.coroutine
+    def wrapper(self, *args, **kwargs):
+        with (yield from self.pool.volume_lock(self.vid)):
+            return (yield from method(self, *args, **kwargs))
+    return wrapper
+
 
 class ThinVolume(qubes.storage.Volume):
     ''' Default LVM thin volume implementation
@@ -209,14 +526,8 @@ class ThinVolume(qubes.storage.Volume):
 
     @property
     def revisions(self):
-        name_prefix = self.vid + '-'
         revisions = {}
-        for revision_vid in size_cache:
-            if not revision_vid.startswith(name_prefix):
-                continue
-            if not revision_vid.endswith('-back'):
-                continue
-            revision_vid = revision_vid[len(name_prefix):]
+        for revision_vid in size_cache.get_revisions(self.vid):
             seconds = int(revision_vid[:-len('-back')])
             iso_date = qubes.storage.isodate(seconds).split('.', 1)[0]
             revisions[revision_vid] = iso_date
@@ -234,43 +545,49 @@ class ThinVolume(qubes.storage.Volume):
         raise qubes.storage.StoragePoolException(
             "You shouldn't use lvm size setter")
 
+    @asyncio.coroutine
+    def _update_cache(self, *vids):
+        ''' Update :py:data:`size_cache` after an operation on this volume,
+        listing only changed volumes (and the pool) '''
+        # pylint: disable=protected-access
+        yield from size_cache.update_coro(vids + (self.pool._pool_id,),
+            self.log)
+
+    @asyncio.coroutine
     def _reset(self):
         ''' Resets a volatile volume '''
         assert not self.snap_on_start and not self.save_on_stop, \
             "Not a volatile volume"
         self.log.debug('Resetting volatile ' + self.vid)
-        try:
-            cmd = ['remove', self.vid]
-            qubes_lvm(cmd, self.log)
-        except qubes.storage.StoragePoolException:
-            pass
+        batch = LvmBatch(self.log)
+        batch.add(['remove', self.vid], ignore_errors=True)
         # pylint: disable=protected-access
-        cmd = ['create', self.pool._pool_id, self.vid.split('/')[1],
-               str(self.size)]
-        qubes_lvm(cmd, self.log)
+        batch.add(['create', self.pool._pool_id, self.vid.split('/')[1],
+               str(self.size)])
+        yield from batch.execute()
 
-    def _remove_revisions(self, revisions=None):
+    def _remove_revisions(self, batch, revisions=None):
         '''Remove old volume revisions.
 
         If no revisions list is given, it removes old revisions according to
-        :py:attr:`revisions_to_keep`
+        :py:attr:`revisions_to_keep`, counting in the revision added earlier
+        to the same *batch* (see :py:meth:`_commit`).
 
+        :param LvmBatch batch: batch to add the removals to
         :param revisions: list of revisions to remove
         '''
         if revisions is None:
             revisions = sorted(self.revisions.items(),
                 key=operator.itemgetter(1))
-            revisions = revisions[:-self.revisions_to_keep]
+            revisions = revisions[:max(0,
+                len(revisions) + 1 - self.revisions_to_keep)]
             revisions = [rev_id for rev_id, _ in revisions]
 
         for rev_id in revisions:
-            try:
-                cmd = ['remove', self.vid + rev_id]
-                qubes_lvm(cmd, self.log)
-            except qubes.storage.StoragePoolException:
-                pass
+            batch.add(['remove', self.vid + '-' + rev_id], ignore_errors=True)
 
-    def _commit(self):
+    def _commit(self, batch):
+        ''' Add operations committing the snapshot to *batch* '''
         msg = "Trying to commit {!s}, but it has save_on_stop == False"
         msg = msg.format(self)
         assert self.save_on_stop, msg
@@ -281,29 +598,20 @@ class ThinVolume(qubes.storage.Volume):
         assert hasattr(self, '_vid_snap')
 
         if self.revisions_to_keep > 0:
-            cmd = ['clone', self.vid,
-                '{}-{}-back'.format(self.vid, int(time.time()))]
-            qubes_lvm(cmd, self.log)
-            self._remove_revisions()
-
-        # TODO: when converting this function to coroutine, this _must_ be
-        # under a lock
-        # remove old volume only after _successful_ clone of the new one
-        cmd = ['rename', self.vid, self.vid + '-tmp']
-        qubes_lvm(cmd, self.log)
-        try:
-            cmd = ['clone', self._vid_snap, self.vid]
-            qubes_lvm(cmd, self.log)
-        except:
-            # restore original volume
-            cmd = ['rename', self.vid + '-tmp', self.vid]
-            qubes_lvm(cmd, self.log)
-            raise
-        else:
-            cmd = ['remove', self.vid + '-tmp']
-            qubes_lvm(cmd, self.log)
-
-
+            batch.add(['clone', self.vid,
+                '{}-{}-back'.format(self.vid, int(time.time()))])
+            self._remove_revisions(batch)
+
+        # remove old volume only after _successful_ clone of the new one;
+        # callers hold the volume lock, so nobody sees the volume missing
+        batch.add(['rename', self.vid, self.vid + '-tmp'])
+        # restore original volume on failure
+        batch.add(['clone', self._vid_snap, self.vid],
+            rollback=[['rename', self.vid + '-tmp', self.vid]])
+        batch.add(['remove', self.vid + '-tmp'])
+
+    @locked
+    @asyncio.coroutine
     def create(self):
         assert self.vid
         assert self.size
@@ -317,22 +625,31 @@ class ThinVolume(qubes.storage.Volume):
                     self.vid.split('/', 1)[1],
                     str(self.size)
                 ]
-            qubes_lvm(cmd, self.log)
-            reset_cache()
+            yield from qubes_lvm_coro(cmd, self.log)
+            yield from self._update_cache()
         return self
 
+    @asyncio.coroutine
     def remove(self):
+        yield from self._remove()
+        # no operations on the volume are expected anymore
+        self.pool.forget_volume_lock(self.vid)
+
+    @locked
+    @asyncio.coroutine
+    def _remove(self):
         assert self.vid
+        batch = LvmBatch(self.log)
         if self.is_dirty():
-            cmd = ['remove', self._vid_snap]
-            qubes_lvm(cmd, self.log)
+            batch.add(['remove', self._vid_snap])
 
-        self._remove_revisions(self.revisions.keys())
+        self._remove_revisions(batch, self.revisions.keys())
         if not os.path.exists(self.path):
+            yield from batch.execute()
             return
-        cmd = ['remove', self.vid]
-        qubes_lvm(cmd, self.log)
-        reset_cache()
+        batch.add(['remove', self.vid])
+        yield from batch.execute()
+        yield from self._update_cache()
         # pylint: disable=protected-access
         self.pool._volume_objects_cache.pop(self.vid, None)
 
@@ -343,6 +660,7 @@ class ThinVolume(qubes.storage.Volume):
         devpath = '/dev/' + self.vid
         return devpath
 
+    @locked
     @asyncio.coroutine
     def import_volume(self, src_volume):
         if not src_volume.save_on_stop:
@@ -353,13 +671,13 @@ class ThinVolume(qubes.storage.Volume):
         # pylint: disable=line-too-long
         if isinstance(src_volume.pool, ThinPool) and \
                 src_volume.pool.thin_pool == self.pool.thin_pool:  # NOQA
-            cmd = ['remove', self.vid]
-            qubes_lvm(cmd, self.log)
-            cmd = ['clone', str(src_volume), str(self)]
-            qubes_lvm(cmd, self.log)
+            batch = LvmBatch(self.log)
+            batch.add(['remove', self.vid])
+            batch.add(['clone', str(src_volume), str(self)])
+            yield from batch.execute()
         else:
             if src_volume.size != self.size:
-                self.resize(src_volume.size)
+                yield from self._resize(src_volume.size)
             src_path = src_volume.export()
             cmd = ['dd', 'if=' + src_path, 'of=/dev/' + self.vid,
                 'conv=sparse']
@@ -369,7 +687,8 @@ class ThinVolume(qubes.storage.Volume):
                 raise qubes.storage.StoragePoolException(
                     'Failed to import volume {!r}, dd exit code: {}'.format(
                         src_volume, p.returncode))
-            reset_cache()
+            # usage changed by writing the data
+            yield from self._update_cache(self.vid)
 
         return self
 
@@ -391,7 +710,8 @@ class ThinVolume(qubes.storage.Volume):
         return (size_cache[self._vid_snap]['origin'] !=
                self.source.vid.split('/')[1])
 
-
+    @locked
+    @asyncio.coroutine
     def revert(self, revision=None):
         if revision is None:
             revision = \
@@ -401,18 +721,24 @@ class ThinVolume(qubes.storage.Volume):
             msg = "Volume {!s} has no {!s}".format(self, old_path)
             raise qubes.storage.StoragePoolException(msg)
 
-        cmd = ['remove', self.vid]
-        qubes_lvm(cmd, self.log)
-        cmd = ['clone', self.vid + '-' + revision, self.vid]
-        qubes_lvm(cmd, self.log)
-        reset_cache()
+        batch = LvmBatch(self.log)
+        batch.add(['remove', self.vid])
+        batch.add(['clone', self.vid + '-' + revision, self.vid])
+        yield from batch.execute()
+        yield from self._update_cache()
         return self
 
+    @locked
+    @asyncio.coroutine
     def resize(self, size):
         ''' Expands volume, throws
             :py:class:`qubst.storage.qubes.storage.StoragePoolException` if
             given size is less than current_size
         '''
+        yield from self._resize(size)
+
+    @asyncio.coroutine
+    def _resize(self, size):
         if not self.rw:
             msg = 'Can not resize reađonly volume {!s}'.format(self)
             raise qubes.storage.StoragePoolException(msg)
@@ -427,50 +753,55 @@ class ThinVolume(qubes.storage.Volume):
         if size == self.size:
             return
 
-        cmd = ['extend', self.vid, str(size)]
-        qubes_lvm(cmd, self.log)
+        batch = LvmBatch(self.log)
+        batch.add(['extend', self.vid, str(size)])
         if self.is_dirty():
-            cmd = ['extend', self._vid_snap, str(size)]
-            qubes_lvm(cmd, self.log)
-        reset_cache()
+            batch.add(['extend', self._vid_snap, str(size)])
+        yield from batch.execute()
+        yield from self._update_cache()
 
+    @asyncio.coroutine
     def _snapshot(self):
-        try:
-            cmd = ['remove', self._vid_snap]
-            qubes_lvm(cmd, self.log)
-        except:  # pylint: disable=bare-except
-            pass
+        batch = LvmBatch(self.log)
+        batch.add(['remove', self._vid_snap], ignore_errors=True)
 
         if self.source is None:
-            cmd = ['clone', self.vid, self._vid_snap]
+            batch.add(['clone', self.vid, self._vid_snap])
+            yield from batch.execute()
         else:
-            cmd = ['clone', str(self.source), self._vid_snap]
-        qubes_lvm(cmd, self.log)
-
+            batch.add(['clone', str(self.source), self._vid_snap])
+            # don't let the source volume be committed in the meantime
+            with (yield from self.source.pool.volume_lock(
+                    str(self.source))):
+                yield from batch.execute()
 
+    @locked
+    @asyncio.coroutine
     def start(self):
         try:
             if self.snap_on_start or self.save_on_stop:
                 if not self.save_on_stop or not self.is_dirty():
-                    self._snapshot()
+                    yield from self._snapshot()
             else:
-                self._reset()
+                yield from self._reset()
         finally:
-            reset_cache()
+            yield from self._update_cache()
         return self
 
+    @locked
+    @asyncio.coroutine
     def stop(self):
+        batch = LvmBatch(self.log)
         try:
             if self.save_on_stop:
-                self._commit()
+                self._commit(batch)
             if self.snap_on_start or self.save_on_stop:
-                cmd = ['remove', self._vid_snap]
-                qubes_lvm(cmd, self.log)
+                batch.add(['remove', self._vid_snap])
             else:
-                cmd = ['remove', self.vid]
-                qubes_lvm(cmd, self.log)
+                batch.add(['remove', self.vid])
+            yield from batch.execute()
         finally:
-            reset_cache()
+            yield from self._update_cache()
         return self
 
     def verify(self):
@@ -521,11 +852,11 @@ def pool_exists(pool_id):
         return False
 
 
-def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
-    ''' Call :program:`lvm` to execute an LVM operation '''
+def _get_lvm_cmdline(cmd):
+    ''' Build command line for :program:`lvm` call '''
     action = cmd[0]
     if action == 'remove':
-        lvm_cmd = ['lvremove', '-f', cmd[1]]
+        lvm_cmd = ['lvremove', '-f'] + cmd[1:]
     elif action == 'clone':
         lvm_cmd = ['lvcreate', '-kn', '-ay', '-s', cmd[1], '-n', cmd[2]]
     elif action == 'create':
@@ -547,19 +878,136 @@ def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
         cmd = ['sudo', 'lvm'] + lvm_cmd
     else:
         cmd = ['lvm'] + lvm_cmd
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        close_fds=True)
-    out, err = p.communicate()
-    return_code = p.returncode
-    if out:
-        log.debug(out)
-    if return_code == 0 and err:
-        log.warning(err)
-    elif return_code != 0:
-        assert err, "Command exited unsuccessful, but printed nothing to stderr"
-        raise qubes.storage.StoragePoolException(err)
+    return cmd
+
+
+def _process_lvm_output(returncode, stdout, stderr, log):
+    ''' Process output of :program:`lvm`, raise an exception on failure '''
+    if stdout:
+        log.debug(stdout)
+    if returncode == 0 and stderr:
+        log.warning(stderr)
+    elif returncode != 0:
+        assert stderr, \
+            "Command exited unsuccessful, but printed nothing to stderr"
+        raise qubes.storage.StoragePoolException(stderr)
     return True
 
 
+def qubes_lvm(cmd, log=logging.getLogger('qubes.storage.lvm')):
+    ''' Call :program:`lvm` to execute an LVM operation '''
+    p = subprocess.Popen(_get_lvm_cmdline(cmd), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, close_fds=True)
+    out, err = p.communicate()
+    size_cache.record_lvm_call(cmd, p.returncode == 0)
+    return _process_lvm_output(p.returncode, out, err, log)
+
+
+@asyncio.coroutine
+def qubes_lvm_coro(cmd, log=logging.getLogger('qubes.storage.lvm')):
+    ''' Call :program:`lvm` to execute an LVM operation
+
+    Coroutine version of :py:func:`qubes_lvm`, not blocking the event loop
+    while :program:`lvm` runs.
+    '''
+    p = yield from asyncio.create_subprocess_exec(*_get_lvm_cmdline(cmd),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+    out, err = yield from p.communicate()
+    size_cache.record_lvm_call(cmd, p.returncode == 0)
+    return _process_lvm_output(p.returncode, out, err, log)
+
+
+class LvmBatch(object):
+    ''' LVM operations executed in order, in a single shell session
+
+    Operations are given as for :py:func:`qubes_lvm`. Execution stops at the
+    first failed operation (unless added with *ignore_errors*), then its
+    *rollback* operations are executed and
+    :py:class:`qubes.storage.StoragePoolException` is raised. Consecutive
+    removals are merged into a single :program:`lvremove` call.
+
+    This spawns one process instead of one for each operation, and the
+    caller waits for all of them at once.
+    '''
+
+    #: prefix of lines with exit code of each operation, printed by the script
+    status_prefix = b'qubes-lvm-status '
+
+    def __init__(self, log=logging.getLogger('qubes.storage.lvm')):
+        self.log = log
+        #: list of tuples ``(cmd, ignore_errors, rollback)``
+        self.steps = []
+
+    def add(self, cmd, ignore_errors=False, rollback=()):
+        ''' Add an operation
+
+        :param list cmd: operation, as for :py:func:`qubes_lvm`
+        :param bool ignore_errors: continue if the operation fails
+        :param list rollback: operations to execute if this one fails
+        '''
+        if self.steps and cmd[0] == 'remove' and not rollback:
+            last_cmd, last_ignore_errors, last_rollback = self.steps[-1]
+            if last_cmd[0] == 'remove' and not last_rollback \
+                    and last_ignore_errors == ignore_errors:
+                last_cmd.extend(cmd[1:])
+                return
+        self.steps.append((list(cmd), ignore_errors, list(rollback)))
+
+    def get_script(self):
+        ''' Shell script executing the operations '''
+        lines = []
+        for cmd, ignore_errors, _ in self.steps:
+            line = ' '.join(shlex.quote(arg) for arg in _get_lvm_cmdline(cmd))
+            if ignore_errors:
+                # like for failed qubes_lvm() calls, which were ignored
+                line += ' 2>/dev/null'
+            lines.append(line)
+            lines.append('status=$?; echo {}$status'.format(
+                self.status_prefix.decode()))
+            if not ignore_errors:
+                lines.append('[ $status -eq 0 ] || exit 1')
+        return '\n'.join(lines) + '\n'
+
+    @asyncio.coroutine
+    def execute(self):
+        ''' Execute the operations '''
+        if not self.steps:
+            return
+        p = yield from asyncio.create_subprocess_exec(
+            'sh', '-c', self.get_script(),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
+        out, err = yield from p.communicate()
+
+        statuses = []
+        for line in out.splitlines():
+            if line.startswith(self.status_prefix):
+                statuses.append(int(line[len(self.status_prefix):]))
+            elif line.strip():
+                self.log.debug(line)
+        for (cmd, _, _), status in zip(self.steps, statuses):
+            size_cache.record_lvm_call(cmd, status == 0)
+
+        if p.returncode == 0 and len(statuses) == len(self.steps):
+            if err:
+                self.log.warning(err)
+            return
+
+        if statuses and statuses[-1] != 0:
+            for cmd in self.steps[len(statuses) - 1][2]:
+                try:
+                    yield from qubes_lvm_coro(cmd, self.log)
+                except qubes.storage.StoragePoolException as e:
+                    self.log.error('Rollback failed: %s', e)
+        raise qubes.storage.StoragePoolException(
+            err or 'LVM operations failed')
+
+
 def reset_cache():
-    qubes.storage.lvm.size_cache = init_cache()
+    ''' List all the volumes again, see :py:meth:`VolumeCache.rescan` '''
+    size_cache.rescan()
+
+
+@asyncio.coroutine
+def reset_cache_coro():
+    ''' Coroutine version of :py:func:`reset_cache` '''
+    yield from size_cache.rescan_coro()
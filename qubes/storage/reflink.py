@@ -0,0 +1,467 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' Driver for storing vm images as files, copied with reflinks
+
+Unlike :py:mod:`qubes.storage.file`, no device-mapper snapshots are used.
+Snapshots and revisions are reflinked copies (``FICLONE`` ioctl) of image
+files, sharing data blocks until either copy is written to. Taking them
+takes constant time on filesystems supporting it, like btrfs or XFS (with
+``reflink=1``).
+
+Files of a volume with ``vid`` ``vm/private``:
+
+- ``vm/private.img`` - the volume data, as of the last commit
+- ``vm/private-dirty.img`` - the data used while the domain is running
+  (for volumes with :py:attr:`~qubes.storage.Volume.snap_on_start` or
+  :py:attr:`~qubes.storage.Volume.save_on_stop`), replaces ``private.img``
+  on commit
+- ``vm/private-<seconds>-back.img`` - old revisions, named after the time of
+  the commit (or a later second, if a revision of that time exists already)
+- ``vm/private-import.img`` - data being imported
+'''
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import time
+
+import qubes.storage
+import qubes.storage.file
+
+#: ``FICLONE`` ioctl number, ``_IOW(0x94, 9, int)``
+FICLONE = 0x40049409
+
+#: errors of ``FICLONE`` meaning the filesystem does not support it
+REFLINK_UNSUPPORTED_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+    errno.EINVAL, errno.ENOSYS)
+
+#: extended attribute of a snapshot (``-dirty`` image), holding the inode of
+#: the image it was taken from
+SOURCE_INODE_XATTR = 'user.qubes.source-inode'
+
+
+class ReflinkPool(qubes.storage.Pool):
+    ''' File based pool, using reflinks for snapshots and revisions
+
+    :param str dir_path: directory for the images, on a filesystem supporting
+        reflinks
+    :param bool setup_check: when adding the pool, refuse *dir_path* not
+        supporting reflinks; if disabled, images are copied there instead
+        (slow, but useful for example on tmpfs)
+    '''  # pylint: disable=protected-access
+    driver = 'file-reflink'
+
+    def __init__(self, dir_path, setup_check=True, revisions_to_keep=1,
+            **kwargs):
+        super(ReflinkPool, self).__init__(revisions_to_keep=revisions_to_keep,
+            **kwargs)
+        assert dir_path, "No pool dir_path specified"
+        self.dir_path = os.path.normpath(dir_path)
+        self.setup_check = str(setup_check).lower() in ('true', '1', 'yes')
+        self.log = logging.getLogger('qubes.storage.reflink.%s' % self.name)
+        self._volume_objects_cache = {}
+
+    @property
+    def config(self):
+        return {
+            'name': self.name,
+            'dir_path': self.dir_path,
+            'driver': ReflinkPool.driver,
+            'revisions_to_keep': self.revisions_to_keep
+        }
+
+    def destroy(self):
+        pass
+
+    def setup(self):
+        qubes.storage.file.create_dir_if_not_exists(self.dir_path)
+        if self.setup_check and not is_reflink_supported(self.dir_path):
+            raise qubes.storage.StoragePoolException(
+                'Filesystem of {} does not support reflinks, use a btrfs or '
+                'XFS one, or set setup_check=False to copy the images '
+                'instead'.format(self.dir_path))
+
+    def init_volume(self, vm, volume_config):
+        if 'vid' not in volume_config:
+            volume_config['vid'] = os.path.join(vm.name,
+                volume_config['name'])
+
+        if not volume_config.get('save_on_stop', False):
+            volume_config['revisions_to_keep'] = 0
+        elif 'revisions_to_keep' not in volume_config:
+            volume_config['revisions_to_keep'] = self.revisions_to_keep
+
+        volume_config['pool'] = self
+        volume = ReflinkVolume(**volume_config)
+        self._volume_objects_cache[volume.vid] = volume
+        return volume
+
+    def get_volume(self, vid):
+        if vid in self._volume_objects_cache:
+            return self._volume_objects_cache[vid]
+        if not os.path.exists(os.path.join(self.dir_path, vid + '.img')):
+            raise KeyError(vid)
+        # don't cache this object, as it doesn't carry full configuration
+        return ReflinkVolume(pool=self, vid=vid, name=vid, rw=True,
+            save_on_stop=True)
+
+    def list_volumes(self):
+        volumes = []
+        for path in sorted(glob.glob(os.path.join(self.dir_path, '*',
+                '*.img'))):
+            vid = os.path.relpath(path, self.dir_path)[:-len('.img')]
+            if _parse_revision(vid) is not None \
+                    or vid.endswith(('-dirty', '-import')):
+                # implementation detail files
+                continue
+            volumes.append(self.get_volume(vid))
+        return volumes
+
+    @property
+    def size(self):
+        statvfs = os.statvfs(self.dir_path)
+        return statvfs.f_frsize * statvfs.f_blocks
+
+    @property
+    def usage(self):
+        statvfs = os.statvfs(self.dir_path)
+        return statvfs.f_frsize * (statvfs.f_blocks - statvfs.f_bfree)
+
+
+class ReflinkVolume(qubes.storage.Volume):
+    ''' Volume stored in image files of :py:class:`ReflinkPool` '''
+
+    def __init__(self, **kwargs):
+        super(ReflinkVolume, self).__init__(**kwargs)
+        self.log = self.pool.log
+        #: inode of the source image the running snapshot was taken from,
+        #: for filesystems not supporting :py:data:`SOURCE_INODE_XATTR`
+        self._source_inode = None
+
+    def _path(self, suffix=''):
+        return os.path.join(self.pool.dir_path, self.vid + suffix + '.img')
+
+    @property
+    def path(self):
+        ''' The committed image '''
+        return self._path()
+
+    @property
+    def path_dirty(self):
+        ''' Image used while the domain is running '''
+        return self._path('-dirty')
+
+    @property
+    def path_import(self):
+        ''' Image the data is imported into '''
+        return self._path('-import')
+
+    def _path_revision(self, revision):
+        return self._path('-' + revision)
+
+    def create(self):
+        assert isinstance(self.size, int) and self.size > 0, \
+            'Volume size must be > 0'
+        if self.save_on_stop:
+            qubes.storage.file.create_sparse_file(self.path, self.size)
+        return self
+
+    def remove(self):
+        for revision in self.revisions:
+            _remove_if_exists(self._path_revision(revision))
+        for path in (self.path_dirty, self.path_import, self.path):
+            _remove_if_exists(path)
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+    def is_dirty(self):
+        return self.save_on_stop and os.path.exists(self.path_dirty)
+
+    def is_outdated(self):
+        if not self.snap_on_start:
+            return False
+        try:
+            source_inode = int(os.getxattr(self.path_dirty,
+                SOURCE_INODE_XATTR))
+        except FileNotFoundError:
+            # not started
+            return False
+        except OSError:
+            # xattrs not supported, or the image taken by an older version
+            source_inode = self._source_inode
+        if source_inode is None:
+            return False
+        try:
+            return os.stat(self.source.path).st_ino != source_inode
+        except FileNotFoundError:
+            return True
+
+    def start(self):
+        if not self.snap_on_start and not self.save_on_stop:
+            _remove_if_exists(self.path)
+            qubes.storage.file.create_sparse_file(self.path, self.size)
+            return self
+
+        if self.is_dirty():
+            # not committed, after unclean shutdown - use the data
+            return self
+
+        source_path = self.source.path if self.snap_on_start else self.path
+        _check_path(source_path)
+        self._source_inode = os.stat(source_path).st_ino
+        copy_file(source_path, self.path_dirty)
+        try:
+            # remembered across restarts of qubesd, see is_outdated()
+            os.setxattr(self.path_dirty, SOURCE_INODE_XATTR,
+                str(self._source_inode).encode())
+        except OSError as e:
+            self.log.debug('failed to set %s on %s: %s', SOURCE_INODE_XATTR,
+                self.path_dirty, e)
+        if os.path.getsize(self.path_dirty) < self.size:
+            with open(self.path_dirty, 'r+b') as image:
+                image.truncate(self.size)
+        return self
+
+    def stop(self):
+        if self.save_on_stop:
+            if os.path.exists(self.path_dirty):
+                self._commit()
+        elif self.snap_on_start:
+            _remove_if_exists(self.path_dirty)
+        else:
+            _remove_if_exists(self.path)
+        self._source_inode = None
+        return self
+
+    def _commit(self):
+        ''' Replace the committed image with the dirty one, keeping the
+        previous one as a revision '''
+        msg = 'Tried to commit a non commitable volume {!r}'.format(self)
+        assert self.save_on_stop and self.rw, msg
+
+        _fsync(self.path_dirty)
+        revision_path = None
+        if self.revisions_to_keep > 0 and os.path.exists(self.path):
+            # never overwrite a revision committed within the same second
+            seconds = max([int(time.time())] + [_parse_revision(revision) + 1
+                for revision in self.revisions])
+            revision_path = self._path_revision('{}-back'.format(seconds))
+            os.rename(self.path, revision_path)
+        try:
+            os.rename(self.path_dirty, self.path)
+        except:
+            if revision_path is not None:
+                # restore the previous image
+                os.rename(revision_path, self.path)
+            raise
+        _fsync(os.path.dirname(self.path))
+        self._remove_revisions()
+
+    def _remove_revisions(self):
+        ''' Remove revisions above :py:attr:`revisions_to_keep` '''
+        revisions = sorted(self.revisions, key=_parse_revision)
+        for revision in revisions[:max(0,
+                len(revisions) - self.revisions_to_keep)]:
+            _remove_if_exists(self._path_revision(revision))
+
+    @property
+    def revisions(self):
+        revisions = {}
+        for path in glob.glob(self._path('-*-back')):
+            vid = os.path.relpath(path, self.pool.dir_path)[:-len('.img')]
+            seconds = _parse_revision(vid)
+            if seconds is None or not vid.startswith(self.vid + '-'):
+                continue
+            iso_date = qubes.storage.isodate(seconds).split('.', 1)[0]
+            revisions[vid[len(self.vid) + 1:]] = iso_date
+        return revisions
+
+    def revert(self, revision=None):
+        if revision is None:
+            revisions = self.revisions
+            if not revisions:
+                raise qubes.storage.StoragePoolException(
+                    'Volume {!s} has no revisions'.format(self))
+            revision = max(revisions.items(), key=lambda item: item[1])[0]
+        revision_path = self._path_revision(revision)
+        if not os.path.exists(revision_path):
+            raise qubes.storage.StoragePoolException(
+                'Volume {!s} has no {!s}'.format(self, revision_path))
+        copy_file(revision_path, self.path)
+        return self
+
+    def resize(self, size):
+        ''' Expands volume, throws
+            :py:class:`qubes.storage.StoragePoolException` if
+            given size is less than current_size
+        '''
+        if not self.rw:
+            msg = 'Can not resize reađonly volume {!s}'.format(self)
+            raise qubes.storage.StoragePoolException(msg)
+
+        if size < self.size:
+            raise qubes.storage.StoragePoolException(
+                'For your own safety, shrinking of %s is'
+                ' disabled. If you really know what you'
+                ' are doing, use `truncate` on %s manually.' %
+                (self.name, self.vid))
+
+        for path in (self.path, self.path_dirty):
+            if os.path.exists(path):
+                with open(path, 'r+b') as image:
+                    image.truncate(size)
+        if os.path.exists(self.path_dirty):
+            qubes.storage.file.resize_loop_device(self.path_dirty)
+        self.size = size
+
+    def export(self):
+        if self.snap_on_start and not self.save_on_stop:
+            return self.source.path
+        return self.path
+
+    def import_data(self):
+        _remove_if_exists(self.path_import)
+        qubes.storage.file.create_sparse_file(self.path_import, self.size)
+        return self.path_import
+
+    def import_data_end(self, success):
+        if success:
+            _fsync(self.path_import)
+            os.replace(self.path_import, self.path)
+        else:
+            _remove_if_exists(self.path_import)
+
+    def import_volume(self, src_volume):
+        if self.save_on_stop:
+            copy_file(src_volume.export(), self.path)
+        return self
+
+    def verify(self):
+        ''' Verifies the volume. '''
+        if self.snap_on_start:
+            _check_path(self.source.path)
+        elif self.save_on_stop:
+            _check_path(self.path)
+        return True
+
+    def block_device(self):
+        ''' Return :py:class:`qubes.storage.BlockDevice` for serialization in
+            the libvirt XML template as <disk>.
+        '''
+        if self.snap_on_start or self.save_on_stop:
+            return qubes.storage.BlockDevice(self.path_dirty, self.name,
+                self.script, self.rw, self.domain, self.devtype)
+        return super(ReflinkVolume, self).block_device()
+
+    @property
+    def usage(self):
+        ''' Returns the actualy used space '''
+        return sum(qubes.storage.file.get_disk_usage(path)
+            for path in (self.path, self.path_dirty))
+
+
+def reflink(source, destination):
+    ''' Create *destination* file sharing data blocks with *source*
+
+    :raise OSError: with one of :py:data:`REFLINK_UNSUPPORTED_ERRORS` if the
+        filesystem does not support it
+    '''
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE,
+                source_file.fileno())
+
+
+def copy_file(source, destination):
+    ''' Atomically replace *destination* with a copy of *source*
+
+    The copy is a reflink if the filesystem supports it, otherwise data is
+    copied with :py:func:`qubes.storage.file.copy_file`.
+    '''
+    tmp_path = destination + '.tmp'
+    _remove_if_exists(tmp_path)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        try:
+            reflink(source, tmp_path)
+        except OSError as e:
+            if e.errno not in REFLINK_UNSUPPORTED_ERRORS:
+                raise
+            _remove_if_exists(tmp_path)
+            qubes.storage.file.copy_file(source, tmp_path)
+        os.replace(tmp_path, destination)
+    except:
+        _remove_if_exists(tmp_path)
+        raise
+
+
+def is_reflink_supported(dir_path):
+    ''' Check whether the filesystem of *dir_path* supports reflinks '''
+    source = os.path.join(dir_path, '.reflink-check')
+    destination = source + '-copy'
+    try:
+        with open(source, 'wb') as source_file:
+            source_file.write(b'\0')
+        reflink(source, destination)
+    except OSError as e:
+        if e.errno not in REFLINK_UNSUPPORTED_ERRORS:
+            raise
+        return False
+    finally:
+        _remove_if_exists(source)
+        _remove_if_exists(destination)
+    return True
+
+
+def _parse_revision(vid):
+    ''' Time of creation of a revision with given volume (or revision) ID,
+    or :py:obj:`None` if it isn't one '''
+    if not vid.endswith('-back'):
+        return None
+    seconds = vid[:-len('-back')].rpartition('-')[2]
+    if not seconds.isdigit():
+        return None
+    return int(seconds)
+
+
+def _fsync(path):
+    ''' Flush *path* (a file or a directory) to disk '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove_if_exists(path):
+    ''' Removes a file if it exist, silently succeeds if file does not exist '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _check_path(path):
+    ''' Raise an StoragePoolException if ``path`` does not exist'''
+    if not os.path.exists(path):
+        msg = 'Missing image file: %s' % path
+        raise qubes.storage.StoragePoolException(msg)
@@ -33,6 +33,7 @@
 import asyncio
 import collections
 import functools
+import json
 import logging
 import os
 import pathlib
@@ -42,6 +43,7 @@ import subprocess
 import sys
 import tempfile
 import time
+import timeit
 import traceback
 import unittest
 import warnings
@@ -69,6 +71,10 @@ TEMPLATE = 'fedora-23'
 VMPREFIX = 'test-inst-'
 CLSVMPREFIX = 'test-cls-'
 
+#: how much slower than the baseline a benchmark may get,
+#: see :py:meth:`QubesTestCase.benchmark`
+BENCHMARK_TOLERANCE = 1.5
+
 
 if 'DEFAULT_LVM_POOL' in os.environ.keys():
     DEFAULT_LVM_POOL = os.environ['DEFAULT_LVM_POOL']
@@ -598,6 +604,56 @@ class QubesTestCase(unittest.TestCase):
         except AssertionError as e:
             self.fail(str(e))
 
+    def benchmark(self, label, func, number=1000, repeat=3):
+        '''Measure and report time of a single call of *func*.
+
+        This is meant for microbenchmarks, which should be decorated with
+        ``@skipUnlessEnv('QUBES_TEST_BENCHMARK')``, so they are not run
+        unless explicitly requested. The result is written both to the test
+        log and to standard error.
+
+        To track regressions, set ``QUBES_TEST_BENCHMARK_RESULTS`` to a path
+        of JSON file, where results will be stored. Such file may be then
+        given in ``QUBES_TEST_BENCHMARK_BASELINE`` of a later run; the test
+        fails if a measurement is more than :py:data:`BENCHMARK_TOLERANCE`
+        times slower than in the baseline.
+
+        :param str label: description of what is measured
+        :param collections.Callable func: function to call, without arguments
+        :param int number: number of calls in one measurement
+        :param int repeat: number of measurements, the best one is reported
+        :return: time of a single call, in seconds
+        '''
+
+        elapsed = min(timeit.repeat(func, number=number, repeat=repeat)) \
+            / number
+        msg = 'benchmark {}: {:.3f} us per call'.format(label, elapsed * 1e6)
+        self.log.info(msg)
+        sys.stderr.write(msg + '\n')
+
+        key = '{}: {}'.format(self.id(), label)
+        results_path = os.getenv('QUBES_TEST_BENCHMARK_RESULTS')
+        if results_path:
+            try:
+                with open(results_path) as results_file:
+                    results = json.load(results_file)
+            except FileNotFoundError:
+                results = {}
+            results[key] = elapsed
+            with open(results_path, 'w') as results_file:
+                json.dump(results, results_file, indent=1, sort_keys=True)
+
+        baseline_path = os.getenv('QUBES_TEST_BENCHMARK_BASELINE')
+        if baseline_path:
+            with open(baseline_path) as baseline_file:
+                baseline = json.load(baseline_file).get(key)
+            if baseline is not None:
+                self.assertLess(elapsed, baseline * BENCHMARK_TOLERANCE,
+                    'benchmark {} regressed: {:.3f} us per call, was '
+                    '{:.3f} us'.format(label, elapsed * 1e6, baseline * 1e6))
+
+        return elapsed
+
     @staticmethod
     def make_vm_name(name, class_teardown=False):
         if class_teardown:
@@ -606,6 +662,41 @@ class QubesTestCase(unittest.TestCase):
             return VMPREFIX + name
 
 
+class PoolTestCase(QubesTestCase):
+    '''Base class for unit tests of a storage pool driver.
+
+    The test case sets up :py:attr:`pool` in :py:meth:`setUp`, and then gets
+    its volumes with :py:meth:`get_volume`.
+    '''
+
+    class TestVM(object):
+        '''Domain stub, as much as :py:meth:`qubes.storage.Pool.init_volume`
+        needs'''
+        # pylint: disable=too-few-public-methods
+        def __init__(self, name):
+            self.name = name
+
+    #: default configuration of volumes returned by :py:meth:`get_volume`
+    volume_config = {
+        'name': 'private',
+        'rw': True,
+        'save_on_stop': True,
+        'size': 1024 ** 3,
+    }
+
+    def setUp(self):
+        super(PoolTestCase, self).setUp()
+        #: pool under test, set up by the subclass
+        self.pool = None
+
+    def get_volume(self, vm_name, **kwargs):
+        '''Initialise a volume of :py:attr:`pool` for domain *vm_name*,
+        with :py:attr:`volume_config` updated by *kwargs*'''
+        config = dict(self.volume_config, pool=self.pool)
+        config.update(kwargs)
+        return self.pool.init_volume(self.TestVM(vm_name), config)
+
+
 class SystemTestCase(QubesTestCase):
     """
     Mixin for integration tests. All the tests here should use self.app
@@ -1127,6 +1218,7 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.storage',
             'qubes.tests.storage_file',
             'qubes.tests.storage_lvm',
+            'qubes.tests.storage_reflink',
             'qubes.tests.storage_kernels',
             'qubes.tests.ext',
             'qubes.tests.vm.qubesvm',
@@ -1136,6 +1228,8 @@ def load_tests(loader, tests, pattern): # pylint: disable=unused-argument
             'qubes.tests.vm.dispvm',
             'qubes.tests.app',
             'qubes.tests.tarwriter',
+            'qubes.tests.stats',
+            'qubes.tests.bulk',
             'qubes.tests.api',
             'qubes.tests.api_admin',
             'qubes.tests.api_misc',
@@ -92,6 +92,45 @@ class TestMgmt(object):
         except asyncio.CancelledError:
             pass
 
+class DummyAPI(qubes.api.AbstractQubesAPI):
+    @qubes.api.method('dummy.Simple', no_payload=True)
+    @asyncio.coroutine
+    def simple(self):
+        return 'simple'
+
+    @qubes.api.method('dummy.Endpoint.{endpoint}', no_payload=True,
+        endpoints=('a', 'b'))
+    @asyncio.coroutine
+    def with_endpoint(self, endpoint):
+        return endpoint
+
+    @qubes.api.method('dummy.Write', no_payload=True, write=True)
+    @asyncio.coroutine
+    def write(self):
+        self.app.save()
+        return 'written'
+
+
+class ExtendedDummyAPI(DummyAPI):
+    @qubes.api.method('dummy.Extended', no_payload=True)
+    @asyncio.coroutine
+    def extended(self):
+        return 'extended'
+
+
+def make_api_class(count):
+    '''Create API class with *count* methods'''
+    attrs = {}
+    for i in range(count):
+        @qubes.api.method('dummy.Method{}'.format(i), no_payload=True)
+        @asyncio.coroutine
+        def func(self):
+            pass
+        attrs['method{}'.format(i)] = func
+    return type('DummyAPI{}'.format(count), (qubes.api.AbstractQubesAPI,),
+        attrs)
+
+
 class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
     def setUp(self):
         super(TC_00_QubesDaemonProtocol, self).setUp()
@@ -109,6 +148,10 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
             connect_coro)
 
     def tearDown(self):
+        # framed connections are not closed by the tests themselves
+        self.transport.close()
+        self.writer.close()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
         self.sock_server.close()
         self.sock_client.close()
         super(TC_00_QubesDaemonProtocol, self).tearDown()
@@ -170,3 +213,338 @@ class TC_00_QubesDaemonProtocol(qubes.tests.QubesTestCase):
         with self.assertNotRaises(asyncio.TimeoutError):
             self.loop.run_until_complete(
                 asyncio.wait_for(self.protocol.mgmt.task, 1))
+
+    def send_frame(self, request_id, data):
+        self.writer.write(qubes.api.QubesDaemonProtocol.frame_header.pack(
+            request_id, len(data)) + data)
+
+    def read_frame(self):
+        header = qubes.api.QubesDaemonProtocol.frame_header
+        with self.assertNotRaises(asyncio.TimeoutError):
+            request_id, length = header.unpack(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.readexactly(header.size), 1)))
+            data = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.readexactly(length), 1))
+        return request_id, data
+
+    def test_010_framed_pipelined(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        self.send_frame(1, b'dom0\0mgmt.success\0dom0\0arg1\0payload1')
+        self.send_frame(2, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.send_frame(3, b'dom0\0mgmt.success\0dom0\0arg3\0payload3')
+        responses = dict(self.read_frame() for _ in range(3))
+        self.assertEqual(responses, {
+            1: b"0\0src: b'dom0', dest: b'dom0', arg: b'arg1', "
+                b"payload: b'payload1'",
+            2: b"0\0",
+            3: b"0\0src: b'dom0', dest: b'dom0', arg: b'arg3', "
+                b"payload: b'payload3'",
+        })
+
+        # request id can be reused after the request is finished
+        self.send_frame(1, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.assertEqual(self.read_frame(), (1, b"0\0"))
+
+        # connection is closed after EOF, once everything is answered
+        self.writer.write_eof()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), b'')
+
+    def test_011_framed_in_parts(self):
+        preamble = qubes.api.QubesDaemonProtocol.framed_preamble
+        request = qubes.api.QubesDaemonProtocol.frame_header.pack(
+            5, 32) + b'dom0\0mgmt.success_none\0dom0\0arg\0'
+        data = preamble + request
+        for i in range(0, len(data), 3):
+            self.writer.write(data[i:i+3])
+            self.loop.run_until_complete(self.writer.drain())
+            self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertTrue(self.protocol.framed)
+        self.assertEqual(self.read_frame(), (5, b"0\0"))
+
+    def test_012_framed_errors(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        self.send_frame(1, b'dom0\0mgmt.qubesexception\0dom0\0arg\0payload')
+        self.assertEqual(self.read_frame(),
+            (1, b"2\0QubesException\0\0qubes-exception\0"))
+        self.send_frame(2, b'dom0\0mgmt.exception\0dom0\0arg\0payload')
+        self.assertEqual(self.read_frame(), (2, b''))
+        self.send_frame(3, b'dom0\0mgmt.no_such_method\0dom0\0arg\0payload')
+        self.assertEqual(self.read_frame(), (3, b''))
+        # connection is still usable
+        self.send_frame(4, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.assertEqual(self.read_frame(), (4, b"0\0"))
+
+    def test_013_framed_event(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        self.send_frame(1, b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        self.assertEqual(self.read_frame(),
+            (1, b"1\0subject\0event\0payload\0payload\0\0"))
+        # responses to other requests are interleaved with events
+        self.send_frame(2, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        self.assertEqual(self.read_frame(), (2, b"0\0"))
+        request_id, data = self.read_frame()
+        self.assertEqual(request_id, 1)
+        self.assertTrue(data.startswith(b'1\0'))
+        # empty frame cancels the request, which is ended with empty frame
+        mgmt = self.protocol.framed_requests[1]
+        self.send_frame(1, b'')
+        self.assertEqual(self.read_frame(), (1, b''))
+        self.assertTrue(mgmt.task.done())
+        self.assertEqual(self.protocol.framed_requests, {})
+
+    def test_014_framed_duplicate_id(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        self.send_frame(1, b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        self.send_frame(1, b'dom0\0mgmt.success_none\0dom0\0arg\0')
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertIsNone(self.protocol.transport)
+
+    def test_015_framed_too_long(self):
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        self.writer.write(qubes.api.QubesDaemonProtocol.frame_header.pack(
+            1, qubes.api.QubesDaemonProtocol.buffer_size + 1))
+        with self.assertNotRaises(asyncio.TimeoutError):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1)), b'')
+
+    def read_frame_skip_events(self):
+        while True:
+            request_id, data = self.read_frame()
+            if not data.startswith(b'1\0'):
+                return request_id, data
+
+    def test_016_framed_queue(self):
+        self.protocol.max_framed_requests = 2
+        self.writer.write(qubes.api.QubesDaemonProtocol.framed_preamble)
+        for request_id in range(3):
+            self.send_frame(request_id,
+                b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        for _ in range(2):
+            request_id, _ = self.read_frame()
+            self.assertIn(request_id, (0, 1))
+        self.assertEqual(sorted(self.protocol.framed_requests), [0, 1])
+        self.assertEqual(list(self.protocol.framed_queue), [2])
+        self.assertFalse(self.protocol.flow.reading_paused)
+
+        # queued request can be cancelled without being started
+        self.send_frame(2, b'')
+        self.assertEqual(self.read_frame_skip_events(), (2, b''))
+        self.assertEqual(list(self.protocol.framed_queue), [])
+
+        # with full queue, reading is paused
+        for request_id in range(3, 5):
+            self.send_frame(request_id,
+                b'dom0\0mgmt.event\0dom0\0arg\0payload')
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(list(self.protocol.framed_queue), [3, 4])
+        self.assertTrue(self.protocol.flow.reading_paused)
+
+        # finishing one request lets the next one in
+        self.protocol.framed_requests[0].cancel()
+        self.assertEqual(self.read_frame_skip_events(), (0, b''))
+        self.assertEqual(sorted(self.protocol.framed_requests), [1, 3])
+        self.assertEqual(list(self.protocol.framed_queue), [4])
+        self.assertFalse(self.protocol.flow.reading_paused)
+
+
+    def test_020_events_queued_while_paused(self):
+        self.protocol.pause_writing()
+        self.protocol.send_event('vm1', 'event1', arg='1')
+        self.protocol.send_event('vm2', 'event2', arg='2')
+        self.assertEqual(len(self.protocol.flow.queue), 2)
+        stats = self.protocol.get_stats()
+        self.assertTrue(stats['paused'])
+        self.assertEqual(stats['queued_events'], 2)
+        # other data keeps its order after queued events
+        self.protocol.send_header(0x30)
+        self.assertEqual(len(self.protocol.flow.queue), 3)
+
+        self.protocol.resume_writing()
+        self.assertEqual(len(self.protocol.flow.queue), 0)
+        self.assertEqual(self.protocol.flow.size, 0)
+        self.transport.close()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response,
+            b'1\0vm1\0event1\0arg\x001\0\0'
+            b'1\0vm2\0event2\0arg\x002\0\0'
+            b'0\0')
+
+    def test_021_events_drop_oldest(self):
+        self.protocol.flow.overflow_policy = 'drop-oldest'
+        event_size = len(self.protocol.format_event('vm1', 'event', arg='1'))
+        self.protocol.flow.limit = 2 * event_size
+        self.protocol.pause_writing()
+        for i in range(2):
+            self.protocol.send_event('vm1', 'event', arg=str(i))
+        self.assertEqual(self.protocol.flow.dropped, 0)
+        self.assertEqual(len(self.protocol.flow.queue), 2)
+        for i in range(3, 5):
+            self.protocol.send_event('vm{}'.format(i), 'event', arg='1')
+        self.assertEqual(self.protocol.flow.dropped, 2)
+        self.assertEqual(self.protocol.get_stats()['dropped'], 2)
+        self.assertEqual(list(self.protocol.flow.queue),
+            [(None, 'vm3', 'event'), (None, 'vm4', 'event')])
+
+    def test_022_events_coalesce(self):
+        self.protocol.flow.overflow_policy = 'coalesce'
+        self.protocol.pause_writing()
+        for i in range(3):
+            self.protocol.send_event('vm1', 'event', arg=str(i))
+        self.protocol.send_event('vm2', 'event', arg='x')
+        self.assertEqual(self.protocol.flow.coalesced, 2)
+        self.assertEqual(len(self.protocol.flow.queue), 2)
+
+        self.protocol.resume_writing()
+        self.transport.close()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response,
+            b'1\0vm1\0event\0arg\x002\0\0'
+            b'1\0vm2\0event\0arg\0x\0\0')
+
+    def test_023_events_disconnect(self):
+        self.protocol.flow.overflow_policy = 'disconnect'
+        event_size = len(self.protocol.format_event('vm1', 'event', arg='1'))
+        self.protocol.flow.limit = 2 * event_size
+        self.protocol.pause_writing()
+        for i in range(3):
+            self.protocol.send_event('vm{}'.format(i), 'event', arg='1')
+        self.assertTrue(self.protocol.flow.overflowed)
+        self.assertEqual(self.protocol.flow.dropped, 3)
+        # ignored after giving up
+        self.protocol.send_event('vm4', 'event', arg='1')
+        self.assertEqual(len(self.protocol.flow.queue), 0)
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response, b'1\0\0connection-overflow\0\0')
+
+    def test_024_close_after_queue_flushed(self):
+        self.protocol.pause_writing()
+        self.protocol.send_event('vm1', 'event1', arg='1')
+        self.writer.write(b'dom0\0mgmt.qubesexception\0dom0\0arg\0payload')
+        self.writer.write_eof()
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        # the exception waits in the queue after the event, so the
+        # connection must stay open
+        self.assertIsNotNone(self.protocol.transport)
+        self.assertTrue(self.protocol.flow.close_pending)
+        self.assertEqual(len(self.protocol.flow.queue), 2)
+
+        self.protocol.resume_writing()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        self.assertEqual(response,
+            b'1\0vm1\0event1\0arg\x001\0\0'
+            b'2\0QubesException\0\0qubes-exception\0')
+
+    def test_025_events_coalesce_order(self):
+        self.protocol.flow.overflow_policy = 'coalesce'
+        self.protocol.pause_writing()
+        self.protocol.send_event('vm1', 'event', arg='1')
+        self.protocol.send_event('vm2', 'event', arg='x')
+        self.protocol.send_event('vm1', 'event', arg='2')
+        self.assertEqual(self.protocol.flow.coalesced, 1)
+
+        self.protocol.resume_writing()
+        self.transport.close()
+        with self.assertNotRaises(asyncio.TimeoutError):
+            response = self.loop.run_until_complete(
+                asyncio.wait_for(self.reader.read(), 1))
+        # the newest event of vm1 is sent after the event queued before it
+        self.assertEqual(response,
+            b'1\0vm2\0event\0arg\0x\0\0'
+            b'1\0vm1\0event\0arg\x002\0\0')
+
+
+class TC_10_AbstractQubesAPI(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = unittest.mock.Mock()
+        self.app.domains = {'dom0': unittest.mock.sentinel.dom0}
+
+    def test_000_list_method_names(self):
+        self.assertEqual(DummyAPI.list_method_names(),
+            ['dummy.Endpoint.a', 'dummy.Endpoint.b', 'dummy.Simple',
+                'dummy.Write'])
+        self.assertEqual(ExtendedDummyAPI.list_method_names(),
+            ['dummy.Endpoint.a', 'dummy.Endpoint.b', 'dummy.Extended',
+                'dummy.Simple', 'dummy.Write'])
+        # the subclass has its own index
+        self.assertEqual(DummyAPI.list_method_names(),
+            ['dummy.Endpoint.a', 'dummy.Endpoint.b', 'dummy.Simple',
+                'dummy.Write'])
+
+    def test_001_list_methods(self):
+        self.assertEqual(list(DummyAPI.list_methods('dummy.Endpoint.b')),
+            [(DummyAPI.with_endpoint, 'dummy.Endpoint.b', 'b')])
+        self.assertEqual(list(DummyAPI.list_methods('dummy.Extended')), [])
+        self.assertCountEqual(
+            [name for _, name, _ in ExtendedDummyAPI.list_methods()],
+            ExtendedDummyAPI.list_method_names())
+
+    def test_002_dispatch(self):
+        for method, expected in (
+                (b'dummy.Simple', 'simple'),
+                (b'dummy.Endpoint.a', 'a'),
+                (b'dummy.Endpoint.b', 'b'),
+                (b'dummy.Extended', 'extended')):
+            mgmt = ExtendedDummyAPI(self.app, b'dom0', method, b'dom0', b'')
+            self.assertEqual(self.loop.run_until_complete(
+                mgmt.execute(untrusted_payload=b'')), expected)
+
+        with self.assertRaises(qubes.api.ProtocolError):
+            DummyAPI(self.app, b'dom0', b'dummy.Extended', b'dom0', b'')
+
+    def test_003_write_waits_for_save(self):
+        saved = asyncio.Future()
+        self.app.delayed_save.sync.side_effect = \
+            lambda: asyncio.ensure_future(saved)
+        mgmt = DummyAPI(self.app, b'dom0', b'dummy.Write', b'dom0', b'')
+        task = mgmt.execute(untrusted_payload=b'')
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(self.app.save.called)
+        self.assertFalse(task.done())
+        saved.set_result(None)
+        self.assertEqual(self.loop.run_until_complete(task), 'written')
+
+        # read-only methods do not wait
+        self.app.delayed_save.sync.reset_mock()
+        mgmt = DummyAPI(self.app, b'dom0', b'dummy.Simple', b'dom0', b'')
+        self.loop.run_until_complete(mgmt.execute(untrusted_payload=b''))
+        self.assertFalse(self.app.delayed_save.sync.called)
+
+        # without delayed saving the reply is sent right away
+        self.app.delayed_save = None
+        mgmt = DummyAPI(self.app, b'dom0', b'dummy.Write', b'dom0', b'')
+        self.assertEqual(self.loop.run_until_complete(
+            mgmt.execute(untrusted_payload=b'')), 'written')
+
+
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_90_APIBenchmark(qubes.tests.QubesTestCase):
+    def test_000_request_setup(self):
+        app = unittest.mock.Mock()
+        app.domains = {'dom0': unittest.mock.sentinel.dom0}
+        for count in (10, 100, 1000):
+            api_class = make_api_class(count)
+            method = 'dummy.Method{}'.format(count - 1).encode()
+            self.benchmark('request setup ({} methods)'.format(count),
+                lambda: api_class(app, b'dom0', method, b'dom0', b''),
+                number=1000)
+
+            def uncached():
+                # pylint: disable=protected-access
+                del api_class._method_index_cache
+                api_class(app, b'dom0', method, b'dom0', b'')
+            self.benchmark(
+                'request setup, without index ({} methods)'.format(count),
+                uncached, number=100)
@@ -21,10 +21,12 @@
 ''' Tests for management calls endpoints '''
 
 import asyncio
+import functools
 import operator
 import os
 import shutil
 import tempfile
+import time
 import unittest.mock
 
 import libvirt
@@ -36,6 +38,7 @@ import qubes.firewall
 import qubes.api.admin
 import qubes.tests
 import qubes.storage
+import qubespolicy
 
 # properties defined in API
 volume_properties = [
@@ -121,6 +124,57 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertEqual(value,
             'test-vm1 class=AppVM state=Halted\n')
 
+    def test_002_vm_list_with_properties(self):
+        value = self.call_mgmt_func(b'admin.vm.ListWithProperties', b'dom0')
+        lines = value.splitlines()
+        headers = [line for line in lines if not line.startswith('\t')]
+        self.assertEqual(headers, [
+            'dom0 class=AdminVM state=Running',
+            'test-template class=TemplateVM state=Halted',
+            'test-vm1 class=AppVM state=Halted'])
+        vm_lines = lines[lines.index(headers[2]) + 1:]
+        self.assertEqual(len(vm_lines), len(self.vm.property_list()))
+        self.assertIn('\tname default=False type=str test-vm1', vm_lines)
+        self.assertIn('\ttemplate default=False type=vm test-template',
+            vm_lines)
+
+    def test_003_vm_list_with_properties_filter(self):
+        def filters(subject, event, **kwargs):
+            # pylint: disable=unused-argument
+            if 'vm' not in kwargs:
+                return [lambda vm: vm.name != 'test-template']
+            return [lambda prop: prop.__name__ == 'label']
+        self.emitter.events_enabled = True
+        self.emitter.add_handler(
+            'admin-permission:admin.vm.ListWithProperties', filters)
+        value = self.call_mgmt_func(b'admin.vm.ListWithProperties', b'dom0')
+        self.assertEqual(value,
+            'dom0 class=AdminVM state=Running\n'
+            '\tlabel default=False type=label black\n'
+            'test-vm1 class=AppVM state=Halted\n'
+            '\tlabel default=False type=label red\n')
+
+    def test_004_method_list(self):
+        value = self.call_mgmt_func(b'admin.method.List', b'dom0')
+        names = value.splitlines()
+        self.assertEqual(names,
+            qubes.api.admin.QubesAdminAPI.list_method_names())
+        self.assertIn('admin.method.List', names)
+        self.assertIn('admin.vm.device.pci.Attach', names)
+
+    def test_005_method_list_filter(self):
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.method.List',
+            lambda *args, **kwargs: [lambda name: name.startswith(
+                'admin.label.')])
+        value = self.call_mgmt_func(b'admin.method.List', b'dom0')
+        self.assertEqual(value,
+            'admin.label.Create\n'
+            'admin.label.Get\n'
+            'admin.label.Index\n'
+            'admin.label.List\n'
+            'admin.label.Remove\n')
+
     def test_010_vm_property_list(self):
         # this test is kind of stupid, but at least check if appropriate
         # admin-permission event is fired
@@ -174,6 +228,41 @@ class TC_00_VMs(AdminAPITestCase):
             b'provides_network')
         self.assertEqual(value, 'type=bool False')
 
+    def test_027_vm_property_get_all(self):
+        self.vm.kernelopts = 'opt1\nopt2\\'
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'test-vm1')
+        lines = value.splitlines()
+        self.assertEqual(len(lines), len(self.vm.property_list()))
+        self.assertIn('name default=False type=str test-vm1', lines)
+        self.assertIn('vcpus default=True type=int 2', lines)
+        self.assertIn('label default=False type=label red', lines)
+        self.assertIn('netvm default=True type=vm ', lines)
+        self.assertIn('kernelopts default=False type=str opt1\\nopt2\\\\',
+            lines)
+        for line in lines:
+            name, _, rest = line.partition(' ')
+            if name == 'kernelopts':
+                continue
+            self.assertEqual(rest, self.call_mgmt_func(
+                b'admin.vm.property.Get', b'test-vm1', name.encode()))
+
+    def test_028_vm_property_get_all_filter(self):
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.vm.property.GetAll',
+            lambda *args, **kwargs: [lambda prop: prop.__name__ in
+                ('name', 'label')])
+        value = self.call_mgmt_func(b'admin.vm.property.GetAll', b'test-vm1')
+        self.assertEqual(value,
+            'label default=False type=label red\n'
+            'name default=False type=str test-vm1\n')
+
+    def test_029_property_get_all(self):
+        value = self.call_mgmt_func(b'admin.property.GetAll', b'dom0')
+        lines = value.splitlines()
+        self.assertEqual(len(lines), len(self.app.property_list()))
+        self.assertIn('default_template default=False type=vm test-template',
+            lines)
+
     def test_030_vm_property_set_vm(self):
         netvm = self.app.add_new_vm('AppVM', label='red', name='test-net',
             template='test-template', provides_network=True)
@@ -894,6 +983,125 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_221_start_many(self):
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-net1',
+            template='test-template', provides_network=True)
+        self.vm.netvm = netvm
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        started = []
+
+        def start_mock(vm):
+            @asyncio.coroutine
+            def coroutine_mock():
+                started.append(vm.name)
+                if vm is vm2:
+                    raise qubes.exc.QubesVMError(vm, 'start failed')
+                return vm
+            return coroutine_mock
+        for vm in (self.vm, vm2, netvm):
+            vm.start = start_mock(vm)
+
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.StartMany', b'dom0', b'', send_event=send_event)
+        value = self.loop.run_until_complete(mgmt_obj.execute(
+            untrusted_payload=b'test-vm1\ntest-vm2\n'))
+        self.assertIsNone(value)
+        self.assertCountEqual(started, ['test-net1', 'test-vm1', 'test-vm2'])
+        self.assertLess(started.index('test-net1'), started.index('test-vm1'))
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.StartMany')
+        for vm in (self.vm, vm2, netvm):
+            self.assertEventFired(self.emitter,
+                'admin-permission:admin.vm.Start', kwargs={'dest': vm})
+        self.assertIn(unittest.mock.call(netvm, 'start-many-started'),
+            send_event.mock_calls)
+        self.assertIn(unittest.mock.call(vm2, 'start-many-failed',
+            reason='start failed'), send_event.mock_calls)
+        self.assertEqual(send_event.mock_calls[-1],
+            unittest.mock.call(self.app, 'start-many-finished',
+                started=2, failed=1))
+
+    def test_222_start_many_invalid(self):
+        func_mock = unittest.mock.Mock()
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        self.vm.start = coroutine_mock
+        with self.assertRaises(qubes.exc.QubesVMNotFoundError):
+            self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'',
+                b'test-vm1\nno-such-vm\n')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'',
+                b'test-vm1\ntest/vm\n')
+        self.assertFalse(func_mock.called)
+
+    def _setup_many_permission(self, method):
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-net1',
+            template='test-template', provides_network=True)
+        self.vm.netvm = netvm
+        mgmtvm = self.app.add_new_vm('AppVM', label='red', name='test-mgmt',
+            template='test-template')
+        func_mock = unittest.mock.Mock()
+
+        @asyncio.coroutine
+        def coroutine_mock(*args, **kwargs):
+            return func_mock(*args, **kwargs)
+        for vm in (self.vm, netvm):
+            setattr(vm, method, coroutine_mock)
+            vm.is_halted = lambda: method == 'start'
+            vm.is_running = lambda: method != 'start'
+        return netvm, mgmtvm, func_mock
+
+    def _write_policy(self, policy_dir, method, rules):
+        with open(os.path.join(policy_dir, method), 'w') as policy_file:
+            policy_file.write(rules)
+
+    def test_223_start_many_denied_event(self):
+        netvm, _, func_mock = self._setup_many_permission('start')
+
+        def deny(subject, event, dest, **kwargs):
+            # pylint: disable=unused-argument
+            if dest is netvm:
+                raise qubes.api.PermissionDenied()
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.vm.Start', deny)
+        # test-net1 is not listed, but would be started
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.StartMany', b'dom0', b'',
+                b'test-vm1\n')
+        self.assertFalse(func_mock.called)
+
+    def test_224_start_many_policy(self):
+        _, _, func_mock = self._setup_many_permission('start')
+        with tempfile.TemporaryDirectory() as policy_dir:
+            self._write_policy(policy_dir, 'admin.vm.Start',
+                'test-mgmt test-vm1 allow,target=dom0\n'
+                'test-mgmt test-net1 ask,target=dom0\n'
+                '$anyvm $anyvm deny\n')
+            policy_patch = unittest.mock.patch('qubespolicy.Policy',
+                functools.partial(qubespolicy.Policy, policy_dir=policy_dir))
+            with policy_patch:
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app,
+                    b'test-mgmt', b'admin.vm.StartMany', b'dom0', b'')
+                with self.assertRaises(qubes.api.PermissionDenied):
+                    self.loop.run_until_complete(mgmt_obj.execute(
+                        untrusted_payload=b'test-vm1\n'))
+                self.assertFalse(func_mock.called)
+
+                self._write_policy(policy_dir, 'admin.vm.Start',
+                    'test-mgmt test-vm1 allow,target=dom0\n'
+                    'test-mgmt test-net1 allow,target=dom0\n'
+                    '$anyvm $anyvm deny\n')
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app,
+                    b'test-mgmt', b'admin.vm.StartMany', b'dom0', b'',
+                    send_event=unittest.mock.Mock(spec=[]))
+                self.loop.run_until_complete(mgmt_obj.execute(
+                    untrusted_payload=b'test-vm1\n'))
+        self.assertEqual(func_mock.call_count, 2)
+
     def test_230_shutdown(self):
         func_mock = unittest.mock.Mock()
 
@@ -905,6 +1113,75 @@ class TC_00_VMs(AdminAPITestCase):
         self.assertIsNone(value)
         func_mock.assert_called_once_with()
 
+    def test_231_shutdown_many(self):
+        netvm = self.app.add_new_vm('AppVM', label='red', name='test-net1',
+            template='test-template', provides_network=True)
+        self.vm.netvm = netvm
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+        halted = []
+
+        def shutdown_mock(vm):
+            @asyncio.coroutine
+            def coroutine_mock():
+                halted.append(vm.name)
+                yield from vm.fire_event_async('domain-shutdown')
+                return vm
+            return coroutine_mock
+        for vm in (self.vm, vm2, netvm):
+            vm.shutdown = shutdown_mock(vm)
+            vm.is_halted = (lambda vm=vm: vm.name in halted)
+
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+            b'admin.vm.ShutdownMany', b'dom0', b'', send_event=send_event)
+        value = self.loop.run_until_complete(mgmt_obj.execute(
+            untrusted_payload=b'test-net1\ntest-vm2\n'))
+        self.assertIsNone(value)
+        self.assertCountEqual(halted, ['test-net1', 'test-vm1', 'test-vm2'])
+        self.assertLess(halted.index('test-vm1'), halted.index('test-net1'))
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.ShutdownMany')
+        self.assertIn(unittest.mock.call(self.vm, 'shutdown-many-halted'),
+            send_event.mock_calls)
+        self.assertEqual(send_event.mock_calls[-1],
+            unittest.mock.call(self.app, 'shutdown-many-finished',
+                halted=3, failed=0))
+
+    def test_232_shutdown_many_denied_event(self):
+        _, _, func_mock = self._setup_many_permission('shutdown')
+
+        def deny(subject, event, dest, **kwargs):
+            # pylint: disable=unused-argument
+            if dest is self.vm:
+                raise qubes.api.PermissionDenied()
+        self.emitter.events_enabled = True
+        self.emitter.add_handler('admin-permission:admin.vm.Kill', deny)
+        # test-vm1 is not listed, but is connected to test-net1
+        with self.assertRaises(qubes.api.PermissionDenied):
+            self.call_mgmt_func(b'admin.vm.ShutdownMany', b'dom0', b'',
+                b'test-net1\n')
+        self.assertFalse(func_mock.called)
+        self.assertEventFired(self.emitter,
+            'admin-permission:admin.vm.Shutdown', kwargs={'dest': self.vm})
+
+    def test_233_shutdown_many_policy(self):
+        _, _, func_mock = self._setup_many_permission('shutdown')
+        with tempfile.TemporaryDirectory() as policy_dir:
+            for method in ('admin.vm.Shutdown', 'admin.vm.Kill'):
+                self._write_policy(policy_dir, method,
+                    'test-mgmt test-net1 allow,target=dom0\n'
+                    '$anyvm $anyvm deny\n')
+            policy_patch = unittest.mock.patch('qubespolicy.Policy',
+                functools.partial(qubespolicy.Policy, policy_dir=policy_dir))
+            with policy_patch:
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app,
+                    b'test-mgmt', b'admin.vm.ShutdownMany', b'dom0', b'')
+                with self.assertRaises(qubes.api.PermissionDenied):
+                    self.loop.run_until_complete(mgmt_obj.execute(
+                        untrusted_payload=b'test-net1\n'))
+        self.assertFalse(func_mock.called)
+
     def test_240_pause(self):
         func_mock = unittest.mock.Mock()
 
@@ -994,6 +1271,104 @@ class TC_00_VMs(AdminAPITestCase):
                 unittest.mock.call(vm2, 'test-event2', arg1='abc'),
             ])
 
+    def run_events(self, method, payload, fire_events):
+        send_event = unittest.mock.Mock(spec=[])
+        mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0', method,
+            b'dom0', b'', send_event=send_event)
+
+        @asyncio.coroutine
+        def fire_event():
+            yield from fire_events()
+            mgmt_obj.cancel()
+
+        loop = asyncio.get_event_loop()
+        execute_task = asyncio.ensure_future(
+            mgmt_obj.execute(untrusted_payload=payload))
+        asyncio.ensure_future(fire_event())
+        loop.run_until_complete(execute_task)
+        self.assertIsNone(execute_task.result())
+        self.assertEventFired(self.emitter,
+            'admin-permission:' + method.decode())
+        return send_event.mock_calls
+
+    def test_272_events_filtered(self):
+        vm2 = self.app.add_new_vm('AppVM', label='red', name='test-vm2',
+            template='test-template')
+
+        @asyncio.coroutine
+        def fire_events():
+            self.vm.fire_event('test-event', arg1='abc')
+            self.vm.fire_event('other-event', arg1='abc')
+            vm2.fire_event('test-event', arg1='def')
+            self.template.fire_event('test-event2', arg1='ghi')
+            self.app.fire_event('test-event-global')
+            self.app.fire_event('other-event-global')
+            yield
+
+        calls = self.run_events(b'admin.EventsFiltered',
+            b'event=test-*\nvm=test-vm1\nvm=test-template\n', fire_events)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            unittest.mock.call(self.vm, 'test-event', arg1='abc'),
+            unittest.mock.call(self.template, 'test-event2', arg1='ghi'),
+            unittest.mock.call(self.app, 'test-event-global'),
+        ])
+
+    def test_273_events_filtered_coalesce(self):
+        self.vm.vcpus = 1
+        default_kernelopts = self.vm.kernelopts
+
+        @asyncio.coroutine
+        def fire_events():
+            self.vm.vcpus = 2
+            self.vm.vcpus = 3
+            self.vm.kernelopts = 'opt'
+            self.template.vcpus = 4
+            self.vm.vcpus = 5
+            del self.vm.kernelopts
+            self.vm.fire_event('test-event')
+            yield from asyncio.sleep(0.1)
+            self.vm.vcpus = 6
+
+        calls = self.run_events(b'admin.EventsFiltered',
+            b'event=property-set:*\nevent=property-del:*\n'
+            b'event=test-event\ncoalesce=0.05',
+            fire_events)
+        self.assertEqual(calls, [
+            unittest.mock.call(self.app, 'connection-established'),
+            # sent before property-del
+            unittest.mock.call(self.vm, 'property-set:kernelopts',
+                name='kernelopts', newvalue='opt',
+                oldvalue=default_kernelopts),
+            unittest.mock.call(self.vm, 'property-del:kernelopts',
+                name='kernelopts', oldvalue='opt'),
+            unittest.mock.call(self.vm, 'test-event'),
+            unittest.mock.call(self.vm, 'property-set:vcpus', name='vcpus',
+                newvalue=5, oldvalue=1),
+            unittest.mock.call(self.template, 'property-set:vcpus',
+                name='vcpus', newvalue=4, oldvalue=2),
+        ])
+
+    def test_274_events_filtered_invalid(self):
+        for payload in (
+                b'event',
+                b'event=',
+                b'event=test event',
+                b'vm=test/vm',
+                b'coalesce=abc',
+                b'coalesce=1.2.3',
+                b'coalesce=0',
+                b'coalesce=1000',
+                b'coalesce=1\ncoalesce=2',
+                b'unknown=1'):
+            with self.subTest(payload):
+                mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                    b'admin.EventsFiltered', b'dom0', b'',
+                    send_event=unittest.mock.Mock(spec=[]))
+                with self.assertRaises(qubes.api.ProtocolError):
+                    self.loop.run_until_complete(
+                        mgmt_obj.execute(untrusted_payload=payload))
+
     def test_280_feature_list(self):
         self.vm.features['test-feature'] = 'some-value'
         value = self.call_mgmt_func(b'admin.vm.feature.List', b'test-vm1')
@@ -2044,28 +2419,21 @@ class TC_00_VMs(AdminAPITestCase):
         def cancel_call():
             mgmt_obj.cancel()
 
-        class MockVM(object):
-            def __init__(self, name):
-                self._name = name
-
-            def name(self):
-                return self._name
-
         loop = asyncio.get_event_loop()
-        self.app.vmm.libvirt_conn.lookupByID.side_effect = lambda xid: {
-            0: MockVM('Domain-0'),
-            1: MockVM('test-template'),
-            2: MockVM('test-vm1')}[xid]
+        self.set_running(self.template, 1)
+        self.set_running(self.vm, 2)
         execute_task = asyncio.ensure_future(
             mgmt_obj.execute(untrusted_payload=b''))
         loop.call_later(1.1, cancel_call)
         loop.run_until_complete(execute_task)
+        # let the sampler finish
+        loop.run_until_complete(asyncio.sleep(0))
         self.assertIsNone(execute_task.result())
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=None),
-            unittest.mock.call(0, stats1, only_vm=None),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2091,6 +2459,11 @@ class TC_00_VMs(AdminAPITestCase):
         send_event = unittest.mock.Mock(spec=[])
 
         stats1 = {
+            0: {
+                'cpu_time': 243951379111104 // 8,
+                'cpu_usage': 0,
+                'memory_kb': 3733212,
+            },
             2: {
                 'cpu_time': 2849496569205,
                 'cpu_usage': 0,
@@ -2111,28 +2484,21 @@ class TC_00_VMs(AdminAPITestCase):
         def cancel_call():
             mgmt_obj.cancel()
 
-        class MockVM(object):
-            def __init__(self, name):
-                self._name = name
-
-            def name(self):
-                return self._name
-
         loop = asyncio.get_event_loop()
-        self.app.vmm.libvirt_conn.lookupByID.side_effect = lambda xid: {
-            0: MockVM('Domain-0'),
-            1: MockVM('test-template'),
-            2: MockVM('test-vm1')}[xid]
+        self.set_running(self.template, 1)
+        self.set_running(self.vm, 2)
         execute_task = asyncio.ensure_future(
             mgmt_obj.execute(untrusted_payload=b''))
         loop.call_later(1.1, cancel_call)
         loop.run_until_complete(execute_task)
+        # let the sampler finish
+        loop.run_until_complete(asyncio.sleep(0))
         self.assertIsNone(execute_task.result())
         self.assertEventFired(self.emitter,
             'admin-permission:' + 'admin.vm.Stats')
         self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
-            unittest.mock.call(None, None, only_vm=self.vm),
-            unittest.mock.call(0, stats1, only_vm=self.vm),
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats1),
         ])
         self.assertEqual(send_event.mock_calls, [
             unittest.mock.call(self.app, 'connection-established'),
@@ -2146,6 +2512,141 @@ class TC_00_VMs(AdminAPITestCase):
                     memory_kb=stats2[2]['memory_kb']),
             ])
 
+    def set_running(self, vm, xid):
+        self.app.vmm.offline_mode = False
+        vm._libvirt_domain = unittest.mock.Mock(**{
+            'isActive.return_value': True,
+            'ID.return_value': xid,
+        })
+
+    def test_632_vm_stats_shared(self):
+        stats = {
+            0: {'cpu_time': 1000000, 'cpu_usage': 0, 'memory_kb': 1024},
+            2: {'cpu_time': 2000000, 'cpu_usage': 0, 'memory_kb': 2048},
+            3: {'cpu_time': 3000000, 'cpu_usage': 0, 'memory_kb': 4096},
+        }
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.return_value = (0, stats)
+        self.app.stats_interval = 1
+        send_event1 = unittest.mock.Mock(spec=[])
+        send_event2 = unittest.mock.Mock(spec=[])
+        mgmt_obj1 = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event1)
+        mgmt_obj2 = qubes.api.admin.QubesAdminAPI(
+            self.app, b'dom0', b'admin.vm.Stats',
+            b'dom0', b'', send_event=send_event2)
+
+        loop = asyncio.get_event_loop()
+        execute_task1 = asyncio.ensure_future(
+            mgmt_obj1.execute(untrusted_payload=b''))
+        loop.run_until_complete(asyncio.sleep(0.1))
+        execute_task2 = asyncio.ensure_future(
+            mgmt_obj2.execute(untrusted_payload=b''))
+        loop.run_until_complete(asyncio.sleep(0.1))
+        # test-vm1 (ID 2) was not running when sampling started
+        self.assertEqual(self.app.vm_stats_sampler.id_to_name_map,
+            {0: 'dom0'})
+        self.set_running(self.vm, 2)
+        self.vm.fire_event('domain-spawn', start_guid=False)
+        loop.run_until_complete(asyncio.sleep(1))
+        mgmt_obj1.cancel()
+        mgmt_obj2.cancel()
+        loop.run_until_complete(asyncio.wait([execute_task1, execute_task2]))
+        loop.run_until_complete(asyncio.sleep(0))
+
+        self.assertEqual(self.app.host.get_vm_stats.mock_calls, [
+            unittest.mock.call(None, None),
+            unittest.mock.call(0, stats),
+        ])
+        for send_event in (send_event1, send_event2):
+            self.assertEqual(send_event.mock_calls, [
+                unittest.mock.call(self.app, 'connection-established'),
+                unittest.mock.call('dom0', 'vm-stats',
+                    cpu_time=1, cpu_usage=0, memory_kb=1024),
+                unittest.mock.call('dom0', 'vm-stats',
+                    cpu_time=1, cpu_usage=0, memory_kb=1024),
+                unittest.mock.call('test-vm1', 'vm-stats',
+                    cpu_time=2, cpu_usage=0, memory_kb=2048),
+            ])
+        # sampler stops with the last subscriber
+        self.assertIsNone(self.app.vm_stats_sampler.task)
+        self.assertNotIn('domain-spawn', self.vm.__handlers__)
+
+    def test_633_vm_stats_shutdown(self):
+        self.set_running(self.vm, 2)
+        sampler = qubes.api.admin.VMStatsSampler(self.app)
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.return_value = (0, {})
+        queue = sampler.subscribe()
+        self.assertEqual(sampler.id_to_name_map, {0: 'dom0', 2: 'test-vm1'})
+        self.vm.fire_event('domain-shutdown')
+        self.assertEqual(sampler.id_to_name_map, {0: 'dom0'})
+        sampler.unsubscribe(queue)
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_634_vm_stats_history(self):
+        self.set_running(self.vm, 2)
+        self.app.host.get_vm_stats = unittest.mock.Mock()
+        self.app.host.get_vm_stats.return_value = (3600, {
+            0: {'cpu_time': 1000000, 'cpu_usage': 10, 'memory_kb': 1024},
+            2: {'cpu_time': 2000000, 'cpu_usage': 20, 'memory_kb': 2048},
+        })
+        self.app.vm_stats_sampler = qubes.api.admin.VMStatsSampler(self.app)
+        self.app.vm_stats_sampler.enable_history(((1, 10), (60, 10)))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        value = self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1',
+            b'60')
+        self.assertEqual(value, 'time,cpu_usage,memory_kb\n'
+            '3600,20.0,2048\n')
+        value = self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1',
+            b'1', b'0 3000')
+        self.assertEqual(value, 'time,cpu_usage,memory_kb\n')
+        with self.assertRaises(qubes.exc.QubesValueError):
+            self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1', b'5')
+        with self.assertRaises(qubes.api.ProtocolError):
+            self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1',
+                b'1', b'0')
+        self.app.vm_stats_sampler.history = None
+        self.app.vm_stats_sampler.stop()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_635_vm_stats_history_disabled(self):
+        with self.assertRaises(qubes.exc.QubesException):
+            self.call_mgmt_func(b'admin.vm.StatsHistory', b'test-vm1', b'60')
+
+    def test_636_vm_stats_history_failure(self):
+        self.set_running(self.vm, 2)
+        stats = {
+            0: {'cpu_time': 1000000, 'cpu_usage': 10, 'memory_kb': 1024},
+            2: {'cpu_time': 2000000, 'cpu_usage': 20, 'memory_kb': 2048},
+        }
+        calls = []
+
+        def get_vm_stats(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise OSError('transient failure')
+            return 3600, stats
+
+        self.app.host.get_vm_stats = get_vm_stats
+        self.app.stats_interval = 1
+        sampler = qubes.api.admin.VMStatsSampler(self.app)
+        sampler.max_retry_delay = 0.01
+        sampler.enable_history(((1, 10),))
+        with self.assertLogs('app', 'WARNING'):
+            self.loop.run_until_complete(asyncio.sleep(0))
+        # the failed sample is skipped, but history is still recorded
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertEqual(len(calls), 2)
+        self.assertIsNotNone(sampler.history)
+        self.assertIsNotNone(sampler.task)
+        self.assertEqual(sampler.history.get('test-vm1', 1),
+            [(3600, 20.0, 2048)])
+        sampler.history = None
+        sampler.stop()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
     @unittest.mock.patch('qubes.storage.Storage.create')
     def test_640_vm_create_disposable(self, mock_storage):
         mock_storage.side_effect = self.dummy_coro
@@ -2448,6 +2949,7 @@ class TC_00_VMs(AdminAPITestCase):
     def test_992_dom0_unexpected_payload(self):
         methods_with_no_payload = [
             b'admin.vmclass.List',
+            b'admin.method.List',
             b'admin.vm.List',
             b'admin.label.List',
             b'admin.label.Get',
@@ -2489,6 +2991,7 @@ class TC_00_VMs(AdminAPITestCase):
     def test_993_dom0_unexpected_argument(self):
         methods_with_no_argument = [
             b'admin.vmclass.List',
+            b'admin.method.List',
             b'admin.vm.List',
             b'admin.label.List',
             b'admin.property.List',
@@ -2523,6 +3026,7 @@ class TC_00_VMs(AdminAPITestCase):
         # because of invalid destination, not invalid arguments
         methods_for_dom0_only = [
             b'admin.vmclass.List',
+            b'admin.method.List',
             b'admin.vm.Create.AppVM',
             b'admin.vm.CreateInPool.AppVM',
             b'admin.vm.CreateTemplate',
@@ -2550,6 +3054,8 @@ class TC_00_VMs(AdminAPITestCase):
             b'admin.backup.Execute',
             b'admin.backup.Info',
             b'admin.backup.Restore',
+            b'admin.vm.StartMany',
+            b'admin.vm.ShutdownMany',
         ]
         # make sure also no methods on actual VM gets called
         vm_mock = unittest.mock.MagicMock()
@@ -2672,3 +3178,38 @@ class TC_00_VMs(AdminAPITestCase):
                         b'some-payload')
                 self.assertFalse(vm_mock.called)
                 self.assertFalse(self.app.save.called)
+
+
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_90_AdminAPIBenchmark(AdminAPITestCase):
+    #: simulated time of a call to libvirtd
+    libvirt_call_time = 0.0001
+
+    def libvirt_call(self, value):
+        def call():
+            time.sleep(self.libvirt_call_time)
+            return value
+        return call
+
+    def test_000_vm_list(self):
+        for i in range(100):
+            vm = self.app.add_new_vm('AppVM', label='red',
+                name='test-bench{}'.format(i), template='test-template')
+            vm._libvirt_domain = unittest.mock.Mock(**{
+                'isActive.side_effect': self.libvirt_call(True),
+                'state.side_effect': self.libvirt_call(
+                    [libvirt.VIR_DOMAIN_PAUSED, 0]),
+            })
+        self.app.vmm.offline_mode = False
+
+        def vm_list():
+            mgmt_obj = qubes.api.admin.QubesAdminAPI(self.app, b'dom0',
+                b'admin.vm.List', b'dom0', b'')
+            self.loop.run_until_complete(
+                mgmt_obj.execute(untrusted_payload=b''))
+
+        self.benchmark('admin.vm.List (100 VMs, uncached)', vm_list,
+            number=10)
+        self.app.libvirt_cache_enabled = True
+        self.benchmark('admin.vm.List (100 VMs, cached)', vm_list,
+            number=10)
@@ -20,13 +20,24 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
+import concurrent.futures
 import os
+import threading
+import time
 import unittest.mock as mock
+import uuid
 
+import libvirt
 import lxml.etree
 
 import qubes
+import qubes.config
+import qubes.devices
 import qubes.events
+import qubes.exc
+import qubes.storage
+import qubes.utils
 
 import qubes.tests
 import qubes.tests.init
@@ -148,6 +159,114 @@ class TC_20_QubesHost(qubes.tests.QubesTestCase):
 
 
 
+class TC_21_VirConnectWrapper(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_21_VirConnectWrapper, self).setUp()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        self.libvirt_conn = mock.Mock()
+        with mock.patch('libvirt.open', create=True,
+                return_value=self.libvirt_conn) as self.mock_open:
+            self.conn = qubes.app.VirConnectWrapper('test:///default',
+                executor=executor)
+
+    def test_000_call_async(self):
+        threads = []
+
+        def get_hostname():
+            threads.append(threading.current_thread())
+            return 'dom0'
+        self.libvirt_conn.getHostname.side_effect = get_hostname
+        self.assertEqual(self.loop.run_until_complete(
+            self.conn.call_async('getHostname')), 'dom0')
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_001_domain_calls_ordered(self):
+        log = []
+        domain = mock.Mock()
+        domain.UUID.return_value = b'\x01' * 16
+
+        def call(name):
+            log.append(name + '-start')
+            time.sleep(0.05)
+            log.append(name + '-end')
+        domain.suspend.side_effect = lambda: call('suspend')
+        domain.resume.side_effect = lambda: call('resume')
+        wrapper = qubes.app.VirDomainWrapper(self.conn, domain)
+        self.loop.run_until_complete(asyncio.gather(
+            wrapper.call_async('suspend'), wrapper.call_async('resume')))
+        self.assertEqual(log,
+            ['suspend-start', 'suspend-end', 'resume-start', 'resume-end'])
+
+    def test_002_domain_call_reconnect(self):
+        old_domain = mock.Mock()
+        old_domain.resume.side_effect = libvirt.libvirtError('dead')
+        old_domain.UUID.return_value = b'\x01' * 16
+        old_domain.connect.return_value.isAlive.return_value = False
+        self.libvirt_conn.isAlive.return_value = False
+        new_conn = mock.Mock()
+        new_domain = new_conn.lookupByUUID.return_value
+        new_domain.resume.return_value = 0
+        wrapper = qubes.app.VirDomainWrapper(self.conn, old_domain)
+        with mock.patch('libvirt.open', create=True,
+                return_value=new_conn):
+            self.assertEqual(self.loop.run_until_complete(
+                wrapper.call_async('resume')), 0)
+        new_conn.lookupByUUID.assert_called_once_with(b'\x01' * 16)
+        new_domain.resume.assert_called_once_with()
+
+    def test_003_reconnect_event_callbacks(self):
+        callback = mock.Mock()
+        reconnected = mock.Mock()
+        self.conn.reconnect_callbacks.append(reconnected)
+        self.libvirt_conn.domainEventRegisterAny.return_value = 5
+        callback_id = self.conn.domainEventRegisterAny(None, 1, callback,
+            None)
+        self.libvirt_conn.domainEventRegisterAny.assert_called_once_with(
+            None, 1, callback, None)
+
+        self.libvirt_conn.getHostname.side_effect = libvirt.libvirtError(
+            'dead')
+        self.libvirt_conn.isAlive.return_value = False
+        new_conn = mock.Mock()
+        new_conn.getHostname.return_value = 'dom0'
+        new_conn.domainEventRegisterAny.return_value = 7
+        with mock.patch('libvirt.open', create=True,
+                return_value=new_conn):
+            self.assertEqual(self.conn.getHostname(), 'dom0')
+        new_conn.domainEventRegisterAny.assert_called_once_with(
+            None, 1, callback, None)
+        reconnected.assert_called_once_with()
+
+        self.conn.domainEventDeregisterAny(callback_id)
+        new_conn.domainEventDeregisterAny.assert_called_once_with(7)
+        self.assertFalse(self.libvirt_conn.domainEventDeregisterAny.called)
+
+    def test_004_domain_lock_dropped_on_undefine(self):
+        # pylint: disable=protected-access
+        domain = mock.Mock()
+        domain.UUID.return_value = b'\x01' * 16
+        wrapper = qubes.app.VirDomainWrapper(self.conn, domain)
+        self.loop.run_until_complete(wrapper.call_async('resume'))
+        self.assertIn(b'\x01' * 16, self.conn._domain_locks)
+        wrapper.undefine()
+        domain.undefine.assert_called_once_with()
+        self.assertNotIn(b'\x01' * 16, self.conn._domain_locks)
+
+    def test_005_domain_lock_kept_while_used(self):
+        # pylint: disable=protected-access
+        lock = self.conn._domain_lock(b'\x01' * 16)
+        self.loop.run_until_complete(lock.acquire())
+        self.conn.forget_domain_lock(b'\x01' * 16)
+        self.assertIs(self.conn._domain_lock(b'\x01' * 16), lock)
+        lock.release()
+        self.conn.forget_domain_lock(b'\x01' * 16)
+        self.assertNotIn(b'\x01' * 16, self.conn._domain_locks)
+        # unknown domain
+        self.conn.forget_domain_lock(b'\x02' * 16)
+
+
 class TC_30_VMCollection(qubes.tests.QubesTestCase):
     def setUp(self):
         super().setUp()
@@ -171,7 +290,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         del self.app
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1, _enable_events=False)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -182,7 +301,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1, _enable_events=False)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
@@ -251,6 +370,69 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertEventFired(self.app, 'domain-delete',
             kwargs={'vm': self.testvm2})
 
+    def test_009_getitem_uuid(self):
+        self.testvm2.uuid = uuid.uuid4()
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+
+        self.assertIs(self.vms[self.testvm2.uuid], self.testvm2)
+        self.assertIs(self.vms[self.testvm2], self.testvm2)
+        with self.assertRaises(KeyError):
+            self.vms[uuid.uuid4()]
+
+    def test_010_index_after_delitem(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertCountEqual(self.vms, [self.testvm1, self.testvm2])
+
+        del self.vms['testvm2']
+
+        self.assertNotIn('testvm2', self.vms)
+        self.assertNotIn(self.testvm2, self.vms)
+        with self.assertRaises(KeyError):
+            self.vms['testvm2']
+        self.assertCountEqual(self.vms, [self.testvm1])
+        self.assertCountEqual(self.vms.names(), ['testvm1'])
+
+    def test_011_index_after_rename(self):
+        self.vms.add(self.testvm1)
+        self.vms.add(self.testvm2)
+        self.assertEqual(list(self.vms), [self.testvm1, self.testvm2])
+
+        self.testvm1.name = 'testvm3'
+
+        self.assertNotIn('testvm1', self.vms)
+        self.assertIs(self.vms['testvm3'], self.testvm1)
+        self.assertEqual(list(self.vms), [self.testvm2, self.testvm1])
+
+        with self.assertRaises(ValueError):
+            self.testvm1.name = 'testvm2'
+        self.assertIs(self.vms['testvm2'], self.testvm2)
+
+    def test_012_index_uuid_set_after_add(self):
+        self.vms.add(self.testvm1)
+        vm_uuid = uuid.uuid4()
+        self.testvm1.fire_event('property-set:uuid',
+            name='uuid', newvalue=vm_uuid)
+
+        self.assertIs(self.vms[vm_uuid], self.testvm1)
+
+    def test_013_contains_equal(self):
+        class EqualTestVM(qubes.tests.init.TestVM):
+            def __eq__(self, other):
+                return isinstance(other, qubes.vm.BaseVM) \
+                    and (self.qid, self.name) == (other.qid, other.name)
+
+            __hash__ = qubes.tests.init.TestVM.__hash__
+
+        self.vms.add(self.testvm1, _enable_events=False)
+        self.assertIn(EqualTestVM(None, None, qid=1, name='testvm1'),
+            self.vms)
+        self.assertNotIn(EqualTestVM(None, None, qid=1, name='testvm2'),
+            self.vms)
+        self.assertNotIn(EqualTestVM(None, None, qid=2, name='testvm1'),
+            self.vms)
+
     def test_100_get_new_unused_qid(self):
         self.vms.add(self.testvm1)
         self.vms.add(self.testvm2)
@@ -270,6 +452,62 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
 #       pass
 
 
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_31_VMCollectionBenchmark(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = TestApp()
+
+    def tearDown(self):
+        del self.app
+        super().tearDown()
+
+    def make_collection(self, count):
+        vms = qubes.app.VMCollection(self.app)
+        for qid in range(1, count + 1):
+            vm = qubes.tests.init.TestVM(None, None,
+                qid=qid, name='testvm{}'.format(qid))
+            vm.uuid = uuid.uuid4()
+            vms.add(vm, _enable_events=False)
+        return vms
+
+    def close_collection(self, vms):
+        testvms = list(vms)
+        vms.close()
+        for vm in testvms:
+            vm.close()
+
+    def test_000_lookup(self):
+        results = {}
+        for count in (10, 100, 1000):
+            vms = self.make_collection(count)
+            vm = vms[count // 2]
+            name, vm_uuid = vm.name, vm.uuid
+            results[count] = sum((
+                self.benchmark('vms[name] ({} VMs)'.format(count),
+                    lambda: vms[name]),
+                self.benchmark('vms[uuid] ({} VMs)'.format(count),
+                    lambda: vms[vm_uuid]),
+                self.benchmark('name in vms ({} VMs)'.format(count),
+                    lambda: name in vms),
+                self.benchmark('vm in vms ({} VMs)'.format(count),
+                    lambda: vm in vms),
+            ))
+            self.close_collection(vms)
+            del vm
+
+        # lookups should not depend on number of VMs; be generous, as this
+        # is run on whatever machine
+        self.assertLess(results[1000], results[10] * 10)
+
+    def test_001_iterate(self):
+        for count in (10, 100, 1000):
+            vms = self.make_collection(count)
+            self.benchmark('list(vms) ({} VMs)'.format(count),
+                lambda: list(vms), number=100)
+            self.close_collection(vms)
+
+
 class TC_89_QubesEmpty(qubes.tests.QubesTestCase):
     def tearDown(self):
         try:
@@ -294,6 +532,10 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             os.unlink('/tmp/qubestest.xml')
         except:
             pass
+        try:
+            os.unlink('/tmp/qubestest.xml.snapshot')
+        except FileNotFoundError:
+            pass
         super().tearDown()
 
     def setUp(self):
@@ -387,9 +629,864 @@ class TC_90_Qubes(qubes.tests.QubesTestCase):
             with self.assertRaises(qubes.exc.QubesVMInUseError):
                 del self.app.domains[appvm]
 
+    def test_300_xml_serialize(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        appvm.features['test-feature'] = 'multi\nline'
+        appvm.tags.add('test-tag')
+        self.assertEqual(self.app.xml_serialize(),
+            lxml.etree.tostring(self.app.__xml__(), encoding='utf-8',
+                pretty_print=True))
+
+    def test_301_xml_cache_reused(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        expected = self.app.xml_serialize()
+        self.assertIsNotNone(appvm.xml_cache)
+        with mock.patch.object(appvm, '__xml__') as mock_xml:
+            self.assertEqual(self.app.xml_serialize(), expected)
+            self.assertFalse(mock_xml.called)
+
+    def test_302_xml_cache_invalidate(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        changes = (
+            ('property-set', lambda: setattr(appvm, 'memory', 1234)),
+            ('property-del', lambda: delattr(appvm, 'memory')),
+            ('feature-set', lambda: appvm.features.__setitem__('test', '1')),
+            ('feature-delete', lambda: appvm.features.__delitem__('test')),
+            ('tag-add', lambda: appvm.tags.add('test-tag')),
+            ('tag-delete', lambda: appvm.tags.remove('test-tag')),
+            ('volume-import-end', lambda: appvm.fire_event(
+                'domain-volume-import-end', volume='private', success=True)),
+            ('device-attach', lambda: self.loop.run_until_complete(
+                appvm.devices['testclass'].attach(
+                    qubes.devices.DeviceAssignment(appvm, '1234',
+                        persistent=True)))),
+            ('device-detach', lambda: self.loop.run_until_complete(
+                appvm.devices['testclass'].detach(
+                    qubes.devices.DeviceAssignment(appvm, '1234')))),
+        )
+        for name, change in changes:
+            with self.subTest(name):
+                self.app.xml_serialize()
+                self.assertIsNotNone(appvm.xml_cache)
+                change()
+                self.assertIsNone(appvm.xml_cache)
+                self.assertEqual(self.app.xml_serialize(),
+                    lxml.etree.tostring(self.app.__xml__(), encoding='utf-8',
+                        pretty_print=True))
+
+    def test_303_xml_cache_volume_config(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        self.app.xml_serialize()
+        appvm.volumes['private'].revisions_to_keep = 0
+        self.assertIn(b'vid="appvms/test-vm/private" revisions_to_keep="0"',
+            self.app.xml_serialize())
+
+    def test_304_xml_cache_events_disabled(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        self.app.xml_serialize()
+        appvm.events_enabled = False
+        appvm.features['test-feature'] = 'test-value'
+        self.assertIn(b'test-value', self.app.xml_serialize())
+        self.assertIsNone(appvm.xml_cache)
+
+    def test_305_xml_cache_other_events(self):
+        self.app.default_kernel = 'dummy'
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template,
+            label='red')
+        self.app.xml_serialize()
+        # invalidation must not make unrelated events look handled
+        self.assertFalse(appvm.has_handlers('domain-test-event'))
+        appvm.fire_event('domain-test-event')
+        self.assertIsNotNone(appvm.xml_cache)
+        # nor property changes, which invalidate it without events
+        self.assertFalse(appvm.has_handlers('property-set:kernelopts'))
+        appvm.kernelopts = 'test-opts'
+        self.assertIsNone(appvm.xml_cache)
+
+    def test_310_load_stopwatch(self):
+        self.app.default_kernel = 'dummy'
+        self.app.add_new_vm('AppVM', name='test-vm', template=self.template,
+            label='red')
+        self.app.save()
+
+        stopwatch = qubes.utils.Stopwatch()
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+            stopwatch=stopwatch)
+        self.addCleanup(app.close)
+        for step in ('parse qubes.xml', 'stage 1: labels',
+                'stage 1: pool driver file', 'stage 2: domains',
+                'stage 3: global properties',
+                'stage 4: domain properties and extras',
+                'stage 5: domain-load events'):
+            self.assertIn(step, stopwatch.steps)
+        self.assertEqual(stopwatch.steps['stage 2: domains'][1], 1)
+        # called for the template and test-vm, but not dom0
+        self.assertEqual(stopwatch.steps[
+            'handler qubes.vm.qubesvm.QubesVM.on_domain_init_loaded '
+            '(domain-load)'][1], 2)
+        self.assertIn('stage 2: domains', stopwatch.format_report())
+
+    def test_311_load_vm_class_lookup(self):
+        self.app.default_kernel = 'dummy'
+        for i in range(3):
+            self.app.add_new_vm('AppVM', name='test-vm{}'.format(i),
+                template=self.template, label='red')
+        self.app.save()
+
+        with mock.patch.object(qubes.Qubes, 'get_vm_class',
+                side_effect=qubes.Qubes.get_vm_class) as mock_get_vm_class:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+            self.addCleanup(app.close)
+        self.assertEqual(len(app.domains), 5)
+        self.assertCountEqual(
+            [call[0][0] for call in mock_get_vm_class.call_args_list],
+            ['AdminVM', 'TemplateVM', 'AppVM'])
+
+    def _setup_lazy(self):
+        self.app.default_kernel = 'dummy'
+        netvm = self.app.add_new_vm('AppVM', name='test-net',
+            template=self.template, label='red', provides_network=True)
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        appvm.netvm = netvm
+        appvm.features['test-feature'] = 'test-value'
+        appvm.tags.add('test-tag')
+        self.app.add_new_vm('AppVM', name='test-other',
+            template=self.template, label='red')
+        self.app.save()
+        del netvm, appvm
+
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True, lazy=True)
+        self.addCleanup(app.close)
+        return app
+
+    def test_320_lazy_index(self):
+        app = self._setup_lazy()
+        self.assertEqual([vm.name for vm in app.domains.loaded_vms()],
+            ['dom0'])
+        self.assertEqual(len(app.domains), 5)
+        self.assertEqual(list(app.domains.names()),
+            sorted(self.app.domains.names()))
+        self.assertEqual(list(app.domains.qids()),
+            list(self.app.domains.qids()))
+        self.assertIn('test-vm', app.domains)
+        self.assertIn(self.app.domains['test-vm'].qid, app.domains)
+        self.assertNotIn('no-such-vm', app.domains)
+        self.assertEqual([vm.name for vm in app.domains.loaded_vms()],
+            ['dom0'])
+
+    def test_321_lazy_getitem(self):
+        app = self._setup_lazy()
+        appvm = app.domains['test-vm']
+        # referenced VMs are loaded too, but nothing else
+        self.assertEqual(
+            sorted(vm.name for vm in app.domains.loaded_vms()),
+            ['dom0', 'test-net', 'test-template', 'test-vm'])
+        self.assertIs(app.domains[appvm.qid], appvm)
+        self.assertIs(app.domains[appvm.uuid], appvm)
+        self.assertIs(appvm.netvm, app.domains['test-net'])
+        self.assertIs(appvm.template, app.domains['test-template'])
+        self.assertEqual(appvm.features['test-feature'], 'test-value')
+        self.assertIn('test-tag', appvm.tags)
+        self.assertTrue(appvm.events_enabled)
+        self.assertIsNotNone(appvm.storage)
+
+    def test_322_lazy_iter(self):
+        app = self._setup_lazy()
+        self.assertEqual([vm.name for vm in app.domains],
+            [vm.name for vm in self.app.domains])
+        self.assertEqual(len(list(app.domains.loaded_vms())), 5)
+
+    def test_323_lazy_save(self):
+        app = self._setup_lazy()
+        app.domains['test-other'].features['test-feature'] = 'changed'
+        with open('/tmp/qubestest.xml', 'rb') as xml_file:
+            orig = lxml.etree.parse(xml_file)
+        app.save()
+        with open('/tmp/qubestest.xml', 'rb') as xml_file:
+            saved = lxml.etree.parse(xml_file)
+
+        def domains(tree):
+            return {node.get('id'): lxml.etree.tostring(node, with_tail=False)
+                for node in tree.xpath('/qubes/domains/domain')}
+        orig_domains = domains(orig)
+        saved_domains = domains(saved)
+        self.assertEqual(orig_domains.keys(), saved_domains.keys())
+        changed = [key for key in orig_domains
+            if orig_domains[key] != saved_domains[key]]
+        self.assertEqual(changed,
+            ['domain-{}'.format(app.domains['test-other'].qid)])
+        self.assertEqual(
+            sorted(vm.name for vm in app.domains.loaded_vms()),
+            ['dom0', 'test-other', 'test-template'])
+
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_UNDEFINED', 1, create=True)
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_STOPPED', 5, create=True)
+    def test_330_libvirt_event_invalidates_cache(self):
+        # pylint: disable=protected-access
+        self.template._libvirt_cache['isActive'] = False
+        class Domain(object):
+            # pylint: disable=too-few-public-methods
+            @staticmethod
+            def name():
+                return 'test-template'
+        domain = Domain()
+        self.app._domain_event_callback(None, domain, 2, 0, None)
+        self.assertEqual(self.template._libvirt_cache, {})
+
+        self.template._libvirt_cache['XMLDesc'] = '<domain/>'
+        self.app._device_event_callback(None, domain, 'xvdi', None)
+        self.assertEqual(self.template._libvirt_cache, {})
+
+    def test_331_libvirt_reconnect_invalidates_cache(self):
+        # pylint: disable=protected-access
+        self.template._libvirt_cache['isActive'] = False
+        self.app.libvirt_cache_enabled = False
+        self.app._libvirt_reconnected()
+        self.assertEqual(self.template._libvirt_cache, {})
+        # libvirt events are not registered, so the cache stays disabled
+        self.assertFalse(self.app.libvirt_cache_enabled)
+
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE', 0, create=True)
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED', 19, create=True)
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED', 15,
+        create=True)
+    def test_332_libvirt_device_events(self):
+        # pylint: disable=protected-access
+        with mock.patch.object(self.app, 'vmm') as mock_vmm:
+            self.app.register_event_handlers()
+            self.app.libvirt_cache_enabled = False
+            register = mock_vmm.libvirt_conn.domainEventRegisterAny
+            self.assertIn(
+                mock.call(None, 19, self.app._device_event_callback, None),
+                register.mock_calls)
+            self.assertIn(
+                mock.call(None, 15, self.app._device_event_callback, None),
+                register.mock_calls)
+            self.assertEqual(len(self.app._device_event_callback_ids), 2)
+
+            self.app._domain_event_callback_id = None
+            self.app._device_event_callback_ids = []
+
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_UNDEFINED', 1, create=True)
+    @mock.patch('libvirt.VIR_DOMAIN_EVENT_STOPPED', 5, create=True)
+    def test_333_libvirt_undefine_event_drops_lock(self):
+        # pylint: disable=protected-access
+        domain = mock.Mock()
+        domain.name = mock.Mock(return_value='test-template')
+        domain.UUID.return_value = b'\x01' * 16
+        with mock.patch.object(self.app, 'vmm') as mock_vmm:
+            self.app._domain_event_callback(None, domain, 1, 0, None)
+            mock_vmm.libvirt_conn.forget_domain_lock.assert_called_once_with(
+                b'\x01' * 16)
+            mock_vmm.libvirt_conn.forget_domain_lock.reset_mock()
+            self.app._domain_event_callback(None, domain, 2, 0, None)
+            self.assertFalse(mock_vmm.libvirt_conn.forget_domain_lock.called)
+
+    def _setup_snapshot(self):
+        self.app.default_kernel = 'dummy'
+        netvm = self.app.add_new_vm('AppVM', name='test-net',
+            template=self.template, label='red', provides_network=True)
+        appvm = self.app.add_new_vm('AppVM', name='test-vm',
+            template=self.template, label='red')
+        appvm.netvm = netvm
+        appvm.memory = 500
+        appvm.features['test-feature'] = 'multi\nline'
+        appvm.tags.add('test-tag')
+        appvm.events_enabled = False
+        appvm.devices['testclass'].load_persistent(
+            qubes.devices.DeviceAssignment(netvm, '1234',
+                {'opt': 'value'}, persistent=True))
+        appvm.events_enabled = True
+        self.app.default_netvm = netvm
+        self.app.save()
+        del netvm, appvm
+
+        # loaded from qubes.xml, the snapshot is written on save
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+            snapshot=True)
+        self.addCleanup(app.close)
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml.snapshot'))
+        app.save()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml.snapshot'))
+        return app
+
+    def test_340_snapshot_load(self):
+        orig_app = self._setup_snapshot()
+        stopwatch = qubes.utils.Stopwatch()
+        with mock.patch('lxml.etree.parse') as mock_parse:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True, stopwatch=stopwatch)
+            self.addCleanup(app.close)
+        self.assertFalse(mock_parse.called)
+        self.assertNotIn('parse qubes.xml', stopwatch.steps)
+        self.assertEqual(app.xml_serialize(), orig_app.xml_serialize())
+
+        appvm = app.domains['test-vm']
+        self.assertIs(appvm.netvm, app.domains['test-net'])
+        self.assertIs(appvm.template, app.domains['test-template'])
+        self.assertIs(app.default_netvm, app.domains['test-net'])
+        self.assertIs(appvm.label, app.labels[1])
+        self.assertEqual(appvm.memory, 500)
+        self.assertEqual(appvm.features['test-feature'], 'multi\nline')
+        self.assertIn('test-tag', appvm.tags)
+        self.assertEqual(
+            [(dev.backend_domain, dev.ident, dev.options) for dev in
+                appvm.devices['testclass'].assignments(persistent=True)],
+            [(app.domains['test-net'], '1234', {'opt': 'value'})])
+        self.assertTrue(appvm.events_enabled)
+        self.assertEqual(
+            {vm.name: vm.volume_config for vm in app.domains if vm.qid},
+            {vm.name: vm.volume_config for vm in orig_app.domains if vm.qid})
+
+    def test_341_snapshot_stale(self):
+        self._setup_snapshot()
+        # qubes.xml modified by something not using the snapshot
+        self.app.default_kernel = 'other'
+        self.app.save()
+        with mock.patch('lxml.etree.parse',
+                side_effect=lxml.etree.parse) as mock_parse:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True)
+            self.addCleanup(app.close)
+        self.assertTrue(mock_parse.called)
+        self.assertEqual(app.default_kernel, 'other')
+
+    def test_342_snapshot_corrupted(self):
+        self._setup_snapshot()
+        with open('/tmp/qubestest.xml.snapshot', 'rb') as snapshot_file:
+            header = snapshot_file.readline()
+        with open('/tmp/qubestest.xml.snapshot', 'wb') as snapshot_file:
+            snapshot_file.write(header + b'{"labels": [\n')
+        with mock.patch('lxml.etree.parse',
+                side_effect=lxml.etree.parse) as mock_parse:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True)
+            self.addCleanup(app.close)
+        self.assertTrue(mock_parse.called)
+        self.assertEqual(len(app.domains), 4)
+
+    def test_343_snapshot_load_failed(self):
+        orig_app = self._setup_snapshot()
+        with open('/tmp/qubestest.xml.snapshot', 'rb') as snapshot_file:
+            lines = snapshot_file.readlines()
+        # reference to a domain which does not exist, found only in stage 4
+        lines[-1] = lines[-1].replace(b'"test-net"', b'"no-such-vm"')
+        with open('/tmp/qubestest.xml.snapshot', 'wb') as snapshot_file:
+            snapshot_file.writelines(lines)
+
+        with mock.patch('lxml.etree.parse',
+                side_effect=lxml.etree.parse) as mock_parse:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True)
+            self.addCleanup(app.close)
+        self.assertTrue(mock_parse.called)
+        self.assertEqual(app.xml_serialize(), orig_app.xml_serialize())
+        self.assertEqual(sorted(app.domains.names()),
+            sorted(orig_app.domains.names()))
+
+    def test_344_snapshot_lazy(self):
+        self._setup_snapshot()
+        with mock.patch('lxml.etree.parse',
+                side_effect=lxml.etree.parse) as mock_parse:
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True, lazy=True)
+            self.addCleanup(app.close)
+        self.assertTrue(mock_parse.called)
+        self.assertIsNone(app.snapshot)
+
+    def test_345_snapshot_not_rewritten(self):
+        app = self._setup_snapshot()
+        snapshot_stat = os.stat('/tmp/qubestest.xml.snapshot')
+        with mock.patch.object(qubes.app.StoreSnapshot, 'dump_domain') \
+                as mock_dump:
+            app.save()
+            self.assertFalse(mock_dump.called)
+        self.assertEqual(os.stat('/tmp/qubestest.xml.snapshot'),
+            snapshot_stat)
+        # still valid for the rewritten qubes.xml
+        with mock.patch('lxml.etree.parse') as mock_parse:
+            qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True).close()
+        self.assertFalse(mock_parse.called)
+
+        app.domains['test-vm'].memory = 600
+        app.save()
+        self.assertNotEqual(os.stat('/tmp/qubestest.xml.snapshot'),
+            snapshot_stat)
+        with mock.patch('lxml.etree.parse') as mock_parse:
+            new_app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True)
+            self.addCleanup(new_app.close)
+        self.assertFalse(mock_parse.called)
+        self.assertEqual(new_app.domains['test-vm'].memory, 600)
+
+    @staticmethod
+    def _loaded_state(app):
+        '''Everything the loading sets up, in comparable form'''
+        # pylint: disable=protected-access
+        def properties(holder):
+            result = {}
+            for prop in holder.property_list():
+                try:
+                    value = getattr(holder, prop.__name__)
+                except AttributeError:
+                    continue
+                except qubes.exc.QubesException as e:
+                    # default computed from the running system
+                    value = ('error', str(e))
+                if isinstance(value, qubes.vm.BaseVM):
+                    value = ('vm', value.name)
+                elif isinstance(value, qubes.Label):
+                    value = ('label', value.index, value.color, value.name)
+                elif isinstance(value, qubes.storage.Pool):
+                    value = ('pool', value.name)
+                result[prop.__name__] = \
+                    (holder.property_is_default(prop), value)
+            return result
+
+        domains = {}
+        for vm in app.domains:
+            domains[vm.name] = {
+                'class': type(vm).__name__,
+                'properties': properties(vm),
+                'volume_config': getattr(vm, 'volume_config', None),
+                'volumes': {name: volume.config
+                    for name, volume in vm.volumes.items()},
+                'features': dict(vm.features),
+                'tags': sorted(vm.tags),
+                'devices': sorted(
+                    (devclass, dev.backend_domain.name, dev.ident,
+                        sorted(dev.options.items()))
+                    for devclass in vm.devices
+                    for dev in vm.devices[devclass].assignments(
+                        persistent=True)),
+                'events_enabled': vm.events_enabled,
+            }
+        return {
+            'properties': properties(app),
+            'labels': sorted((label.index, label.color, label.name)
+                for label in app.labels.values()),
+            'pools': sorted(app.pools),
+            'domains': domains,
+            'name_index': dict(app.domains._name_index),
+            'uuid_index': dict(app.domains._uuid_index),
+        }
+
+    def test_346_snapshot_equivalent(self):
+        self.app.add_new_vm('StandaloneVM', name='test-standalone',
+            label='blue', kernel=None)
+        self.app.add_new_vm('AppVM', name='test-dvm',
+            template=self.template, label='orange',
+            template_for_dispvms=True)
+        self.template.features['updates-available'] = True
+        orig_app = self._setup_snapshot()
+        orig_app.domains['test-vm'].default_dispvm = \
+            orig_app.domains['test-dvm']
+        orig_app.save()
+
+        from_xml = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(from_xml.close)
+        with mock.patch('lxml.etree.parse') as mock_parse:
+            from_snapshot = qubes.Qubes('/tmp/qubestest.xml',
+                offline_mode=True, snapshot=True)
+            self.addCleanup(from_snapshot.close)
+        self.assertFalse(mock_parse.called)
+
+        xml_state = self._loaded_state(from_xml)
+        self.assertEqual(
+            sorted(xml_state['domains']),
+            ['dom0', 'test-dvm', 'test-net', 'test-standalone',
+                'test-template', 'test-vm'])
+        self.assertEqual(self._loaded_state(from_snapshot), xml_state)
+
+        for vm in from_snapshot.domains:
+            self.assertIs(from_snapshot.domains[vm.name], vm)
+            if vm.qid:
+                self.assertIs(from_snapshot.domains[vm.uuid], vm)
+
     @qubes.tests.skipUnlessGit
     def test_900_example_xml_in_doc(self):
         self.assertXMLIsValid(
             lxml.etree.parse(open(
                 os.path.join(qubes.tests.in_git, 'doc/example.xml'), 'rb')),
             'qubes.rng')
+
+
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_91_QubesSaveBenchmark(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+            offline_mode=True)
+        self.addCleanup(self.cleanup_qubes)
+        self.app.load_initial_values()
+        self.app.default_kernel = 'dummy'
+        self.template = self.app.add_new_vm('TemplateVM',
+            name='test-template', label='green')
+
+    def cleanup_qubes(self):
+        self.app.close()
+        del self.app
+        del self.template
+        try:
+            os.unlink('/tmp/qubestest.xml')
+        except FileNotFoundError:
+            pass
+
+    def test_000_save(self):
+        vms = []
+        for count in (10, 100, 250):
+            while len(vms) < count:
+                vms.append(self.app.add_new_vm('AppVM',
+                    name='test-vm{}'.format(len(vms)),
+                    template=self.template, label='red'))
+
+            def modify_one():
+                vms[0].features['test-feature'] = \
+                    str(int(vms[0].features.get('test-feature', 0)) + 1)
+            def full():
+                modify_one()
+                lxml.etree.tostring(self.app.__xml__(),
+                    encoding='utf-8', pretty_print=True)
+            def incremental():
+                modify_one()
+                self.app.xml_serialize()
+            def save():
+                modify_one()
+                self.app.save(lock=False)
+
+            time_full = self.benchmark(
+                'full serialization ({} VMs)'.format(count), full, number=10)
+            time_incremental = self.benchmark(
+                'incremental serialization ({} VMs)'.format(count),
+                incremental, number=10)
+            self.benchmark('save() ({} VMs)'.format(count), save, number=10)
+            self.assertLess(time_incremental, time_full)
+        del vms
+
+
+class TC_92_DelayedSave(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+            offline_mode=True)
+        self.addCleanup(self.cleanup_qubes)
+        self.app.load_initial_values()
+        self.app.default_kernel = 'dummy'
+
+    def cleanup_qubes(self):
+        self.app.close()
+        del self.app
+        try:
+            os.unlink('/tmp/qubestest.xml')
+        except FileNotFoundError:
+            pass
+
+    def test_000_sync_by_default(self):
+        self.assertIsNone(self.app.save())
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+
+    def test_001_coalesce(self):
+        delayed_save = self.app.enable_delayed_save(quiet_period=0.01,
+            max_delay=1, loop=self.loop)
+        with mock.patch.object(self.app, '_write_store') as mock_save:
+            futures = [self.app.save() for _ in range(5)]
+            self.assertFalse(mock_save.called)
+            self.loop.run_until_complete(asyncio.wait(futures))
+            mock_save.assert_called_once_with(mock.ANY, lock=True)
+        for future in futures:
+            self.assertIsNone(future.result())
+        self.assertEqual(delayed_save.get_stats(), {
+            'requested': 5,
+            'saved': 1,
+            'coalesced': 4,
+            'failed': 0,
+            'pending': False,
+        })
+
+    def test_002_max_delay(self):
+        self.app.enable_delayed_save(quiet_period=60, max_delay=0.01,
+            loop=self.loop)
+        with mock.patch.object(self.app, '_write_store') as mock_save:
+            future = self.app.save()
+            self.loop.run_until_complete(asyncio.wait_for(future, 1))
+            mock_save.assert_called_once_with(mock.ANY, lock=True)
+
+    def test_003_lock(self):
+        self.app.enable_delayed_save(quiet_period=0.01, loop=self.loop)
+        with mock.patch.object(self.app, '_write_store') as mock_save:
+            self.loop.run_until_complete(self.app.save(lock=False))
+            mock_save.assert_called_once_with(mock.ANY, lock=False)
+            mock_save.reset_mock()
+            futures = [self.app.save(lock=False), self.app.save()]
+            self.loop.run_until_complete(asyncio.wait(futures))
+            mock_save.assert_called_once_with(mock.ANY, lock=True)
+
+    def test_004_failure(self):
+        delayed_save = self.app.enable_delayed_save(quiet_period=0.01,
+            loop=self.loop)
+        with mock.patch.object(self.app, '_write_store') as mock_save:
+            mock_save.side_effect = OSError('No space left on device')
+            with self.assertLogs('app', 'ERROR'):
+                future = self.app.save()
+                self.loop.run_until_complete(asyncio.wait([future]))
+            self.assertIsInstance(future.exception(), OSError)
+            self.assertTrue(delayed_save.dirty)
+            self.assertEqual(delayed_save.failed, 1)
+
+            # retried on the final flush
+            mock_save.side_effect = None
+            mock_save.reset_mock()
+            self.app.disable_delayed_save()
+            mock_save.assert_called_once_with(mock.ANY, lock=True)
+        self.assertFalse(delayed_save.dirty)
+
+    def test_005_flush_on_disable(self):
+        self.app.enable_delayed_save(quiet_period=60, loop=self.loop)
+        future = self.app.save()
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml'))
+        self.app.disable_delayed_save()
+        self.assertTrue(future.done())
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+        self.assertIsNone(self.app.delayed_save)
+        self.assertIsNone(self.app.save())
+        # let the loop drop the cancelled timer
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_006_flush_on_close(self):
+        self.app.enable_delayed_save(quiet_period=60, loop=self.loop)
+        self.app.save()
+        self.app.close()
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+            offline_mode=True)
+
+    def test_007_flush_save(self):
+        delayed_save = self.app.enable_delayed_save(quiet_period=60,
+            loop=self.loop)
+        with mock.patch.object(self.app, '_write_store') as mock_save:
+            # nothing to do
+            self.app.flush_save()
+            self.assertFalse(mock_save.called)
+
+            future = self.app.save()
+            self.app.flush_save()
+            mock_save.assert_called_once_with(mock.ANY, lock=True)
+            self.assertTrue(future.done())
+            self.assertFalse(delayed_save.dirty)
+
+            mock_save.reset_mock()
+            mock_save.side_effect = OSError('No space left on device')
+            self.app.save()
+            with self.assertLogs('app', 'ERROR'):
+                with self.assertRaises(OSError):
+                    self.app.flush_save()
+            self.assertTrue(delayed_save.dirty)
+            mock_save.side_effect = None
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_008_written_in_thread(self):
+        self.app.enable_delayed_save(quiet_period=0.01, loop=self.loop)
+        threads = []
+        with mock.patch.object(self.app, '_write_store',
+                side_effect=lambda data, lock:
+                    threads.append(threading.current_thread())) as mock_save:
+            self.loop.run_until_complete(self.app.save())
+            mock_save.assert_called_once_with(
+                (self.app.xml_serialize(), None), lock=True)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_009_sync(self):
+        delayed_save = self.app.enable_delayed_save(quiet_period=60,
+            loop=self.loop)
+        # nothing to do
+        self.loop.run_until_complete(delayed_save.sync())
+        self.assertFalse(os.path.exists('/tmp/qubestest.xml'))
+
+        self.app.save()
+        self.app.save()
+        self.loop.run_until_complete(asyncio.wait_for(
+            asyncio.gather(delayed_save.sync(), delayed_save.sync()), 1))
+        self.assertTrue(os.path.exists('/tmp/qubestest.xml'))
+        self.assertFalse(delayed_save.dirty)
+        self.assertEqual(delayed_save.saved, 1)
+
+    def test_010_changes_during_write(self):
+        delayed_save = self.app.enable_delayed_save(quiet_period=0.01,
+            loop=self.loop)
+        started = threading.Event()
+        release = threading.Event()
+        written = []
+
+        def write_store(data, lock):
+            # pylint: disable=unused-argument
+            started.set()
+            release.wait(1)
+            written.append(data[0])
+
+        with mock.patch.object(self.app, '_write_store',
+                side_effect=write_store):
+            future1 = self.app.save()
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            self.assertTrue(started.wait(1))
+            self.app.default_kernel = 'other'
+            future2 = self.app.save()
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            # the second write waits for the first one
+            self.assertEqual(written, [])
+            release.set()
+            self.loop.run_until_complete(asyncio.wait_for(
+                asyncio.gather(future1, future2), 1))
+        self.assertEqual(len(written), 2)
+        self.assertNotIn(b'other', written[0])
+        self.assertIn(b'other', written[1])
+        self.assertEqual(delayed_save.saved, 2)
+
+
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_93_QubesStartupBenchmark(qubes.tests.QubesTestCase):
+    '''Load and save of synthetic qubes.xml files of various sizes'''
+
+    sizes = (10, 100, 500)
+
+    def setUp(self):
+        super().setUp()
+        # more VMs than qids available by default
+        max_qid_patch = mock.patch.object(qubes.config, 'max_qid', 1000)
+        max_qid_patch.start()
+        self.addCleanup(max_qid_patch.stop)
+
+    def tearDown(self):
+        for path in ('/tmp/qubestest.xml', '/tmp/qubestest.xml.snapshot'):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        super().tearDown()
+
+    @staticmethod
+    def generate_xml(count):
+        '''Write qubes.xml with a template, a netvm and *count* AppVMs'''
+        app = qubes.Qubes('/tmp/qubestest.xml', load=False,
+            offline_mode=True)
+        app.load_initial_values()
+        app.default_kernel = 'dummy'
+        app.default_template = app.add_new_vm('TemplateVM',
+            name='test-template', label='green')
+        app.default_netvm = app.add_new_vm('AppVM', name='test-net',
+            label='red', provides_network=True)
+        for i in range(count):
+            vm = app.add_new_vm('AppVM', name='test-vm{}'.format(i),
+                label='red')
+            vm.memory = 400
+            vm.features['test-feature'] = '1'
+            vm.tags.add('test-tag')
+        app.save(lock=False)
+        app.close()
+
+    def test_000_load(self):
+        for count in self.sizes:
+            self.generate_xml(count)
+            self.benchmark('Qubes.load() ({} VMs)'.format(count),
+                lambda: qubes.Qubes('/tmp/qubestest.xml',
+                    offline_mode=True).close(),
+                number=3)
+
+    def test_001_save(self):
+        for count in self.sizes:
+            self.generate_xml(count)
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+            try:
+                self.benchmark('Qubes.save() ({} VMs)'.format(count),
+                    lambda: app.save(lock=False), number=3)
+            finally:
+                app.close()
+            del app
+
+    def test_002_load_profile(self):
+        self.generate_xml(self.sizes[-1])
+        stopwatch = qubes.utils.Stopwatch()
+        qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+            stopwatch=stopwatch).close()
+        self.log.info('load profile (%d VMs):\n%s', self.sizes[-1],
+            stopwatch.format_report())
+        self.assertIn('stage 2: domains', stopwatch.steps)
+
+    def test_003_property_set(self):
+        self.generate_xml(self.sizes[0])
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+        self.addCleanup(app.close)
+        app.events_enabled = False
+
+        def set_property():
+            app.check_updates_vm = True
+        time_fast = self.benchmark('property set, no handlers',
+            set_property, number=10000)
+        app.events_enabled = True
+        app.add_handler('property-set:check_updates_vm',
+            lambda subject, event, **kwargs: None)
+        time_slow = self.benchmark('property set, with handler',
+            set_property, number=10000)
+        self.assertLess(time_fast, time_slow)
+
+    def test_004_lazy_load(self):
+        self.generate_xml(self.sizes[-1])
+        def load_one():
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True)
+            app.domains['test-vm0'].features.get('test-feature')
+            app.close()
+        def load_one_lazy():
+            app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                lazy=True)
+            app.domains['test-vm0'].features.get('test-feature')
+            app.close()
+        time_full = self.benchmark(
+            'access one VM ({} VMs)'.format(self.sizes[-1]),
+            load_one, number=3)
+        time_lazy = self.benchmark(
+            'access one VM, lazy ({} VMs)'.format(self.sizes[-1]),
+            load_one_lazy, number=3)
+        self.assertLess(time_lazy, time_full)
+
+    def test_005_snapshot_load(self):
+        count = self.sizes[-1]
+        self.generate_xml(count)
+        app = qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+            snapshot=True)
+        try:
+            self.benchmark('Qubes.save() with snapshot ({} VMs)'.format(count),
+                lambda: app.save(lock=False), number=3)
+        finally:
+            app.close()
+        del app
+
+        def load_cold():
+            qubes.Qubes('/tmp/qubestest.xml', offline_mode=True).close()
+        def load_warm():
+            qubes.Qubes('/tmp/qubestest.xml', offline_mode=True,
+                snapshot=True).close()
+        time_cold = self.benchmark(
+            'Qubes.load() from qubes.xml ({} VMs)'.format(count),
+            load_cold, number=3)
+        time_warm = self.benchmark(
+            'Qubes.load() from snapshot ({} VMs)'.format(count),
+            load_warm, number=3)
+        self.assertLess(time_warm, time_cold)
@@ -0,0 +1,288 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+
+import qubes.bulk
+import qubes.exc
+import qubes.tests
+
+
+class TestVM(object):
+    def __init__(self, log, name, qid=1, netvm=None, running=False,
+            provides_network=False):
+        self.log = log
+        self.name = name
+        self.qid = qid
+        self.netvm = netvm
+        self.running = running
+        self.provides_network = provides_network
+        #: exceptions raised by consecutive start() calls
+        self.start_errors = []
+        #: ignore shutdown() calls
+        self.hang = False
+        self.halted = asyncio.Event()
+
+    def __str__(self):
+        return self.name
+
+    def is_running(self):
+        return self.running
+
+    def is_halted(self):
+        return not self.running
+
+    @asyncio.coroutine
+    def shutdown(self):
+        self.log.append(('shutdown', self.name))
+        if not self.hang:
+            asyncio.get_event_loop().call_later(0.01,
+                lambda: asyncio.ensure_future(self.stopped()))
+
+    @asyncio.coroutine
+    def kill(self):
+        self.log.append(('kill', self.name))
+        asyncio.ensure_future(self.stopped())
+
+    @asyncio.coroutine
+    def stopped(self):
+        yield from asyncio.sleep(0)
+        self.running = False
+        self.log.append(('halted', self.name))
+        self.halted.set()
+
+    @asyncio.coroutine
+    def wait_halted(self, timeout=None):
+        if self.running:
+            yield from asyncio.wait_for(self.halted.wait(), timeout)
+
+    @asyncio.coroutine
+    def start(self):
+        if self.running:
+            return self
+        self.log.append(('start', self.name))
+        yield from asyncio.sleep(0.01)
+        if self.start_errors:
+            exc = self.start_errors.pop(0)
+            self.log.append(('failed', self.name))
+            raise exc
+        if self.netvm is not None and self.netvm.qid != 0:
+            assert self.netvm.running
+        self.running = True
+        self.log.append(('running', self.name))
+        return self
+
+
+class TC_00_StartScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_StartScheduler, self).setUp()
+        self.log = []
+        self.events = []
+        self.dom0 = TestVM(self.log, 'dom0', qid=0, running=True)
+        self.sys_net = TestVM(self.log, 'sys-net', netvm=None)
+        self.sys_firewall = TestVM(self.log, 'sys-firewall',
+            netvm=self.sys_net)
+        self.work = TestVM(self.log, 'work', netvm=self.sys_firewall)
+        self.personal = TestVM(self.log, 'personal', netvm=self.sys_firewall)
+        self.vault = TestVM(self.log, 'vault')
+
+    def notify(self, vm, event, **kwargs):
+        self.events.append((vm.name, event, kwargs))
+
+    def run_scheduler(self, vms, **kwargs):
+        scheduler = qubes.bulk.StartScheduler(None, vms, notify=self.notify,
+            **kwargs)
+        return scheduler, self.loop.run_until_complete(scheduler.run())
+
+    def test_000_dependencies(self):
+        scheduler = qubes.bulk.StartScheduler(None,
+            [self.work, self.vault, self.dom0])
+        self.assertEqual(scheduler.order,
+            [self.sys_net, self.vault, self.sys_firewall, self.work])
+        self.assertEqual(scheduler.dependencies, {
+            self.sys_firewall: self.sys_net,
+            self.work: self.sys_firewall,
+        })
+
+    def test_001_dependencies_running_netvm(self):
+        self.sys_firewall.running = True
+        scheduler = qubes.bulk.StartScheduler(None, [self.work])
+        self.assertEqual(scheduler.order, [self.work])
+        self.assertEqual(scheduler.dependencies, {})
+
+    def test_010_start(self):
+        _, results = self.run_scheduler(
+            [self.work, self.personal, self.vault])
+        self.assertEqual(results, dict.fromkeys([self.sys_net,
+            self.sys_firewall, self.work, self.personal, self.vault]))
+        self.assertTrue(all(vm.running for vm in results))
+        # independent branches are started concurrently
+        self.assertEqual(self.log[:2],
+            [('start', 'sys-net'), ('start', 'vault')])
+        self.assertLess(self.log.index(('running', 'sys-firewall')),
+            self.log.index(('start', 'work')))
+        self.assertLess(self.log.index(('start', 'personal')),
+            self.log.index(('running', 'work')))
+        self.assertIn(('work', 'start-many-queued', {}), self.events)
+        self.assertIn(('work', 'start-many-starting', {}), self.events)
+        self.assertEqual(self.events[-1][1], 'start-many-started')
+
+    def test_011_concurrency_limit(self):
+        vms = [TestVM(self.log, 'vm{}'.format(i)) for i in range(4)]
+        self.run_scheduler(vms, max_concurrency=1)
+        self.assertEqual(self.log, [
+            ('start', 'vm0'), ('running', 'vm0'),
+            ('start', 'vm1'), ('running', 'vm1'),
+            ('start', 'vm2'), ('running', 'vm2'),
+            ('start', 'vm3'), ('running', 'vm3'),
+        ])
+
+    def test_012_netvm_failed(self):
+        self.sys_net.start_errors.append(
+            qubes.exc.QubesVMError(self.sys_net, 'failed'))
+        _, results = self.run_scheduler([self.work, self.vault])
+        self.assertIsInstance(results[self.sys_net], qubes.exc.QubesVMError)
+        self.assertIsInstance(results[self.work], qubes.exc.QubesVMError)
+        self.assertIsNone(results[self.vault])
+        self.assertNotIn(('start', 'work'), self.log)
+        self.assertIn(('work', 'start-many-failed',
+            {'reason': 'Network VM sys-firewall of work failed to start'}),
+            self.events)
+
+    def test_013_memory_deferred(self):
+        self.vault.start_errors.append(qubes.exc.QubesMemoryError(self.vault))
+        _, results = self.run_scheduler([self.sys_net, self.vault])
+        self.assertIsNone(results[self.vault])
+        self.assertTrue(self.vault.running)
+        self.assertEqual(self.log.count(('start', 'vault')), 2)
+        self.assertIn(('vault', 'start-many-deferred', {}), self.events)
+
+    def test_014_memory_failed(self):
+        self.vault.start_errors.append(qubes.exc.QubesMemoryError(self.vault))
+        _, results = self.run_scheduler([self.vault])
+        self.assertIsInstance(results[self.vault], qubes.exc.QubesMemoryError)
+        self.assertEqual(self.log.count(('start', 'vault')), 1)
+        self.assertNotIn(('vault', 'start-many-deferred', {}), self.events)
+
+
+class TestVMCollection(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, vms):
+        self.vms = vms
+
+    def get_vms_connected_to(self, netvm):
+        connected = set()
+        new_vms = {netvm}
+        while new_vms:
+            cur_vm = new_vms.pop()
+            for vm in self.vms:
+                if vm.netvm is cur_vm and vm not in connected:
+                    connected.add(vm)
+                    new_vms.add(vm)
+        return connected
+
+
+class TestApp(object):
+    # pylint: disable=too-few-public-methods
+    def __init__(self, vms):
+        self.domains = TestVMCollection(vms)
+
+
+class TC_10_ShutdownScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_10_ShutdownScheduler, self).setUp()
+        self.log = []
+        self.events = []
+        self.dom0 = TestVM(self.log, 'dom0', qid=0, running=True)
+        self.sys_net = TestVM(self.log, 'sys-net', running=True,
+            provides_network=True)
+        self.sys_firewall = TestVM(self.log, 'sys-firewall',
+            netvm=self.sys_net, running=True, provides_network=True)
+        self.work = TestVM(self.log, 'work', netvm=self.sys_firewall,
+            running=True)
+        self.personal = TestVM(self.log, 'personal',
+            netvm=self.sys_firewall, running=True)
+        self.halted = TestVM(self.log, 'halted', netvm=self.sys_firewall)
+        self.vault = TestVM(self.log, 'vault', running=True)
+        self.app = TestApp([self.dom0, self.sys_net, self.sys_firewall,
+            self.work, self.personal, self.halted, self.vault])
+
+    def notify(self, vm, event, **kwargs):
+        self.events.append((vm.name, event, kwargs))
+
+    def run_scheduler(self, vms, **kwargs):
+        scheduler = qubes.bulk.ShutdownScheduler(self.app, vms,
+            notify=self.notify, **kwargs)
+        results = self.loop.run_until_complete(scheduler.run())
+        # let the remaining domain-shutdown handlers finish
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return scheduler, results
+
+    def test_000_dependencies(self):
+        scheduler = qubes.bulk.ShutdownScheduler(self.app,
+            [self.sys_net, self.vault, self.dom0])
+        self.assertEqual(scheduler.order, [self.personal, self.vault,
+            self.work, self.sys_firewall, self.sys_net])
+        self.assertEqual(scheduler.dependencies, {
+            self.sys_net: {self.sys_firewall},
+            self.sys_firewall: {self.work, self.personal},
+        })
+
+    def test_010_shutdown(self):
+        _, results = self.run_scheduler([self.sys_net, self.vault])
+        self.assertEqual(results, dict.fromkeys([self.sys_net,
+            self.sys_firewall, self.work, self.personal, self.vault]))
+        self.assertTrue(all(not vm.running for vm in results))
+        # independent domains are shut down concurrently
+        self.assertEqual(self.log[:3], [('shutdown', 'personal'),
+            ('shutdown', 'vault'), ('shutdown', 'work')])
+        self.assertLess(self.log.index(('halted', 'work')),
+            self.log.index(('shutdown', 'sys-firewall')))
+        self.assertLess(self.log.index(('halted', 'sys-firewall')),
+            self.log.index(('shutdown', 'sys-net')))
+        self.assertNotIn(('shutdown', 'halted'), self.log)
+        self.assertIn(('work', 'shutdown-many-queued', {}), self.events)
+        self.assertIn(('work', 'shutdown-many-stopping', {}), self.events)
+        self.assertEqual(self.events[-1],
+            ('sys-net', 'shutdown-many-halted', {}))
+
+    def test_011_timeout(self):
+        self.work.hang = True
+        _, results = self.run_scheduler([self.sys_firewall], timeout=0.05)
+        self.assertEqual(results, dict.fromkeys([self.sys_firewall,
+            self.work, self.personal]))
+        self.assertIn(('kill', 'work'), self.log)
+        self.assertNotIn(('kill', 'personal'), self.log)
+        self.assertIn(('work', 'shutdown-many-killing', {}), self.events)
+        self.assertFalse(self.sys_firewall.running)
+
+    def test_012_client_failed(self):
+        @asyncio.coroutine
+        def shutdown():
+            raise qubes.exc.QubesVMError(self.work, 'failed')
+        self.work.shutdown = shutdown
+        _, results = self.run_scheduler([self.sys_net])
+        self.assertIsInstance(results[self.work], qubes.exc.QubesVMError)
+        self.assertIsInstance(results[self.sys_firewall],
+            qubes.exc.QubesVMError)
+        self.assertIsInstance(results[self.sys_net], qubes.exc.QubesVMError)
+        self.assertIsNone(results[self.personal])
+        self.assertTrue(self.sys_firewall.running)
+        self.assertNotIn(('shutdown', 'sys-firewall'), self.log)
+        self.assertIn(('sys-firewall', 'shutdown-many-failed',
+            {'reason': 'Domains connected to sys-firewall failed to shut '
+                'down: work'}), self.events)
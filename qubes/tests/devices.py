@@ -57,6 +57,9 @@ class TestVM(qubes.tests.TestEmitter):
     def __str__(self):
         return self.name
 
+    def invalidate_xml_cache(self):
+        pass
+
     @qubes.events.handler('device-list-attached:testclass')
     def dev_testclass_list_attached(self, event, persistent = False):
         for vm in self.app.domains:
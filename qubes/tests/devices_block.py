@@ -21,6 +21,7 @@
 from unittest import mock
 
 import jinja2
+import lxml.etree
 
 import qubes.tests
 import qubes.ext.block
@@ -126,6 +127,13 @@ class TestVM(object):
                 'XMLDesc.return_value': domain_xml
             })
 
+    @property
+    def libvirt_xml(self):
+        return lxml.etree.fromstring(self.libvirt_domain.XMLDesc())
+
+    def invalidate_libvirt_cache(self):
+        pass
+
     def __eq__(self, other):
         if isinstance(other, TestVM):
             return self.name == other.name
@@ -20,6 +20,7 @@
 import asyncio
 
 import qubes.events
+import qubes.ext
 import qubes.tests
 
 class TC_00_Emitter(qubes.tests.QubesTestCase):
@@ -165,3 +166,132 @@ class TC_00_Emitter(qubes.tests.QubesTestCase):
 
         self.assertCountEqual(effect,
             ('testvalue1', 'testvalue2', 'testvalue3', 'testvalue4'))
+
+    def test_006_dispatch_cache(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        with self.subTest('add_handler'):
+            emitter.add_handler('testevent', on_testevent_2)
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1', 'testevent_2'])
+
+        with self.subTest('remove_handler'):
+            emitter.remove_handler('testevent', on_testevent_2)
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1'])
+            self.assertNotIn('testevent', emitter.__handlers__)
+
+        with self.subTest('class_handlers'):
+            TestEmitter.__handlers__['testevent'].add(on_testevent_2)
+            qubes.events.invalidate_dispatch_cache()
+            self.assertEqual(emitter.fire_event('testevent'),
+                ['testevent_1', 'testevent_2'])
+
+    def test_007_dispatch_cache_extension(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        class TestExtension(qubes.ext.Extension):
+            # pylint: disable=too-few-public-methods
+            @qubes.ext.handler('testevent', vm=TestEmitter)
+            def on_testevent_2(self, subject, event):
+                # pylint: disable=no-self-use,unused-argument
+                yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+
+        TestExtension()
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+
+    def test_008_profile_handlers(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                pass
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+
+        calls = []
+        with qubes.events.profile_handlers(
+                lambda func, event, seconds: calls.append((func, event))):
+            emitter.fire_event('testevent')
+        emitter.fire_event('testevent')
+        self.assertEqual(calls,
+            [(TestEmitter.on_testevent_1, 'testevent')])
+
+    def test_009_instance_handlers_keep_dispatch_cache(self):
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent_1(self, event):
+                yield 'testevent_1'
+
+        def on_testevent_2(subject, event):
+            yield 'testevent_2'
+
+        emitter = TestEmitter()
+        emitter.events_enabled = True
+        emitter.fire_event('testevent')
+        dispatch = TestEmitter.__dispatch__['testevent']
+
+        emitter.add_handler('testevent', on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'),
+            ['testevent_1', 'testevent_2'])
+        emitter.remove_handler('testevent', on_testevent_2)
+        self.assertEqual(emitter.fire_event('testevent'), ['testevent_1'])
+        self.assertIs(TestEmitter.__dispatch__['testevent'], dispatch)
+
+
+@qubes.tests.skipUnlessEnv('QUBES_TEST_BENCHMARK')
+class TC_90_EmitterBenchmark(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super().setUp()
+
+        class TestEmitter(qubes.events.Emitter):
+            @qubes.events.handler('testevent')
+            def on_testevent(self, event):
+                pass
+
+        class TestEmitter2(TestEmitter):
+            @qubes.events.handler('*')
+            def on_all(self, event):
+                pass
+
+        self.emitter = TestEmitter()
+        self.emitter.events_enabled = True
+        self.emitter2 = TestEmitter2()
+        self.emitter2.events_enabled = True
+
+    def bench_fire(self, label, emitter, event):
+        def uncached():
+            qubes.events.invalidate_dispatch_cache()
+            emitter.fire_event(event)
+        time_cached = self.benchmark(label + ' (cached)',
+            lambda: emitter.fire_event(event), number=100000)
+        time_uncached = self.benchmark(label + ' (uncached)',
+            uncached, number=100000)
+        self.assertLess(time_cached, time_uncached)
+
+    def test_000_no_handler(self):
+        self.bench_fire('no handler', self.emitter, 'otherevent')
+
+    def test_001_class_handler(self):
+        self.bench_fire('class handler', self.emitter, 'testevent')
+
+    def test_002_wildcard(self):
+        self.bench_fire('wildcard handler', self.emitter2, 'otherevent')
@@ -21,6 +21,7 @@
 #
 
 import unittest
+import unittest.mock
 import uuid
 
 import lxml.etree
@@ -319,6 +320,65 @@ class TC_20_PropertyHolder(qubes.tests.QubesTestCase):
     def test_010_property_require(self):
         pass
 
+    def test_020_property_list_cache(self):
+        class MyTestHolder(qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1')
+
+        holder = MyTestHolder(None)
+        self.assertEqual(holder.property_list(), ['testprop1'])
+
+        MyTestHolder.testprop2 = qubes.property('testprop2', load_stage=3)
+        self.assertEqual(holder.property_list(), ['testprop1', 'testprop2'])
+        self.assertEqual(holder.property_list(3), ['testprop2'])
+        self.assertIs(holder.property_get_def('testprop2'),
+            MyTestHolder.testprop2)
+
+        del MyTestHolder.testprop2
+        self.assertEqual(holder.property_list(), ['testprop1'])
+        self.assertEqual(holder.property_list(3), [])
+        with self.assertRaises(AttributeError):
+            holder.property_get_def('testprop2')
+
+        # returned list is a copy
+        holder.property_list().clear()
+        self.assertEqual(holder.property_list(), ['testprop1'])
+
+    def test_021_set_no_handlers(self):
+        default = unittest.mock.Mock(return_value='defaultvalue')
+
+        class MyTestHolder(qubes.PropertyHolder):
+            testprop1 = qubes.property('testprop1', default=default)
+
+        holder = MyTestHolder(None)
+        holder.events_enabled = True
+        holder.testprop1 = 'testvalue1'
+        self.assertEqual(holder.testprop1, 'testvalue1')
+        self.assertFalse(default.called)
+
+        events = []
+        holder.add_handler('property-set:testprop1',
+            lambda subject, event, **kwargs: events.append(kwargs))
+        holder.testprop1 = 'testvalue2'
+        self.assertEqual(events, [{'name': 'testprop1',
+            'newvalue': 'testvalue2', 'oldvalue': 'testvalue1'}])
+
+    def test_022_load_properties_parse_once(self):
+        self.holder.load_properties(load_stage=2)
+        values = self.holder._get_xml_property_values()
+        self.assertEqual(values,
+            [('testprop1', 'testvalue1'), ('testprop2', 'testref2')])
+        self.assertIs(self.holder._get_xml_property_values(), values)
+
+        self.holder.xml = lxml.etree.XML('''
+<qubes version="3">
+    <properties>
+        <property name="testprop4">testvalue4</property>
+    </properties>
+</qubes>
+        ''')
+        self.holder.load_properties()
+        self.assertEqual(self.holder.testprop4, 'testvalue4')
+
 
 class TestVM(qubes.vm.BaseVM):
     qid = qubes.property('qid', type=int)
@@ -368,7 +428,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         del self.app
 
     def test_000_contains(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1, _enable_events=False)
 
         self.assertIn(1, self.vms)
         self.assertIn('testvm1', self.vms)
@@ -379,7 +439,7 @@ class TC_30_VMCollection(qubes.tests.QubesTestCase):
         self.assertNotIn(self.testvm2, self.vms)
 
     def test_001_getitem(self):
-        self.vms._dict = {1: self.testvm1}
+        self.vms.add(self.testvm1, _enable_events=False)
 
         self.assertIs(self.vms[1], self.testvm1)
         self.assertIs(self.vms['testvm1'], self.testvm1)
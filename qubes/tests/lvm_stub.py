@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- encoding: utf8 -*-
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+'''Stand-in for :program:`lvm` and :program:`lvs`, to test
+:py:mod:`qubes.storage.lvm` without real LVM.
+
+Only what :py:mod:`qubes.storage.lvm` uses is implemented. Logical volumes
+are kept in a JSON file, each invocation is logged, so tests can check
+which calls did overlap. Use :py:func:`install` to get :program:`lvm` and
+:program:`lvs` commands running this script.
+
+Environment variables:
+
+- ``QUBES_LVM_STUB_STATE`` - path to the JSON file with volumes
+- ``QUBES_LVM_STUB_LOG`` - path to the file to log invocations into, one
+  ``start``/``end`` line for each
+- ``QUBES_LVM_STUB_DELAY`` - seconds each invocation takes (default: 0)
+
+This file must not import anything outside of the standard library, it is
+run as a standalone script.
+'''
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+
+def install(directory, state, thin_pools=('qubes_dom0/pool00',),
+        size=100 * 1024 ** 3):
+    '''Create :program:`lvm` and :program:`lvs` commands in *directory*
+
+    Add *directory* at the beginning of :envvar:`PATH` to use them.
+
+    :param str directory: where to create the commands
+    :param str state: path to the JSON file for volumes, created with empty \
+        *thin_pools* of *size* bytes each
+    '''
+    for name in ('lvm', 'lvs'):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as script:
+            script.write('#!/bin/sh\nexec {} {} {} "$@"\n'.format(
+                sys.executable, os.path.abspath(__file__), name))
+        os.chmod(path, 0o755)
+    with open(state, 'w') as state_file:
+        json.dump({pool: {'pool_lv': '', 'size': size, 'usage': 0,
+            'attr': 'twi-a-tz--', 'origin': ''} for pool in thin_pools},
+            state_file)
+
+
+def fail(message, code=5):
+    sys.stderr.write('  {}\n'.format(message))
+    return code
+
+
+def parse_args(args):
+    '''Split options (with their values) and positional arguments'''
+    options = {}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-T', '-n', '-V', '-s', '-o', '--units', '--separator'):
+            options[arg] = args.pop(0)
+        elif arg.startswith('-L'):
+            options['-L'] = arg[2:]
+        elif arg.startswith('-'):
+            options[arg] = True
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def lvs(volumes, args):
+    _, positional = parse_args(args)
+    returncode = 0
+    for vid in positional:
+        if vid not in volumes:
+            returncode = fail('Failed to find logical volume "{}"'.format(vid))
+    for vid, info in sorted(volumes.items()):
+        if positional and vid not in positional:
+            continue
+        vg_name, name = vid.split('/', 1)
+        percent = '{:.2f}'.format(100 * info['usage'] / info['size']) \
+            if info['size'] else '0.00'
+        print('  {};{};{};{}B;{};{};{}'.format(vg_name, info['pool_lv'], name,
+            info['size'], percent, info['attr'], info['origin']))
+    return returncode
+
+
+def lvcreate(volumes, args):
+    options, _ = parse_args(args)
+    if '-T' in options:
+        vg_name, pool_lv = options['-T'].split('/', 1)
+        vid = vg_name + '/' + options['-n']
+        if options['-T'] not in volumes:
+            return fail('Thin pool {} not found'.format(options['-T']))
+        if vid in volumes:
+            return fail('Logical Volume "{}" already exists'.format(vid))
+        volumes[vid] = {'pool_lv': pool_lv, 'usage': 0,
+            'size': int(options['-V'].rstrip('B')),
+            'attr': 'Vwi-a-tz--', 'origin': ''}
+        return 0
+    origin = options['-s']
+    vid = options['-n']
+    if '/' not in vid:
+        vid = origin.split('/', 1)[0] + '/' + vid
+    if origin not in volumes:
+        return fail('Failed to find logical volume "{}"'.format(origin))
+    if vid in volumes:
+        return fail('Logical Volume "{}" already exists'.format(vid))
+    volumes[vid] = dict(volumes[origin],
+        origin=origin.split('/', 1)[1], attr='Vwi-a-tz--')
+    return 0
+
+
+def lvremove(volumes, args):
+    _, positional = parse_args(args)
+    returncode = 0
+    for vid in positional:
+        if vid not in volumes:
+            returncode = fail('Failed to find logical volume "{}"'.format(vid))
+            continue
+        del volumes[vid]
+    return returncode
+
+
+def lvextend(volumes, args):
+    options, positional = parse_args(args)
+    if positional[0] not in volumes:
+        return fail('Failed to find logical volume "{}"'.format(
+            positional[0]))
+    volumes[positional[0]]['size'] = \
+        int(float(options['-L']) * 1024 * 1024)
+    return 0
+
+
+def lvchange(volumes, args):
+    _, positional = parse_args(args)
+    if positional[0] not in volumes:
+        return fail('Failed to find logical volume "{}"'.format(
+            positional[0]))
+    return 0
+
+
+def lvrename(volumes, args):
+    _, positional = parse_args(args)
+    old, new = positional
+    if '/' not in new:
+        new = old.split('/', 1)[0] + '/' + new
+    if old not in volumes:
+        return fail('Existing logical volume "{}" not found'.format(old))
+    if new in volumes:
+        return fail('Logical Volume "{}" already exists'.format(new))
+    volumes[new] = volumes.pop(old)
+    return 0
+
+
+COMMANDS = {
+    'lvs': lvs,
+    'lvcreate': lvcreate,
+    'lvremove': lvremove,
+    'lvextend': lvextend,
+    'lvchange': lvchange,
+    'lvrename': lvrename,
+}
+
+
+def log(event, args):
+    log_path = os.environ.get('QUBES_LVM_STUB_LOG')
+    if not log_path:
+        return
+    with open(log_path, 'a') as log_file:
+        fcntl.flock(log_file, fcntl.LOCK_EX)
+        log_file.write('{} {}\n'.format(event, ' '.join(args)))
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[0] == 'lvm':
+        args = args[1:]
+    command = COMMANDS[args[0]]
+    if '--help' in args:
+        # qubes.storage.lvm checks for this option
+        print('  {} --setactivationskip y|n'.format(args[0]))
+        return 0
+
+    log('start', args)
+    time.sleep(float(os.environ.get('QUBES_LVM_STUB_DELAY', 0)))
+    with open(os.environ['QUBES_LVM_STUB_STATE'], 'r+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        volumes = json.load(state_file)
+        returncode = command(volumes, args[1:])
+        state_file.seek(0)
+        state_file.truncate()
+        json.dump(volumes, state_file)
+    log('end', args)
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+import qubes.stats
+import qubes.tests
+
+
+class TC_00_StatsRing(qubes.tests.QubesTestCase):
+    def test_000_add(self):
+        ring = qubes.stats.StatsRing(1, 10)
+        ring.add(100.2, 10, 1000)
+        ring.add(101.5, 20, 2000)
+        self.assertEqual(ring.get(), [(100, 10, 1000), (101, 20, 2000)])
+
+    def test_001_average(self):
+        ring = qubes.stats.StatsRing(60, 10)
+        ring.add(120, 10, 1000)
+        ring.add(130, 20, 2000)
+        ring.add(170, 30, 3000)
+        self.assertEqual(ring.get(), [(120, 20, 2000)])
+
+    def test_002_wrap(self):
+        ring = qubes.stats.StatsRing(1, 3)
+        for timestamp in range(100, 105):
+            ring.add(timestamp, timestamp - 100, 1000)
+        # older slots got overwritten
+        self.assertEqual([t for t, _, _ in ring.get()], [102, 103, 104])
+        self.assertEqual(len(ring.slots), 3)
+
+    def test_003_range(self):
+        ring = qubes.stats.StatsRing(1, 10)
+        for timestamp in range(100, 105):
+            ring.add(timestamp, 0, 1000)
+        self.assertEqual([t for t, _, _ in ring.get(101, 103)],
+            [101, 102, 103])
+        self.assertEqual([t for t, _, _ in ring.get(start=103)], [103, 104])
+
+
+class TC_10_StatsHistory(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_10_StatsHistory, self).setUp()
+        self.history = qubes.stats.StatsHistory(((1, 10), (60, 5)))
+
+    def test_000_tiers(self):
+        self.history.add(120, {'vm1': {'cpu_usage': 10, 'memory_kb': 100}})
+        self.history.add(121, {'vm1': {'cpu_usage': 20, 'memory_kb': 300}})
+        self.assertEqual(self.history.get('vm1', 1),
+            [(120, 10, 100), (121, 20, 300)])
+        self.assertEqual(self.history.get('vm1', 60), [(120, 15, 200)])
+        self.assertEqual(self.history.get('vm2', 60), [])
+        with self.assertRaises(KeyError):
+            self.history.get('vm1', 5)
+
+    def test_001_csv(self):
+        self.history.add(120, {'vm1': {'cpu_usage': 10, 'memory_kb': 100}})
+        self.history.add(121, {'vm1': {'cpu_usage': 5, 'memory_kb': 300}})
+        self.assertEqual(self.history.format_csv('vm1', 60),
+            'time,cpu_usage,memory_kb\n'
+            '120,7.5,200\n')
+
+    def test_002_remove(self):
+        self.history.add(120, {'vm1': {'cpu_usage': 10, 'memory_kb': 100}})
+        self.history.remove('vm1')
+        self.assertEqual(self.history.get('vm1', 1), [])
+        self.history.remove('vm1')
+
+    def test_003_memory_usage(self):
+        self.assertEqual(self.history.vm_memory_usage(), 15 * 18)
@@ -16,6 +16,9 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
+import asyncio
+import os
+import tempfile
 import unittest.mock
 import qubes.log
 import qubes.storage
@@ -23,6 +26,7 @@ from qubes.exc import QubesException
 from qubes.storage import pool_drivers
 from qubes.storage.file import FilePool
 from qubes.tests import SystemTestCase
+import qubes.tests
 
 # :pylint: disable=invalid-name
 
@@ -133,3 +137,76 @@ class TC_00_Pool(SystemTestCase):
     def assertPoolExists(self, pool):
         """ Check if specified pool exists """
         return pool in self.app.pools.keys()
+
+
+class TestAsyncVolume(object):
+    ''' Volume with coroutine methods, failing on demand '''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name, fail=None):
+        self.name = name
+        self.fail = fail
+        self.calls = []
+
+    @asyncio.coroutine
+    def _call(self, method):
+        yield from asyncio.sleep(0)
+        self.calls.append(method)
+        if method == self.fail:
+            raise qubes.storage.StoragePoolException(
+                '{} of {} failed'.format(method, self.name))
+
+    def create(self):
+        return self._call('create')
+
+    def import_volume(self, src_volume):  # pylint: disable=unused-argument
+        return self._call('import_volume')
+
+    def remove(self):
+        return self._call('remove')
+
+
+class TC_10_Storage(qubes.tests.QubesTestCase):
+    ''' Tests for :py:class:`qubes.storage.Storage` with asynchronous
+    volumes '''
+
+    def setUp(self):
+        super(TC_10_Storage, self).setUp()
+        self.dir_path = tempfile.mkdtemp()
+        self.vm = unittest.mock.Mock(spec=['app', 'log', 'dir_path',
+            'volumes'])
+        self.vm.dir_path = self.dir_path
+        self.storage = qubes.storage.Storage(self.vm)
+
+    def tearDown(self):
+        if os.path.exists(self.dir_path):
+            os.rmdir(self.dir_path)
+        super(TC_10_Storage, self).tearDown()
+
+    def test_000_create_failed(self):
+        volumes = [TestAsyncVolume('root', fail='create'),
+            TestAsyncVolume('private')]
+        self.vm.volumes = {vol.name: vol for vol in volumes}
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.loop.run_until_complete(self.storage.create())
+        self.assertEqual([vol.calls for vol in volumes],
+            [['create'], ['create']])
+
+    def test_010_clone_failed(self):
+        volumes = {'root': TestAsyncVolume('root', fail='import_volume'),
+            'private': TestAsyncVolume('private'),
+            'volatile': TestAsyncVolume('volatile', fail='create')}
+        self.vm.volume_config = {name: {'name': name, 'pool': 'test'}
+            for name in volumes}
+        self.vm.app.get_pool.return_value.init_volume.side_effect = \
+            lambda vm, config: volumes[config['name']]
+        src_vm = unittest.mock.Mock(volumes=volumes)
+
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.loop.run_until_complete(self.storage.clone(src_vm))
+        # everything created is removed, including partially cloned volume
+        self.assertEqual(volumes['root'].calls,
+            ['create', 'import_volume', 'remove'])
+        self.assertEqual(volumes['private'].calls,
+            ['create', 'import_volume', 'remove'])
+        self.assertEqual(volumes['volatile'].calls, ['create'])
+        self.assertFalse(os.path.exists(self.dir_path))
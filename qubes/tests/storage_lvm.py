@@ -25,11 +25,17 @@
     represent a :py:class:`qubes.storage.lvm.ThinPool`.
 '''
 
+import asyncio
 import os
 import subprocess
+import tempfile
+import time
 import unittest
+import unittest.mock
 
+import qubes.storage.lvm
 import qubes.tests
+import qubes.tests.lvm_stub
 from qubes.storage.lvm import ThinPool, ThinVolume
 
 if 'DEFAULT_LVM_POOL' in os.environ.keys():
@@ -134,10 +140,10 @@ class TC_00_ThinPool(ThinPoolBase):
         self.assertEqual(volume.name, 'root')
         self.assertEqual(volume.pool, self.pool.name)
         self.assertEqual(volume.size, qubes.config.defaults['root_img_size'])
-        volume.create()
+        self.loop.run_until_complete(volume.create())
         path = "/dev/%s" % volume.vid
         self.assertTrue(os.path.exists(path))
-        volume.remove()
+        self.loop.run_until_complete(volume.remove())
 
     def test_003_read_write_volume(self):
         ''' Test read-write volume creation '''
@@ -154,10 +160,10 @@ class TC_00_ThinPool(ThinPoolBase):
         self.assertEqual(volume.name, 'root')
         self.assertEqual(volume.pool, self.pool.name)
         self.assertEqual(volume.size, qubes.config.defaults['root_img_size'])
-        volume.create()
+        self.loop.run_until_complete(volume.create())
         path = "/dev/%s" % volume.vid
         self.assertTrue(os.path.exists(path))
-        volume.remove()
+        self.loop.run_until_complete(volume.remove())
 
     def test_004_size(self):
         with self.assertNotRaises(NotImplementedError):
@@ -213,3 +219,301 @@ class TC_01_ThinPool(ThinPoolBase, qubes.tests.SystemTestCase):
                 self.assertEqual(volume.path, expected)
         with self.assertNotRaises(qubes.exc.QubesException):
             vm.start()
+
+
+class TC_10_ThinVolumeStub(qubes.tests.PoolTestCase):
+    ''' Tests of :py:class:`qubes.storage.lvm.ThinVolume` using
+    :py:mod:`qubes.tests.lvm_stub` instead of real LVM '''
+
+    def setUp(self):
+        super(TC_10_ThinVolumeStub, self).setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        state = os.path.join(tmpdir.name, 'state.json')
+        self.log_path = os.path.join(tmpdir.name, 'log')
+        qubes.tests.lvm_stub.install(tmpdir.name, state)
+        patches = [
+            unittest.mock.patch.dict(os.environ, {
+                'PATH': tmpdir.name + ':' + os.environ['PATH'],
+                'QUBES_LVM_STUB_STATE': state,
+                'QUBES_LVM_STUB_LOG': self.log_path,
+            }),
+            unittest.mock.patch('os.getuid', return_value=0),
+            unittest.mock.patch.object(qubes.storage.lvm, 'size_cache',
+                qubes.storage.lvm.VolumeCache(rescan_interval=0)),
+            unittest.mock.patch.object(qubes.storage.lvm, 'lvm_is_very_old',
+                False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.pool = ThinPool(name='test-lvm', volume_group='qubes_dom0',
+            thin_pool='pool00')
+
+    def get_log(self):
+        with open(self.log_path) as log_file:
+            return [line.split()[:2] for line in log_file]
+
+    def get_lvs_calls(self):
+        ''' Volumes listed by each :program:`lvs` call, empty list for all '''
+        with open(self.log_path) as log_file:
+            return [line.split()[9:] for line in log_file
+                if line.startswith('start lvs ')]
+
+    def create_externally(self, name):
+        subprocess.check_call(['lvm', 'lvcreate', '-T', 'qubes_dom0/pool00',
+            '-n', name, '-V', '1024B'])
+
+    def test_000_create_start_stop(self):
+        volume = self.get_volume('vm1')
+        self.loop.run_until_complete(volume.create())
+        self.assertEqual(volume.size, 1024 ** 3)
+        self.assertIn('qubes_dom0/vm-vm1-private', qubes.storage.lvm.size_cache)
+
+        self.loop.run_until_complete(volume.start())
+        self.assertIn('qubes_dom0/vm-vm1-private-snap',
+            qubes.storage.lvm.size_cache)
+
+        self.loop.run_until_complete(volume.stop())
+        self.assertNotIn('qubes_dom0/vm-vm1-private-snap',
+            qubes.storage.lvm.size_cache)
+        self.assertEqual(list(volume.revisions), [])
+
+    def test_001_lvm_error(self):
+        volume = self.get_volume('vm1')
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.loop.run_until_complete(volume.start())
+
+    def test_010_volumes_overlap(self):
+        volumes = [self.get_volume(name) for name in ('vm1', 'vm2')]
+        with unittest.mock.patch.dict(os.environ,
+                {'QUBES_LVM_STUB_DELAY': '0.2'}):
+            self.loop.run_until_complete(asyncio.wait(
+                [volume.create() for volume in volumes]))
+        log = [entry for entry in self.get_log() if entry[1] != 'lvs']
+        # both lvcreate calls run at the same time
+        self.assertEqual(log[:2], [['start', 'lvcreate']] * 2)
+
+    def test_011_same_volume_serialized(self):
+        volume = self.get_volume('vm1')
+        self.loop.run_until_complete(volume.create())
+        with unittest.mock.patch.dict(os.environ,
+                {'QUBES_LVM_STUB_DELAY': '0.05'}):
+            self.loop.run_until_complete(asyncio.wait(
+                [volume.start(), volume.resize(2 * 1024 ** 3)]))
+        log = self.get_log()
+        # each call ends before the next one starts
+        self.assertEqual([event for event, _ in log],
+            ['start', 'end'] * (len(log) // 2))
+        self.assertEqual(volume.size, 2 * 1024 ** 3)
+
+    def test_012_loop_not_blocked(self):
+        volume = self.get_volume('vm1')
+        ticks = []
+
+        @asyncio.coroutine
+        def ticker():
+            while True:
+                ticks.append(None)
+                yield from asyncio.sleep(0.02)
+
+        ticker_task = asyncio.ensure_future(ticker())
+        with unittest.mock.patch.dict(os.environ,
+                {'QUBES_LVM_STUB_DELAY': '0.3'}):
+            self.loop.run_until_complete(volume.create())
+        ticker_task.cancel()
+        self.loop.run_until_complete(asyncio.wait([ticker_task]))
+        self.assertGreater(len(ticks), 5)
+
+    def test_013_lock_dropped_on_remove(self):
+        # pylint: disable=protected-access
+        volumes = [self.get_volume(name) for name in ('vm1', 'vm2')]
+        for volume in volumes:
+            self.loop.run_until_complete(volume.create())
+        self.assertCountEqual(self.pool._volume_locks,
+            [volume.vid for volume in volumes])
+        self.loop.run_until_complete(volumes[0].remove())
+        self.assertEqual(list(self.pool._volume_locks), [volumes[1].vid])
+
+    def test_014_lock_kept_while_waited_for(self):
+        # pylint: disable=protected-access
+        volume = self.get_volume('vm1')
+        self.loop.run_until_complete(volume.create())
+        with unittest.mock.patch.dict(os.environ,
+                {'QUBES_LVM_STUB_DELAY': '0.05'}):
+            self.loop.run_until_complete(asyncio.wait(
+                [volume.remove(), volume.create()]))
+        # create() waited for remove(), the lock must have been kept for it
+        self.assertIn(volume.vid, self.pool._volume_locks)
+        log = self.get_log()
+        self.assertEqual([event for event, _ in log],
+            ['start', 'end'] * (len(log) // 2))
+
+    def test_020_no_listing_until_used(self):
+        cache = qubes.storage.lvm.VolumeCache()
+        self.assertFalse(os.path.exists(self.log_path))
+        self.assertIn('qubes_dom0/pool00', cache)
+        self.assertEqual(self.get_lvs_calls(), [[]])
+
+    def test_021_update_lists_only_changed(self):
+        volume = self.get_volume('vm1')
+        self.loop.run_until_complete(volume.create())
+        self.loop.run_until_complete(volume.start())
+        self.loop.run_until_complete(volume.stop())
+        calls = self.get_lvs_calls()
+        # only the first access lists everything
+        self.assertEqual(calls[0], [])
+        self.assertEqual(calls[1:], [
+            ['qubes_dom0/pool00', 'qubes_dom0/vm-vm1-private'],
+            ['qubes_dom0/pool00', 'qubes_dom0/vm-vm1-private-snap'],
+            ['qubes_dom0/pool00', 'qubes_dom0/vm-vm1-private'],
+        ])
+        self.assertNotIn('qubes_dom0/vm-vm1-private-snap',
+            qubes.storage.lvm.size_cache)
+
+    def test_022_rescan_rate_limited(self):
+        cache = qubes.storage.lvm.size_cache
+        cache.rescan_interval = 60
+        self.assertIn('qubes_dom0/pool00', cache)
+        self.create_externally('vm-ext-private')
+        self.pool.list_volumes()
+        # rescanned recently, old data used
+        self.assertNotIn('qubes_dom0/vm-ext-private', cache)
+        with unittest.mock.patch('time.monotonic',
+                return_value=time.monotonic() + 61):
+            volumes = self.pool.list_volumes()
+        self.assertEqual([volume.vid for volume in volumes],
+            ['qubes_dom0/vm-ext-private'])
+        self.assertEqual(len(self.get_lvs_calls()), 2)
+
+    def test_023_missing_volume_rescan(self):
+        volume = self.get_volume('vm1')
+        self.loop.run_until_complete(volume.create())
+        self.create_externally('vm-ext-private')
+        subprocess.check_call(['lvm', 'lvremove', '-f',
+            'qubes_dom0/vm-vm1-private'])
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.loop.run_until_complete(volume.resize(2 * 1024 ** 3))
+        # the failure made the cache list everything again
+        self.assertNotIn('qubes_dom0/vm-vm1-private',
+            qubes.storage.lvm.size_cache)
+        self.assertIn('qubes_dom0/vm-ext-private',
+            qubes.storage.lvm.size_cache)
+
+    def test_024_update_missing_volume(self):
+        cache = qubes.storage.lvm.size_cache
+        self.assertIn('qubes_dom0/pool00', cache)
+        self.create_externally('vm-ext-private')
+        self.loop.run_until_complete(
+            cache.update_coro(['qubes_dom0/vm-vm1-private']))
+        self.assertIn('qubes_dom0/vm-ext-private', cache)
+        self.assertEqual(self.get_lvs_calls(),
+            [[], ['qubes_dom0/vm-vm1-private'], []])
+
+    def test_025_rescan_in_background(self):
+        cache = qubes.storage.lvm.size_cache
+        self.assertIn('qubes_dom0/pool00', cache)
+        self.create_externally('vm-ext-private')
+        cache.invalidate()
+
+        @asyncio.coroutine
+        def access():
+            return 'qubes_dom0/vm-ext-private' in cache
+
+        with unittest.mock.patch.object(qubes.storage.lvm, 'init_cache',
+                side_effect=AssertionError('lvs called synchronously')):
+            # old data is returned, the rescan runs in the background
+            self.assertFalse(self.loop.run_until_complete(access()))
+            self.assertIsNotNone(cache._rescan_future)
+            self.loop.run_until_complete(cache._rescan_future)
+            self.assertTrue(self.loop.run_until_complete(access()))
+        self.assertEqual(self.get_lvs_calls(), [[], []])
+
+    def test_026_updated_at_pruned(self):
+        volume = self.get_volume('vm1', revisions_to_keep=1)
+        self.loop.run_until_complete(volume.create())
+        for timestamp in (1000, 2000, 3000):
+            self.loop.run_until_complete(volume.start())
+            with unittest.mock.patch('time.time', return_value=timestamp):
+                self.loop.run_until_complete(volume.stop())
+        cache = qubes.storage.lvm.size_cache
+        self.assertIn('qubes_dom0/vm-vm1-private-1000-back',
+            cache._updated_at)
+        cache.rescan()
+        self.assertEqual(cache._updated_at, {})
+        self.assertEqual(sorted(volume.revisions), ['3000-back'])
+
+    def count_processes(self, coro):
+        ''' Run *coro*, return names of processes it spawned directly '''
+        spawned = []
+        create_subprocess_exec = asyncio.create_subprocess_exec
+
+        def wrapper(*args, **kwargs):
+            spawned.append(args[0])
+            return create_subprocess_exec(*args, **kwargs)
+
+        with unittest.mock.patch('asyncio.create_subprocess_exec', wrapper):
+            self.loop.run_until_complete(coro)
+        return spawned
+
+    def test_030_stop_single_session(self):
+        volume = self.get_volume('vm1', revisions_to_keep=1)
+        self.loop.run_until_complete(volume.create())
+        self.loop.run_until_complete(volume.start())
+        os.unlink(self.log_path)
+        spawned = self.count_processes(volume.stop())
+        # one session for all LVM operations, and listing changed volumes
+        self.assertEqual(spawned, ['sh', 'lvs'])
+        self.assertEqual([command for event, command in self.get_log()
+                if event == 'start'],
+            ['lvcreate', 'lvrename', 'lvcreate', 'lvremove', 'lvs'])
+        self.assertEqual(len(volume.revisions), 1)
+        self.assertNotIn('qubes_dom0/vm-vm1-private-snap',
+            qubes.storage.lvm.size_cache)
+
+    def test_031_commit_rollback(self):
+        volume = self.get_volume('vm1', revisions_to_keep=0)
+        self.loop.run_until_complete(volume.create())
+        self.loop.run_until_complete(volume.start())
+        subprocess.check_call(['lvm', 'lvremove', '-f',
+            'qubes_dom0/vm-vm1-private-snap'])
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            self.loop.run_until_complete(volume.stop())
+        cache = qubes.storage.lvm.size_cache
+        self.assertIn('qubes_dom0/vm-vm1-private', cache)
+        self.assertNotIn('qubes_dom0/vm-vm1-private-tmp', cache)
+        # the failed clone was followed only by the rollback
+        commands = [command for event, command in self.get_log()
+            if event == 'start' and command != 'lvs']
+        self.assertEqual(commands[-3:], ['lvrename', 'lvcreate', 'lvrename'])
+
+    def test_032_old_revisions_removed(self):
+        volume = self.get_volume('vm1', revisions_to_keep=2)
+        self.loop.run_until_complete(volume.create())
+        for timestamp in (1000, 2000, 3000):
+            self.loop.run_until_complete(volume.start())
+            with unittest.mock.patch('time.time', return_value=timestamp):
+                self.loop.run_until_complete(volume.stop())
+        self.assertEqual(sorted(volume.revisions), ['2000-back', '3000-back'])
+
+    def test_040_revisions_index(self):
+        volumes = [self.get_volume(name, revisions_to_keep=2)
+            for name in ('vm1', 'vm2')]
+        for volume in volumes:
+            self.loop.run_until_complete(volume.create())
+        self.create_externally('vm-vm1-private-1000-back')
+        self.create_externally('vm-vm1-private-snap-back')
+        self.pool.list_volumes()
+        with unittest.mock.patch.object(qubes.storage.lvm.VolumeCache,
+                '__iter__', side_effect=AssertionError('all volumes listed')):
+            self.assertEqual(list(volumes[0].revisions), ['1000-back'])
+            self.assertEqual(volumes[1].revisions, {})
+
+            self.loop.run_until_complete(volumes[0].start())
+            with unittest.mock.patch('time.time', return_value=2000):
+                self.loop.run_until_complete(volumes[0].stop())
+            self.assertEqual(sorted(volumes[0].revisions),
+                ['1000-back', '2000-back'])
+
+            self.loop.run_until_complete(volumes[0].remove())
+            self.assertEqual(volumes[0].revisions, {})
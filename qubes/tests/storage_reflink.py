@@ -0,0 +1,414 @@
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+
+''' Tests for the file-reflink storage driver.
+
+    By default, a temporary directory is used for the pool. If its filesystem
+    does not support reflinks (like tmpfs or ext4), images are copied
+    instead, and tests of reflinks themselves are skipped. A directory on
+    a filesystem supporting them (for example a loopback XFS or btrfs image
+    mounted somewhere) may be provided via :envvar:`QUBES_TEST_REFLINK_DIR`.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import qubes.storage
+import qubes.storage.reflink
+import qubes.tests
+from qubes.storage.reflink import ReflinkPool, ReflinkVolume
+
+
+def make_temp_dir():
+    ''' Temporary directory, on :envvar:`QUBES_TEST_REFLINK_DIR` if set '''
+    return tempfile.mkdtemp(dir=os.environ.get('QUBES_TEST_REFLINK_DIR'))
+
+
+def reflink_supported():
+    dir_path = make_temp_dir()
+    try:
+        return qubes.storage.reflink.is_reflink_supported(dir_path)
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def skipUnlessReflinkSupported(test_item):  # pylint: disable=invalid-name
+    ''' Decorator skipping tests needing a filesystem with reflinks '''
+    return unittest.skipUnless(reflink_supported(),
+        'Filesystem does not support reflinks, set QUBES_TEST_REFLINK_DIR')(
+        test_item)
+
+
+class ReflinkTestCase(qubes.tests.PoolTestCase):
+    def setUp(self):
+        super(ReflinkTestCase, self).setUp()
+        self.dir_path = make_temp_dir()
+        self.addCleanup(shutil.rmtree, self.dir_path)
+
+    def write_file(self, path, data, offset=0):
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as image:
+            image.seek(offset)
+            image.write(data)
+
+    def read_file(self, path, size=None, offset=0):
+        with open(path, 'rb') as image:
+            image.seek(offset)
+            return image.read(size)
+
+
+class TC_00_Reflink(ReflinkTestCase):
+    def test_000_copy_file(self):
+        source = os.path.join(self.dir_path, 'source.img')
+        destination = os.path.join(self.dir_path, 'destination.img')
+        self.write_file(source, b'data', offset=1024 ** 2)
+        self.write_file(destination, b'old data')
+        qubes.storage.reflink.copy_file(source, destination)
+        self.assertEqual(self.read_file(destination, offset=1024 ** 2),
+            b'data')
+        self.assertEqual(os.path.getsize(destination), 1024 ** 2 + 4)
+        self.assertFalse(os.path.exists(destination + '.tmp'))
+
+        # copies are independent
+        self.write_file(destination, b'new')
+        self.assertEqual(self.read_file(source, offset=1024 ** 2), b'data')
+
+    def test_001_copy_file_failed(self):
+        source = os.path.join(self.dir_path, 'source.img')
+        destination = os.path.join(self.dir_path, 'destination.img')
+        self.write_file(destination, b'old data')
+        with self.assertRaises(OSError):
+            qubes.storage.reflink.copy_file(source, destination)
+        self.assertEqual(self.read_file(destination), b'old data')
+        self.assertFalse(os.path.exists(destination + '.tmp'))
+
+    @skipUnlessReflinkSupported
+    def test_010_reflink(self):
+        source = os.path.join(self.dir_path, 'source.img')
+        destination = os.path.join(self.dir_path, 'destination.img')
+        self.write_file(source, b'data')
+        with unittest.mock.patch('qubes.storage.file.copy_file') as mock_copy:
+            qubes.storage.reflink.copy_file(source, destination)
+        self.assertFalse(mock_copy.called)
+        self.assertEqual(self.read_file(destination), b'data')
+
+    def test_011_reflink_unsupported(self):
+        source = os.path.join(self.dir_path, 'source.img')
+        destination = os.path.join(self.dir_path, 'destination.img')
+        self.write_file(source, b'data')
+        with unittest.mock.patch('fcntl.ioctl',
+                side_effect=OSError(95, 'Operation not supported')):
+            self.assertFalse(
+                qubes.storage.reflink.is_reflink_supported(self.dir_path))
+            qubes.storage.reflink.copy_file(source, destination)
+        self.assertEqual(self.read_file(destination), b'data')
+        self.assertEqual(sorted(os.listdir(self.dir_path)),
+            ['destination.img', 'source.img'])
+
+    def test_020_setup_check(self):
+        pool = ReflinkPool(name='test-reflink', dir_path=self.dir_path)
+        with unittest.mock.patch('fcntl.ioctl',
+                side_effect=OSError(95, 'Operation not supported')):
+            with self.assertRaises(qubes.storage.StoragePoolException):
+                pool.setup()
+            pool = ReflinkPool(name='test-reflink', dir_path=self.dir_path,
+                setup_check='False')
+            pool.setup()
+
+    def test_021_config(self):
+        pool = ReflinkPool(name='test-reflink', dir_path=self.dir_path,
+            revisions_to_keep=2)
+        self.assertEqual(pool.config, {
+            'name': 'test-reflink',
+            'dir_path': self.dir_path,
+            'driver': 'file-reflink',
+            'revisions_to_keep': 2,
+        })
+        self.assertIn('file-reflink', qubes.storage.pool_drivers())
+
+
+class TC_10_ReflinkVolume(ReflinkTestCase):
+    volume_config = dict(ReflinkTestCase.volume_config, size=1024 ** 2)
+
+    def setUp(self):
+        super(TC_10_ReflinkVolume, self).setUp()
+        self.pool = ReflinkPool(name='test-reflink', dir_path=self.dir_path,
+            setup_check=False, revisions_to_keep=2)
+        self.pool.setup()
+
+    def get_snapshot_volume(self, vm_name, source, **kwargs):
+        kwargs.setdefault('save_on_stop', False)
+        return self.get_volume(vm_name, name=source.name,
+            snap_on_start=True, source=source, **kwargs)
+
+    def test_000_origin_volume(self):
+        volume = self.get_volume('vm1')
+        self.assertIsInstance(volume, ReflinkVolume)
+        self.assertEqual(volume.vid, 'vm1/private')
+        volume.create()
+        self.assertEqual(os.path.getsize(volume.path), 1024 ** 2)
+        self.assertEqual(volume.usage, 0)
+        self.assertFalse(volume.is_dirty())
+        self.assertTrue(volume.verify())
+
+        volume.start()
+        self.assertTrue(volume.is_dirty())
+        self.assertEqual(volume.block_device().path, volume.path_dirty)
+        self.write_file(volume.path_dirty, b'data')
+        self.assertEqual(self.read_file(volume.export(), 4), b'\0' * 4)
+
+        volume.stop()
+        self.assertFalse(volume.is_dirty())
+        self.assertFalse(os.path.exists(volume.path_dirty))
+        self.assertEqual(self.read_file(volume.path, 4), b'data')
+        self.assertEqual(len(volume.revisions), 1)
+
+    def test_001_revisions(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        for timestamp, data in ((1000, b'one'), (2000, b'two'),
+                (3000, b'six')):
+            volume.start()
+            self.write_file(volume.path_dirty, data)
+            with unittest.mock.patch('time.time', return_value=timestamp):
+                volume.stop()
+        self.assertEqual(sorted(volume.revisions), ['2000-back', '3000-back'])
+        self.assertEqual(volume.revisions['3000-back'], '1970-01-01T00:50:00')
+
+        volume.revert('3000-back')
+        self.assertEqual(self.read_file(volume.path, 3), b'two')
+        volume.revert()
+        self.assertEqual(self.read_file(volume.path, 3), b'two')
+        volume.revert('2000-back')
+        self.assertEqual(self.read_file(volume.path, 3), b'one')
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            volume.revert('1000-back')
+
+    def test_002_no_revisions(self):
+        volume = self.get_volume('vm1', revisions_to_keep=0)
+        volume.create()
+        volume.start()
+        volume.stop()
+        self.assertEqual(volume.revisions, {})
+        self.assertEqual(os.listdir(os.path.dirname(volume.path)),
+            ['private.img'])
+
+    def test_003_commit_rollback(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        self.write_file(volume.path, b'old')
+        volume.start()
+        self.write_file(volume.path_dirty, b'new')
+        rename = os.rename
+
+        def failing_rename(source, destination):
+            if source == volume.path_dirty:
+                raise OSError(5, 'Input/output error')
+            return rename(source, destination)
+
+        with unittest.mock.patch('os.rename', failing_rename):
+            with self.assertRaises(OSError):
+                volume.stop()
+        self.assertEqual(self.read_file(volume.path, 3), b'old')
+        self.assertEqual(volume.revisions, {})
+        self.assertTrue(volume.is_dirty())
+
+    def test_004_dirty_kept_on_start(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        volume.start()
+        self.write_file(volume.path_dirty, b'data')
+        # domain crashed, volume not committed
+        volume.start()
+        self.assertEqual(self.read_file(volume.path_dirty, 4), b'data')
+
+    def test_005_revisions_same_second(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        for data in (b'one', b'two', b'six'):
+            volume.start()
+            self.write_file(volume.path_dirty, data)
+            with unittest.mock.patch('time.time', return_value=1000):
+                volume.stop()
+        self.assertEqual(sorted(volume.revisions), ['1001-back', '1002-back'])
+        self.assertEqual(self.read_file(volume.path, 3), b'six')
+        volume.revert('1002-back')
+        self.assertEqual(self.read_file(volume.path, 3), b'two')
+        volume.revert('1001-back')
+        self.assertEqual(self.read_file(volume.path, 3), b'one')
+
+    def test_010_snapshot_volume(self):
+        source = self.get_volume('template', name='root')
+        source.create()
+        self.write_file(source.path, b'template')
+        volume = self.get_snapshot_volume('vm1', source)
+        volume.create()
+        self.assertFalse(os.path.exists(volume.path))
+        self.assertTrue(volume.verify())
+        self.assertEqual(volume.export(), source.path)
+
+        volume.start()
+        self.assertFalse(volume.is_dirty())
+        self.assertFalse(volume.is_outdated())
+        self.assertEqual(volume.block_device().path, volume.path_dirty)
+        self.assertEqual(self.read_file(volume.path_dirty, 8), b'template')
+        self.write_file(volume.path_dirty, b'vm data')
+        self.assertEqual(self.read_file(source.path, 8), b'template')
+
+        source.start()
+        source.stop()
+        self.assertTrue(volume.is_outdated())
+
+        volume.stop()
+        self.assertFalse(os.path.exists(volume.path_dirty))
+        self.assertFalse(volume.is_outdated())
+
+    def test_011_snapshot_save_on_stop(self):
+        source = self.get_volume('template', name='root')
+        source.create()
+        self.write_file(source.path, b'template')
+        volume = self.get_snapshot_volume('vm1', source, save_on_stop=True,
+            revisions_to_keep=1)
+        volume.create()
+        volume.start()
+        self.assertTrue(volume.is_dirty())
+        self.assertEqual(self.read_file(volume.path_dirty, 8), b'template')
+        self.write_file(volume.path_dirty, b'vm data')
+        volume.stop()
+        self.assertEqual(self.read_file(volume.path, 7), b'vm data')
+        self.assertEqual(self.read_file(source.path, 8), b'template')
+
+    def test_012_snapshot_missing_source(self):
+        source = self.get_volume('template', name='root')
+        volume = self.get_snapshot_volume('vm1', source)
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            volume.verify()
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            volume.start()
+
+    def test_013_snapshot_outdated_after_restart(self):
+        source = self.get_volume('template', name='root')
+        source.create()
+        volume = self.get_snapshot_volume('vm1', source)
+        volume.create()
+        volume.start()
+        source.start()
+        source.stop()
+
+        # qubesd restarted, only the images are left
+        self.pool = ReflinkPool(name='test-reflink', dir_path=self.dir_path,
+            setup_check=False, revisions_to_keep=2)
+        source = self.get_volume('template', name='root')
+        volume = self.get_snapshot_volume('vm1', source)
+        self.assertTrue(volume.is_outdated())
+        volume.stop()
+        volume.start()
+        self.assertFalse(volume.is_outdated())
+
+    def test_014_snapshot_outdated_no_xattr(self):
+        source = self.get_volume('template', name='root')
+        source.create()
+        volume = self.get_snapshot_volume('vm1', source)
+        volume.create()
+        with unittest.mock.patch('os.setxattr',
+                side_effect=OSError(95, 'Operation not supported')):
+            volume.start()
+        self.assertFalse(volume.is_outdated())
+        source.start()
+        source.stop()
+        self.assertTrue(volume.is_outdated())
+
+    def test_020_volatile_volume(self):
+        volume = self.get_volume('vm1', name='volatile', save_on_stop=False)
+        self.assertEqual(volume.revisions_to_keep, 0)
+        volume.create()
+        self.assertFalse(os.path.exists(volume.path))
+        volume.start()
+        self.assertEqual(os.path.getsize(volume.path), 1024 ** 2)
+        self.assertEqual(volume.block_device().path, volume.path)
+        self.write_file(volume.path, b'data')
+        volume.start()
+        self.assertEqual(self.read_file(volume.path, 4), b'\0' * 4)
+        volume.stop()
+        self.assertFalse(os.path.exists(volume.path))
+
+    def test_030_resize(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        with unittest.mock.patch('qubes.storage.file.resize_loop_device') \
+                as mock_resize:
+            volume.resize(2 * 1024 ** 2)
+            self.assertFalse(mock_resize.called)
+            volume.start()
+            volume.resize(3 * 1024 ** 2)
+            mock_resize.assert_called_once_with(volume.path_dirty)
+        self.assertEqual(volume.size, 3 * 1024 ** 2)
+        self.assertEqual(os.path.getsize(volume.path), 3 * 1024 ** 2)
+        self.assertEqual(os.path.getsize(volume.path_dirty), 3 * 1024 ** 2)
+        with self.assertRaises(qubes.storage.StoragePoolException):
+            volume.resize(1024 ** 2)
+
+    def test_040_import_data(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        path = volume.import_data()
+        self.write_file(path, b'imported')
+        volume.import_data_end(False)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.read_file(volume.path, 8), b'\0' * 8)
+
+        path = volume.import_data()
+        self.write_file(path, b'imported')
+        volume.import_data_end(True)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.read_file(volume.path, 8), b'imported')
+
+    def test_041_import_volume(self):
+        source = self.get_volume('vm1')
+        source.create()
+        self.write_file(source.path, b'data')
+        volume = self.get_volume('vm2')
+        volume.create()
+        volume.import_volume(source)
+        self.assertEqual(self.read_file(volume.path, 4), b'data')
+
+    def test_050_list_volumes(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        volume.start()
+        volume.stop()
+        volume.start()
+        self.assertEqual(
+            [listed.vid for listed in self.pool.list_volumes()],
+            ['vm1/private'])
+        self.assertIs(self.pool.get_volume('vm1/private'), volume)
+        self.assertEqual(ReflinkPool(name='test-reflink',
+                dir_path=self.dir_path).get_volume('vm1/private').vid,
+            'vm1/private')
+        with self.assertRaises(KeyError):
+            self.pool.get_volume('vm2/private')
+
+    def test_051_remove(self):
+        volume = self.get_volume('vm1')
+        volume.create()
+        volume.start()
+        volume.stop()
+        volume.start()
+        volume.remove()
+        self.assertEqual(os.listdir(self.dir_path), [])
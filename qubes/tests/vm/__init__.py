@@ -41,6 +41,7 @@ class TestHost(object):
 class TestApp(qubes.tests.TestEmitter):
     labels = {1: qubes.Label(1, '0xcc0000', 'red')}
     check_updates_vm = False
+    libvirt_events_available = False
 
     def get_label(self, label):
         # pylint: disable=unused-argument
@@ -105,6 +105,12 @@ class TC_90_AppVM(qubes.tests.vm.qubesvm.QubesVMTestsMixin,
             vm.volume_config['volatile'].get('snap_on_start', False))
         self.assertIsNone(vm.volume_config['volatile'].get('source', None))
 
+        # per-VM config must not leak into the class-wide defaults
+        self.assertIsNone(
+            qubes.vm.appvm.AppVM.default_volume_config['root']['source'])
+        self.assertIsNot(vm.volume_config['root'],
+            qubes.vm.appvm.AppVM.default_volume_config['root'])
+
     def test_002_storage_template_change(self):
         vm = self.get_vm()
         # create new mock, so new template will get different volumes
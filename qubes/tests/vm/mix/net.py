@@ -48,7 +48,7 @@ class TC_00_NetVMMixin(
             name=qubes.tests.VMPREFIX + 'nonet')
         self.app.domains = qubes.app.VMCollection(self.app)
         for domain in (vm, self.netvm1, self.netvm2, self.nonetvm):
-            self.app.domains._dict[domain.qid] = domain
+            self.app.domains.add(domain, _enable_events=False)
         self.app.default_netvm = self.netvm1
         self.app.default_fw_netvm = self.netvm1
         self.addCleanup(self.cleanup_netvms)
@@ -20,12 +20,14 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import asyncio
 import os
 
 import unittest
 import uuid
 import datetime
 import lxml.etree
+import libvirt
 import unittest.mock
 
 import qubes
@@ -685,3 +687,155 @@ class TC_90_QubesVM(QubesVMTestsMixin, qubes.tests.QubesTestCase):
         libvirt_xml = vm.create_config_file()
         self.assertXMLEqual(lxml.etree.XML(libvirt_xml),
             lxml.etree.XML(expected))
+
+    def get_running_vm(self):
+        vm = self.get_vm()
+        self.app.vmm.offline_mode = False
+        vm._libvirt_domain = unittest.mock.Mock(**{
+            'isActive.return_value': True,
+            'state.return_value': [libvirt.VIR_DOMAIN_PAUSED, 0],
+            'ID.return_value': 3,
+            'XMLDesc.return_value': '<domain><devices/></domain>',
+        })
+        # as if started by this process
+        vm._domain_stopped_event_received = False
+        vm._domain_stopped_event_handled = False
+        vm._domain_halted.clear()
+
+        @asyncio.coroutine
+        def call_async(method, *args):
+            return getattr(vm.libvirt_domain, method)(*args)
+        vm.libvirt_domain.call_async.side_effect = call_async
+        return vm
+
+    def test_700_libvirt_cache_disabled(self):
+        vm = self.get_running_vm()
+        self.assertTrue(vm.is_running())
+        self.assertTrue(vm.is_running())
+        self.assertEqual(vm.libvirt_domain.isActive.call_count, 2)
+        self.assertIsNot(vm.libvirt_xml, vm.libvirt_xml)
+
+    def test_701_libvirt_cache(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_cache_enabled = True
+        for _ in range(2):
+            self.assertTrue(vm.is_running())
+            self.assertTrue(vm.is_paused())
+            self.assertEqual(vm.get_power_state(), 'Paused')
+            self.assertEqual(vm.xid, 3)
+        self.assertEqual(vm.libvirt_domain.isActive.call_count, 1)
+        self.assertEqual(vm.libvirt_domain.state.call_count, 1)
+        self.assertEqual(vm.libvirt_domain.ID.call_count, 1)
+        self.assertIs(vm.libvirt_xml, vm.libvirt_xml)
+        self.assertEqual(vm.libvirt_domain.XMLDesc.call_count, 1)
+
+        vm.libvirt_domain.isActive.return_value = False
+        self.assertTrue(vm.is_running())
+        vm.invalidate_libvirt_cache()
+        self.assertFalse(vm.is_running())
+        self.assertEqual(vm.libvirt_domain.isActive.call_count, 2)
+
+    def test_702_libvirt_cache_check(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_cache_enabled = True
+        self.app.libvirt_cache_check = True
+        self.assertTrue(vm.is_running())
+        self.assertTrue(vm.is_running())
+        vm.libvirt_domain.isActive.return_value = False
+        with self.assertRaises(AssertionError):
+            vm.is_running()
+
+    def test_703_libvirt_cache_invalidate_on_change(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_cache_enabled = True
+        self.assertEqual(vm.get_power_state(), 'Paused')
+        self.loop.run_until_complete(vm.unpause())
+        vm.libvirt_domain.resume.assert_called_once_with()
+        vm.libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_RUNNING, 0]
+        self.assertFalse(vm.is_paused())
+
+    def test_710_wait_halted_event(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_events_available = True
+        wait = asyncio.ensure_future(vm.wait_halted())
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        self.assertFalse(wait.done())
+        # the state is not polled, the event is awaited
+        self.assertEqual(vm.libvirt_domain.state.call_count, 0)
+        vm.libvirt_domain.isActive.return_value = False
+        vm.libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        vm.on_libvirt_domain_stopped()
+        self.loop.run_until_complete(asyncio.wait_for(wait, 1))
+
+    def test_711_wait_halted_event_pending(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_events_available = True
+        # libvirt already reports the domain as halted, but domain-shutdown
+        # handlers did not run yet
+        vm.libvirt_domain.isActive.return_value = False
+        vm.libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        wait = asyncio.ensure_future(vm.wait_halted())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertFalse(wait.done())
+        vm.on_libvirt_domain_stopped()
+        self.loop.run_until_complete(asyncio.wait_for(wait, 1))
+
+    def test_712_wait_halted_handler_failed(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_events_available = True
+        vm.libvirt_domain.isActive.return_value = False
+        vm.libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+
+        def failing_handler(subject, event, **kwargs):
+            raise RuntimeError('handler failed')
+        vm.add_handler('domain-shutdown', failing_handler)
+        wait = asyncio.ensure_future(vm.wait_halted())
+        vm.on_libvirt_domain_stopped()
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(vm._domain_stopped_future)
+        self.loop.run_until_complete(asyncio.wait_for(wait, 1))
+
+    def test_713_wait_halted_not_started(self):
+        vm = self.get_vm()
+        self.app.libvirt_events_available = True
+        self.app.vmm.offline_mode = False
+        vm._libvirt_domain = unittest.mock.Mock(**{
+            'isActive.return_value': False,
+            'state.return_value': [libvirt.VIR_DOMAIN_SHUTOFF, 0],
+        })
+        # no domain-stopped event is expected, so check the state
+        self.loop.run_until_complete(asyncio.wait_for(vm.wait_halted(), 1))
+
+    def test_714_wait_halted_timeout(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_events_available = True
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(vm.wait_halted(timeout=0.01))
+
+    def test_715_wait_halted_poll(self):
+        vm = self.get_running_vm()
+        wait = asyncio.ensure_future(vm.wait_halted())
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertFalse(wait.done())
+        vm.libvirt_domain.isActive.return_value = False
+        vm.libvirt_domain.state.return_value = [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+        self.loop.run_until_complete(asyncio.wait_for(wait, 1))
+
+    def test_716_shutdown_wait(self):
+        vm = self.get_running_vm()
+        self.app.libvirt_events_available = True
+
+        def shutdown():
+            vm.libvirt_domain.isActive.return_value = False
+            vm.libvirt_domain.state.return_value = \
+                [libvirt.VIR_DOMAIN_SHUTOFF, 0]
+            vm._domain_stopped_event_received = False
+            vm._domain_stopped_event_handled = False
+            self.loop.call_soon(vm.on_libvirt_domain_stopped)
+        vm.libvirt_domain.shutdown.side_effect = shutdown
+        with unittest.mock.patch.object(type(vm), 'connected_vms',
+                new_callable=unittest.mock.PropertyMock, return_value=[]):
+            self.loop.run_until_complete(
+                asyncio.wait_for(vm.shutdown(wait=True), 1))
+        vm.libvirt_domain.shutdown.assert_called_once_with()
+        self.loop.run_until_complete(asyncio.sleep(0))
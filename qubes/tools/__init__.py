@@ -358,8 +358,11 @@ class QubesArgumentParser(argparse.ArgumentParser):
 
         if self._want_app and not self._want_app_no_instance:
             self.set_qubes_verbosity(namespace)
+            # offline tools usually touch only a few VMs, don't construct
+            # all of them upfront
             namespace.app = qubes.Qubes(namespace.app,
-                offline_mode=namespace.offline_mode)
+                offline_mode=namespace.offline_mode,
+                lazy=bool(namespace.offline_mode))
 
         if self._want_force_root:
             self.dont_run_as_root(namespace)
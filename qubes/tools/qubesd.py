@@ -21,30 +21,58 @@ def sighandler(loop, signame, servers):
         server.close()
     loop.stop()
 
-parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon')
+parser = qubes.tools.QubesArgumentParser(description='Qubes OS daemon',
+    want_app_no_instance=True)
 parser.add_argument('--debug', action='store_true', default=False,
     help='Enable verbose error logging (all exceptions with full '
          'tracebacks) and also send tracebacks to Admin API clients')
+parser.add_argument('--profile-startup', action='store_true', default=False,
+    help='Measure time spent in each stage of loading qubes.xml (including '
+         'each event handler) and starting the daemon, and print '
+         'the breakdown')
+parser.add_argument('--no-delayed-save', action='store_false',
+    dest='delayed_save', default=True,
+    help='Write qubes.xml on every change, instead of coalescing changes '
+         'which come in a burst')
+parser.add_argument('--snapshot', action='store_true', default=False,
+    help='Keep a snapshot of qubes.xml and load from it when possible, '
+         'for faster start')
 
 def main(args=None):
     loop = asyncio.get_event_loop()
     libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+    stopwatch = qubes.utils.Stopwatch()
     try:
         args = parser.parse_args(args)
+        parser.set_qubes_verbosity(args)
+        with stopwatch.measure('load qubes.xml (total)'):
+            args.app = qubes.Qubes(args.app, offline_mode=args.offline_mode,
+                stopwatch=(stopwatch if args.profile_startup else None),
+                snapshot=args.snapshot)
     except:
         loop.close()
         raise
 
-    args.app.register_event_handlers()
+    with stopwatch.measure('libvirt connection'):
+        args.app.register_event_handlers()
+    if args.delayed_save:
+        args.app.enable_delayed_save(loop=loop)
+    if not args.offline_mode:
+        args.app.vm_stats_sampler = qubes.api.admin.VMStatsSampler(args.app)
+        args.app.vm_stats_sampler.enable_history()
 
     if args.debug:
         qubes.log.enable_debug()
 
-    servers = loop.run_until_complete(qubes.api.create_servers(
-        qubes.api.admin.QubesAdminAPI,
-        qubes.api.internal.QubesInternalAPI,
-        qubes.api.misc.QubesMiscAPI,
-        app=args.app, debug=args.debug))
+    with stopwatch.measure('create servers'):
+        servers = loop.run_until_complete(qubes.api.create_servers(
+            qubes.api.admin.QubesAdminAPI,
+            qubes.api.internal.QubesInternalAPI,
+            qubes.api.misc.QubesMiscAPI,
+            app=args.app, debug=args.debug))
+
+    if args.profile_startup:
+        print('startup profile:\n' + stopwatch.format_report(), end='')
 
     socknames = []
     for server in servers:
@@ -71,6 +99,8 @@ def main(args=None):
                     'socket {} got unlinked sometime before shutdown'.format(
                         sockname))
     finally:
+        # write changes still waiting for the debounce timer
+        args.app.disable_delayed_save()
         loop.close()
 
 if __name__ == '__main__':
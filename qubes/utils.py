@@ -20,6 +20,8 @@
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
 
+import collections
+import contextlib
 import hashlib
 import random
 import string
@@ -27,6 +29,7 @@ import os
 import re
 import socket
 import subprocess
+import time
 
 import pkg_resources
 
@@ -184,3 +187,47 @@ def match_vm_name_with_special(vm, name):
     elif name.startswith('$type:'):
         return name[len('$type:'):] == vm.__class__.__name__
     return name == vm.name
+
+
+class Stopwatch(object):
+    '''Accumulate wall clock time spent in named steps.
+
+    Used to find out where startup time goes (see ``--profile-startup``
+    option of :program:`qubesd`). Steps are reported in the order they were
+    first seen.
+    '''
+
+    def __init__(self):
+        #: step name -> [total seconds, number of calls]
+        self.steps = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        '''Context manager measuring time of its body as step *name*'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        '''Record *seconds* spent in step *name*'''
+        step = self.steps.setdefault(name, [0.0, 0])
+        step[0] += seconds
+        step[1] += 1
+
+    def handler_called(self, func, event, seconds):
+        '''Callback for :py:func:`qubes.events.profile_handlers`'''
+        self.add('handler {}.{} ({})'.format(
+            getattr(func, '__module__', '?'),
+            getattr(func, '__qualname__', repr(func)),
+            event), seconds)
+
+    def format_report(self):
+        '''Format collected times as human readable text
+
+        :rtype: str
+        '''
+        return ''.join('{:10.3f} ms {:6d}x  {}\n'.format(
+                seconds * 1000, count, name)
+            for name, (seconds, count) in self.steps.items())
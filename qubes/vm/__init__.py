@@ -334,6 +334,14 @@ class BaseVM(qubes.PropertyHolder):
         #: storage manager
         self.storage = None
 
+        #: serialised :py:meth:`__xml__`, as cached by
+        #: :py:meth:`qubes.Qubes.save`; see :py:meth:`invalidate_xml_cache`
+        self.xml_cache = None
+
+        #: results of read-only calls to libvirt domain, see
+        #: :py:meth:`libvirt_cached`
+        self._libvirt_cache = {}
+
         if hasattr(self, 'name'):
             self.init_log()
 
@@ -384,6 +392,93 @@ class BaseVM(qubes.PropertyHolder):
         '''Initialise logger for this domain.'''
         self.log = qubes.log.get_vm_logger(self.name)
 
+    def invalidate_xml_cache(self):
+        '''Drop cached serialisation of this domain.
+
+        This is called automatically when properties or devices change, and
+        on events about changed features and tags. Call it when changing
+        anything else that ends up in :py:meth:`__xml__`.
+        '''
+        self.xml_cache = None
+
+    def _property_init(self, prop, value):
+        super()._property_init(prop, value)
+        self.xml_cache = None
+
+    def _property_del(self, prop):
+        super()._property_del(prop)
+        self.xml_cache = None
+
+    def libvirt_cached(self, method):
+        '''Call read-only *method* of :py:attr:`libvirt_domain` (like
+        ``isActive``, ``state`` or ``XMLDesc``), with the result cached until
+        :py:meth:`invalidate_libvirt_cache`.
+
+        The cache is used only when :py:attr:`qubes.Qubes.libvirt_cache_enabled`
+        is set, which means libvirt events (that invalidate it) are
+        received. If :py:attr:`qubes.Qubes.libvirt_cache_check` is set too,
+        cached value is compared with actual one, and a mismatch raises
+        :py:exc:`AssertionError`. This is meant for tests.
+        '''
+        if not getattr(self.app, 'libvirt_cache_enabled', False):
+            return getattr(self.libvirt_domain, method)()
+        try:
+            value = self._libvirt_cache[method]
+        except KeyError:
+            value = getattr(self.libvirt_domain, method)()
+            self._libvirt_cache[method] = value
+            return value
+        if getattr(self.app, 'libvirt_cache_check', False):
+            actual = getattr(self.libvirt_domain, method)()
+            if actual != value:
+                raise AssertionError(
+                    'Stale libvirt cache of {}: {}() returned {!r}, '
+                    'cached {!r}'.format(self.name, method, actual, value))
+        return value
+
+    @property
+    def libvirt_xml(self):
+        '''Parsed ``XMLDesc()`` of :py:attr:`libvirt_domain`, cached like
+        :py:meth:`libvirt_cached`. Do not modify it.'''
+        xml_desc = self.libvirt_cached('XMLDesc')
+        try:
+            cached_desc, parsed = self._libvirt_cache['XMLDesc:parsed']
+            if cached_desc is xml_desc:
+                return parsed
+        except KeyError:
+            pass
+        parsed = lxml.etree.fromstring(xml_desc)
+        if getattr(self.app, 'libvirt_cache_enabled', False):
+            self._libvirt_cache['XMLDesc:parsed'] = (xml_desc, parsed)
+        return parsed
+
+    def invalidate_libvirt_cache(self):
+        '''Drop results cached by :py:meth:`libvirt_cached`.
+
+        This is called on libvirt events about this domain, and after
+        changing domain state or devices through libvirt.
+        '''
+        self._libvirt_cache.clear()
+
+    def xml_cache_key(self):
+        '''Return state that is serialised in :py:meth:`__xml__`, but may
+        change without firing any event.
+
+        Cached serialisation is used only when this returns a value equal to
+        the one returned at the time of caching.
+        '''
+        # pylint: disable=no-self-use
+        return None
+
+    @qubes.events.handler('clone-properties',
+        'domain-feature-set', 'domain-feature-delete',
+        'domain-tag-add', 'domain-tag-delete',
+        'domain-volume-import-end')
+    def on_event_invalidate_xml_cache(self, event, **kwargs):
+        '''Invalidate cached XML on events that change saved state'''
+        # pylint: disable=unused-argument
+        self.xml_cache = None
+
     def __xml__(self):
         element = lxml.etree.Element('domain')
         element.set('id', 'domain-' + str(self.qid))
@@ -20,7 +20,6 @@
 #
 ''' This module contains the AppVM implementation '''
 
-import copy
 
 import qubes.events
 import qubes.vm.qubesvm
@@ -80,7 +79,9 @@ class AppVM(qubes.vm.qubesvm.QubesVM):
                     qubes.property.bool(None, None, node_dispvm_allowed.text)
                 node_dispvm_allowed.getparent().remove(node_dispvm_allowed)
 
-        self.volume_config = copy.deepcopy(self.default_volume_config)
+        # volume configs are flat dicts, no need for (slow) deepcopy
+        self.volume_config = {name: config.copy()
+            for name, config in self.default_volume_config.items()}
         template = kwargs.get('template', None)
 
         if template is not None:
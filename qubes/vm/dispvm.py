@@ -187,6 +187,8 @@ class DispVM(qubes.vm.qubesvm.QubesVM):
             yield from self.kill()
         except qubes.exc.QubesVMNotStartedError:
             pass
+        else:
+            yield from self.wait_halted()
         # if auto_cleanup is set, this will be done automatically
         if not self.auto_cleanup:
             yield from self.remove_from_disk()
@@ -164,7 +164,25 @@ class NetVMMixin(qubes.events.Emitter):
         ''' Return a generator containing all domains connected to the current
             NetVM.
         '''
-        for vm in self.app.domains:
+        loaded = tuple(self.app.domains.loaded_vms())
+        pending = self.app.domains.pending_items()
+
+        for vm in loaded:
+            if getattr(vm, 'netvm', None) is self:
+                yield vm
+
+        # domains not constructed yet (see VMCollection.add_lazy): look into
+        # their XML first, to not load all of them just to check this
+        is_default = self in (getattr(self.app, 'default_netvm', None),
+            getattr(self.app, 'default_fw_netvm', None))
+        for qid, node in pending:
+            netvm = node.xpath('./properties/property[@name="netvm"]')
+            if netvm:
+                if (netvm[0].get('ref') or netvm[0].text) != self.name:
+                    continue
+            elif not is_default:
+                continue
+            vm = self.app.domains[qid]
             if getattr(vm, 'netvm', None) is self:
                 yield vm
 
@@ -257,6 +275,7 @@ class NetVMMixin(qubes.events.Emitter):
         self.libvirt_domain.attachDevice(
             self.app.env.get_template('libvirt/devices/net.xml').render(
                 vm=self))
+        self.invalidate_libvirt_cache()
 
     def detach_network(self):
         '''Detach machine from it's netvm'''
@@ -268,6 +287,7 @@ class NetVMMixin(qubes.events.Emitter):
         self.libvirt_domain.detachDevice(
             self.app.env.get_template('libvirt/devices/net.xml').render(
                 vm=self))
+        self.invalidate_libvirt_cache()
 
     def is_networked(self):
         '''Check whether this VM can reach network (firewall notwithstanding).
@@ -519,7 +519,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if self.libvirt_domain is None:
             return -1
         try:
-            return self.libvirt_domain.ID()
+            return self.libvirt_cached('ID')
         except libvirt.libvirtError as e:
             if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
                 return -1
@@ -546,8 +546,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
     @property
     def attached_volumes(self):
         result = []
-        xml_desc = self.libvirt_domain.XMLDesc()
-        xml = lxml.etree.fromstring(xml_desc)
+        xml = self.libvirt_xml
         for disk in xml.xpath("//domain/devices/disk"):
             if disk.find('backenddomain') is not None:
                 pool_name = 'p_%s' % disk.find('backenddomain').get('name')
@@ -571,6 +570,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             return self._libvirt_domain
 
         # XXX _update_libvirt_domain?
+        self.invalidate_libvirt_cache()
         try:
             self._libvirt_domain = self.app.vmm.libvirt_conn.lookupByUUID(
                 self.uuid.bytes)
@@ -681,6 +681,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         # start(). This should not be accessed anywhere else.
         self._domain_stopped_lock = asyncio.Lock()
 
+        # Set when the domain-shutdown event was handled, cleared once the
+        # domain is started; see wait_halted()
+        self._domain_halted = asyncio.Event()
+        self._domain_halted.set()
+
         if xml is None:
             # we are creating new VM and attributes came through kwargs
             assert hasattr(self, 'qid')
@@ -714,6 +719,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             self._qdb_connection = None
         if self._libvirt_domain is not None:
             self._libvirt_domain = None
+        self.invalidate_libvirt_cache()
         super().close()
 
     def __hash__(self):
@@ -733,6 +739,12 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         return element
 
+    def xml_cache_key(self):
+        # volume configuration (like size or revisions_to_keep) is changed
+        # directly on volume objects, without any event
+        return [(name, volume.config)
+            for name, volume in self.volumes.items()]
+
     #
     # event handlers
     #
@@ -752,6 +764,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             self.start_qdb_watch()
             self._domain_stopped_event_received = False
             self._domain_stopped_event_handled = False
+            self._domain_halted.clear()
 
     @qubes.events.handler('property-set:label')
     def on_property_set_label(self, event, name, newvalue, oldvalue=None):
@@ -858,8 +871,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                     # twice if an exception gets thrown.
                     self._domain_stopped_event_handled = True
 
-                    yield from self.fire_event_async('domain-stopped')
-                    yield from self.fire_event_async('domain-shutdown')
+                    try:
+                        yield from self.fire_event_async('domain-stopped')
+                        yield from self.fire_event_async('domain-shutdown')
+                    finally:
+                        self._domain_halted.set()
 
             self.log.info('Starting {}'.format(self.name))
 
@@ -892,9 +908,9 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 raise
 
             try:
-                self._update_libvirt_domain()
+                yield from self._update_libvirt_domain_async()
 
-                self.libvirt_domain.createWithFlags(
+                yield from self._libvirt_call('createWithFlags',
                     libvirt.VIR_DOMAIN_START_PAUSED)
 
             except Exception as exc:
@@ -906,11 +922,13 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 raise
 
             finally:
+                self.invalidate_libvirt_cache()
                 if qmemman_client:
                     qmemman_client.close()
 
             self._domain_stopped_event_received = False
             self._domain_stopped_event_handled = False
+            self._domain_halted.clear()
 
             try:
                 yield from self.fire_event_async('domain-spawn',
@@ -922,7 +940,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 self.start_qdb_watch()
 
                 self.log.warning('Activating the {} VM'.format(self.name))
-                self.libvirt_domain.resume()
+                yield from self._libvirt_call('resume')
+                self.invalidate_libvirt_cache()
 
                 yield from self.start_qrexec_daemon()
 
@@ -976,8 +995,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             # an exception gets thrown.
             self._domain_stopped_event_handled = True
 
-            yield from self.fire_event_async('domain-stopped')
-            yield from self.fire_event_async('domain-shutdown')
+            try:
+                yield from self.fire_event_async('domain-stopped')
+                yield from self.fire_event_async('domain-shutdown')
+            finally:
+                self._domain_halted.set()
 
     @qubes.events.handler('domain-stopped')
     @asyncio.coroutine
@@ -1003,13 +1025,40 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         yield from self.fire_event_async('domain-pre-shutdown', pre_event=True,
             force=force)
 
-        self.libvirt_domain.shutdown()
+        yield from self._libvirt_call('shutdown')
+        self.invalidate_libvirt_cache()
 
-        while wait and not self.is_halted():
-            yield from asyncio.sleep(0.25)
+        if wait:
+            yield from self.wait_halted()
 
         return self
 
+    @asyncio.coroutine
+    def wait_halted(self, timeout=None):
+        '''Wait until the domain is halted.
+
+        When libvirt events are available (see
+        :py:attr:`qubes.app.Qubes.libvirt_events_available`) and the domain
+        was started, this returns after handlers of ``domain-shutdown`` event
+        are done, even if libvirt already reports the domain as halted.
+        Otherwise domain state is polled.
+
+        :param float timeout: maximum time to wait (in seconds), \
+            :py:obj:`None` means no limit
+        :raises asyncio.TimeoutError: when the domain did not halt in time
+        '''
+
+        if self.app.libvirt_events_available \
+                and not self._domain_halted.is_set():
+            yield from asyncio.wait_for(self._domain_halted.wait(), timeout)
+        else:
+            yield from asyncio.wait_for(self._poll_halted(), timeout)
+
+    @asyncio.coroutine
+    def _poll_halted(self):
+        while not self.is_halted():
+            yield from asyncio.sleep(0.25)
+
     @asyncio.coroutine
     def kill(self):
         '''Forcefuly shutdown (destroy) domain.
@@ -1021,7 +1070,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running() and not self.is_paused():
             raise qubes.exc.QubesVMNotStartedError(self)
 
-        self.libvirt_domain.destroy()
+        yield from self._libvirt_call('destroy')
+        self.invalidate_libvirt_cache()
 
         return self
 
@@ -1046,10 +1096,11 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if list(self.devices['pci'].attached()):
             yield from self.run_service_for_stdio('qubes.SuspendPre',
                 user='root')
-            self.libvirt_domain.pMSuspendForDuration(
+            yield from self._libvirt_call('pMSuspendForDuration',
                 libvirt.VIR_NODE_SUSPEND_TARGET_MEM, 0, 0)
         else:
-            self.libvirt_domain.suspend()
+            yield from self._libvirt_call('suspend')
+        self.invalidate_libvirt_cache()
 
         return self
 
@@ -1060,7 +1111,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_running():
             raise qubes.exc.QubesVMNotRunningError(self)
 
-        self.libvirt_domain.suspend()
+        yield from self._libvirt_call('suspend')
+        self.invalidate_libvirt_cache()
 
         return self
 
@@ -1074,7 +1126,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         # pylint: disable=not-an-iterable
         if self.get_power_state() == "Suspended":
-            self.libvirt_domain.pMWakeup()
+            yield from self._libvirt_call('pMWakeup')
+            self.invalidate_libvirt_cache()
             yield from self.run_service_for_stdio('qubes.SuspendPost',
                 user='root')
         else:
@@ -1088,7 +1141,8 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         if not self.is_paused():
             raise qubes.exc.QubesVMNotPausedError(self)
 
-        self.libvirt_domain.resume()
+        yield from self._libvirt_call('resume')
+        self.invalidate_libvirt_cache()
 
         return self
 
@@ -1565,17 +1619,17 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
             return 'Halted'
 
         try:
-            if libvirt_domain.isActive():
-                # pylint: disable=line-too-long
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            if self.libvirt_cached('isActive'):
+                state = self.libvirt_cached('state')[0]
+                if state == libvirt.VIR_DOMAIN_PAUSED:
                     return "Paused"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
+                elif state == libvirt.VIR_DOMAIN_CRASHED:
                     return "Crashed"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTDOWN:
+                elif state == libvirt.VIR_DOMAIN_SHUTDOWN:
                     return "Halting"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+                elif state == libvirt.VIR_DOMAIN_SHUTOFF:
                     return "Dying"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PMSUSPENDED:  # nopep8
+                elif state == libvirt.VIR_DOMAIN_PMSUSPENDED:
                     return "Suspended"
                 else:
                     if not self.is_fully_usable():
@@ -1624,7 +1678,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
                 else:
                     raise
 
-        return self.libvirt_domain.isActive()
+        return self.libvirt_cached('isActive')
 
     def is_paused(self):
         '''Check whether this domain is paused.
@@ -1635,7 +1689,7 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
         '''
 
         return self.libvirt_domain \
-            and self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
+            and self.libvirt_cached('state')[0] == libvirt.VIR_DOMAIN_PAUSED
 
     def is_qrexec_running(self):
         '''Check whether qrexec for this domain is available.
@@ -1844,21 +1898,48 @@ class QubesVM(qubes.vm.mix.net.NetVMMixin, qubes.vm.BaseVM):
 
         self.fire_event('domain-qdb-create')
 
-    # TODO async; update this in constructor
+    # TODO update this in constructor
     def _update_libvirt_domain(self):
         '''Re-initialise :py:attr:`libvirt_domain`.'''
         domain_config = self.create_config_file()
+        self.invalidate_libvirt_cache()
         try:
             self._libvirt_domain = self.app.vmm.libvirt_conn.defineXML(
                 domain_config)
         except libvirt.libvirtError as e:
-            if e.get_error_code() == libvirt.VIR_ERR_OS_TYPE \
-                    and e.get_str2() == 'hvm':
-                raise qubes.exc.QubesVMError(self,
-                    'HVM qubes are not supported on this machine. '
-                    'Check BIOS settings for VT-x/AMD-V extensions.')
-            else:
-                raise
+            self._check_define_error(e)
+            raise
+
+    @asyncio.coroutine
+    def _update_libvirt_domain_async(self):
+        '''Re-initialise :py:attr:`libvirt_domain`, without blocking the
+        event loop on libvirt.'''
+        domain_config = self.create_config_file()
+        self.invalidate_libvirt_cache()
+        try:
+            self._libvirt_domain = \
+                yield from self.app.vmm.libvirt_conn.call_async(
+                    'defineXML', domain_config)
+        except libvirt.libvirtError as e:
+            self._check_define_error(e)
+            raise
+        finally:
+            self.invalidate_libvirt_cache()
+
+    def _check_define_error(self, e):
+        '''Translate error of defining libvirt domain into QubesException,
+        when there is a better explanation'''
+        if e.get_error_code() == libvirt.VIR_ERR_OS_TYPE \
+                and e.get_str2() == 'hvm':
+            raise qubes.exc.QubesVMError(self,
+                'HVM qubes are not supported on this machine. '
+                'Check BIOS settings for VT-x/AMD-V extensions.')
+
+    @asyncio.coroutine
+    def _libvirt_call(self, method, *args):
+        '''Call *method* of :py:attr:`libvirt_domain` in a thread, so a slow
+        libvirtd does not stall other clients of qubesd'''
+        return (yield from self.libvirt_domain.call_async(method, *args))
 
     #
     # workshop -- those are to be reworked later
@@ -226,6 +226,7 @@ fi
 %{python3_sitelib}/qubes/__init__.py
 %{python3_sitelib}/qubes/app.py
 %{python3_sitelib}/qubes/backup.py
+%{python3_sitelib}/qubes/bulk.py
 %{python3_sitelib}/qubes/config.py
 %{python3_sitelib}/qubes/core2migration.py
 %{python3_sitelib}/qubes/devices.py
@@ -235,6 +236,7 @@ fi
 %{python3_sitelib}/qubes/firewall.py
 %{python3_sitelib}/qubes/log.py
 %{python3_sitelib}/qubes/rngdoc.py
+%{python3_sitelib}/qubes/stats.py
 %{python3_sitelib}/qubes/tarwriter.py
 %{python3_sitelib}/qubes/utils.py
 
@@ -270,6 +272,7 @@ fi
 %{python3_sitelib}/qubes/storage/file.py
 %{python3_sitelib}/qubes/storage/kernels.py
 %{python3_sitelib}/qubes/storage/lvm.py
+%{python3_sitelib}/qubes/storage/reflink.py
 
 %dir %{python3_sitelib}/qubes/tools
 %dir %{python3_sitelib}/qubes/tools/__pycache__
@@ -304,16 +307,20 @@ fi
 %{python3_sitelib}/qubes/tests/api_admin.py
 %{python3_sitelib}/qubes/tests/api_misc.py
 %{python3_sitelib}/qubes/tests/app.py
+%{python3_sitelib}/qubes/tests/bulk.py
 %{python3_sitelib}/qubes/tests/devices.py
 %{python3_sitelib}/qubes/tests/devices_block.py
 %{python3_sitelib}/qubes/tests/events.py
 %{python3_sitelib}/qubes/tests/ext.py
 %{python3_sitelib}/qubes/tests/firewall.py
 %{python3_sitelib}/qubes/tests/init.py
+%{python3_sitelib}/qubes/tests/lvm_stub.py
+%{python3_sitelib}/qubes/tests/stats.py
 %{python3_sitelib}/qubes/tests/storage.py
 %{python3_sitelib}/qubes/tests/storage_file.py
 %{python3_sitelib}/qubes/tests/storage_kernels.py
 %{python3_sitelib}/qubes/tests/storage_lvm.py
+%{python3_sitelib}/qubes/tests/storage_reflink.py
 %{python3_sitelib}/qubes/tests/tarwriter.py
 
 %dir %{python3_sitelib}/qubes/tests/vm